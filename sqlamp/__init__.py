@@ -60,15 +60,26 @@
     .. _`PostgreSQL`: http://postgresql.org
 """
 import weakref
-from operator import attrgetter
+import pickle
+import threading
+import time
+import zlib
+from operator import attrgetter, itemgetter
 import sqlalchemy, sqlalchemy.orm, sqlalchemy.orm.exc
+try:
+    # SQLAlchemy 0.7+
+    from sqlalchemy import event
+except ImportError:
+    event = None
 from sqlalchemy.orm.mapper import class_mapper
 from sqlalchemy.ext.declarative import DeclarativeMeta as BaseDeclarativeMeta
 
 
 __all__ = [
     'MPManager', 'tree_recursive_iterator', 'DeclarativeMeta',
-    'PathOverflowError', 'TooManyChildrenError', 'PathTooDeepError'
+    'PathOverflowError', 'TooManyChildrenError', 'PathTooDeepError',
+    'SubtreeCache', 'DictCacheBackend', 'PathRange',
+    'OperationCost', 'IntegrityProblem'
 ]
 
 __version__ = (0, 6, 0)
@@ -94,11 +105,77 @@ try:
     basestring
 except NameError:
     basestring = str
+try:
+    # `bytes` is new in python 2.6
+    bytes
+except NameError:
+    bytes = str
+try:
+    # `json` is new in python 2.6, `simplejson` is the same module
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+try:
+    # `namedtuple` is new in python 2.6
+    from collections import namedtuple
+except ImportError:
+    def namedtuple(typename, field_names):
+        field_names = tuple(field_names.split())
+        def __new__(cls, *args, **kwargs):
+            args += tuple([kwargs.pop(name)
+                           for name in field_names[len(args):]
+                           if name in kwargs])
+            if kwargs or len(args) != len(field_names):
+                raise TypeError("%s() takes exactly %d arguments"
+                                % (typename, len(field_names)))
+            return tuple.__new__(cls, args)
+        def __repr__(self):
+            return '%s(%s)' % (typename, ', '.join([
+                '%s=%r' % item for item in zip(field_names, self)
+            ]))
+        namespace = {'__slots__': (), '__new__': __new__,
+                     '__repr__': __repr__, '_fields': field_names}
+        for index, name in enumerate(field_names):
+            namespace[name] = property(itemgetter(index))
+        return type(typename, (tuple, ), namespace)
+try:
+    # `OrderedDict` is new in python 2.7
+    from collections import OrderedDict
+except ImportError:
+    class OrderedDict(dict):
+        # Only what is used by LRU caches here. Removing of
+        # a key takes time proportional to the number of keys.
+        def __init__(self):
+            dict.__init__(self)
+            self._keys = []
+        def __setitem__(self, key, value):
+            if key not in self:
+                self._keys.append(key)
+            dict.__setitem__(self, key, value)
+        def __iter__(self):
+            return iter(list(self._keys))
+        def pop(self, key, *default):
+            if key in self:
+                self._keys.remove(key)
+            return dict.pop(self, key, *default)
+        def popitem(self, last=True):
+            if not self._keys:
+                raise KeyError('dictionary is empty')
+            key = self._keys[last and -1 or 0]
+            return key, self.pop(key)
 
 
 ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# digits of paths stored in :class:`BinaryPathField`: all byte values,
+# one character per byte (latin-1).
+BINARY_ALPHABET = ''.join(map(chr, range(256)))
 PATH_FIELD_LENGTH = 255
 STEP_LENGTH = 3
+# the number of chunk sizes to keep `MPOptions.chunk_end()` templates for
+_CHUNK_END_SIZES = 4
 
 
 if hasattr(sqlalchemy.exc, 'DontWrapMixin'):
@@ -127,15 +204,68 @@ class MovingToDescendantError(RuntimeError):
     """
 
 
-def inc_path(path, steplen):
+class PathRange(namedtuple('PathRange', 'tree_id from_path to_path')):
+    """
+    A range of paths in tree ``tree_id`` starting from ``from_path``
+    (inclusive) and up to ``to_path`` (exclusive). The latter is `None`
+    if the range lasts to the end of the tree.
+
+    Instances are passed to `events`_ listeners.
+
+    .. versionadded:: 0.7
+    """
+    __slots__ = ()
+
+class OperationCost(namedtuple('OperationCost', 'subtree_size '
+                               'shifted_subtrees rows statements')):
+    """
+    An estimation of a structural operation, see
+    :meth:`MPClassManager.estimate`. ``subtree_size`` is the number of nodes
+    in the target subtree, ``shifted_subtrees`` is a list of sizes of sibling
+    subtrees which are going to be shifted to free a place for the target
+    node or to fill a gap left by it, ``rows`` is the total number of rows
+    to be updated or deleted and ``statements`` is the number of DML
+    statements the operation takes.
+
+    .. versionadded:: 0.7
+    """
+    __slots__ = ()
+
+class IntegrityProblem(namedtuple('IntegrityProblem',
+                                  'node_id tree_id path problem')):
+    """
+    A problem found by :meth:`MPClassManager.check_integrity` in node
+    ``node_id`` with tree id ``tree_id`` and path ``path``. ``problem``
+    is one of the strings:
+
+    * ``'root'`` -- a root node doesn't have empty path or a tree doesn't
+      have a root node (for the first node of the tree) or has several
+      of them;
+    * ``'depth'`` -- path length doesn't match the depth;
+    * ``'parent'`` -- parent's path is not the node's path prefix or parent
+      belongs to another tree;
+    * ``'gap'`` -- the node's path is not the next one after previous
+      sibling's path (or is not the first possible path for the first
+      child);
+    * ``'order'`` -- the database sorts paths differently than
+      :mod:`sqlamp` does, which breaks all the queries.
+
+    .. versionadded:: 0.7
+    """
+    __slots__ = ()
+
+
+def inc_path(path, steplen, alphabet=ALPHABET):
     """
     Simple arithmetical operation --- incrementation of an integer number
-    (with radix of `len(ALPHABET)`) represented as string.
+    (with radix of `len(alphabet)`) represented as string.
 
     :param path:
         `str`, the path to increment.
     :param steplen:
         `int`, the number of maximum characters to carry overflow.
+    :param alphabet:
+        `str`, ordered digits of paths.
     :returns:
         new path which is greater than `path` by one.
     :raises PathOverflowError:
@@ -155,16 +285,231 @@ def inc_path(path, steplen):
                                              inc_path, 'ABZZ', 2)
     """
     parent_path, path = path[:-steplen], path[-steplen:]
-    path = path.rstrip(ALPHABET[-1])
+    path = path.rstrip(alphabet[-1])
     if not path:
         raise PathOverflowError()
     zeros = steplen - len(path)
     path = path[:-1] + \
-           ALPHABET[ALPHABET.index(path[-1]) + 1] + \
-           ALPHABET[0] * zeros
+           alphabet[alphabet.index(path[-1]) + 1] + \
+           alphabet[0] * zeros
     return parent_path + path
 
 
+def _index_to_path(index, steplen, alphabet=ALPHABET):
+    """
+    Get the last part of path of a node which is ``index``-th (zero-based)
+    child of its parent.
+
+    >>> _index_to_path(0, 3)
+    '000'
+    >>> _index_to_path(37, 2)
+    '11'
+    """
+    digits = []
+    for x in range(steplen):
+        index, digit = divmod(index, len(alphabet))
+        digits.append(alphabet[digit])
+    if index:
+        raise TooManyChildrenError()
+    digits.reverse()
+    return ''.join(digits)
+
+
+def _path_to_index(path, steplen, alphabet=ALPHABET):
+    """
+    The reverse of :func:`_index_to_path`: get the zero-based index
+    of a node with path ``path`` among its siblings.
+
+    >>> _path_to_index('0A011', 2)
+    37
+    >>> _path_to_index('00Z', 3)
+    35
+    """
+    index = 0
+    for digit in path[-steplen:]:
+        index = index * len(alphabet) + alphabet.index(digit)
+    return index
+
+
+class DictCacheBackend(object):
+    """
+    In-process storage for :class:`SubtreeCache` with LRU and (optional)
+    TTL eviction.
+
+    :param maxsize:
+        maximum number of entries to keep. When exceeded, the least
+        recently used entry is evicted.
+    :param ttl:
+        number of seconds after which the entry expires, or `None`
+        for entries that never expire.
+    :param timer:
+        a callable returning current time in seconds, `time.time`
+        by default.
+
+    Instances can be shared between threads. Any object which has methods
+    :meth:`get`, :meth:`set` and :meth:`delete` with the same semantics
+    can be used as a backend. Backends which evict
+    entries silently (instead of returning their keys from :meth:`set`)
+    make :class:`SubtreeCache` remember path ranges of evicted entries
+    till they are invalidated.
+
+    .. versionadded:: 0.7
+    """
+    def __init__(self, maxsize=1024, ttl=None, timer=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer or time.time
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        "Get the value stored for ``key`` or `None` if there is no such."
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= self.timer():
+                return None
+            # re-inserting to mark the entry as the most recently used
+            self._entries[key] = (expires, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        """
+        Store ``value`` for ``key``, evicting old entries if needed.
+        Returns a list of evicted keys.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = self.timer() + self.ttl
+        evicted = []
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                evicted.append(self._entries.popitem(last=False)[0])
+        finally:
+            self._lock.release()
+        return evicted
+
+    def delete(self, key):
+        "Remove ``key`` from the storage, if it is there."
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+
+class SubtreeCache(object):
+    """
+    Opt-in cache of node's descendants and children lists. See
+    :meth:`MPInstanceManager.get_descendants`
+    and :meth:`MPInstanceManager.get_children`.
+
+    Entries are keyed by ``(tree_id, path, kind, depth_limit)`` and each
+    of them covers a range of paths in one tree. All the methods of
+    :class:`MPClassManager` and the mapper extension invalidate only
+    those entries which path ranges overlap with the range of changed
+    nodes, once the transaction is committed. Ranges are tracked by each
+    instance in its process, so entries stored in a shared backend by
+    other processes are not invalidated by changes made in this one.
+
+    Lists are stored pickled, the same way shared caches (like memcached)
+    require, and every :meth:`get` returns new detached copies of nodes.
+    So node classes have to be picklable.
+
+    :param backend:
+        storage for cached values, see :class:`DictCacheBackend`. A new
+        :class:`DictCacheBackend` is created if omitted.
+
+    .. versionadded:: 0.7
+    """
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = DictCacheBackend()
+        self.backend = backend
+        # tree_id -> {key: (from_path, to_path)}, guarded by the lock
+        self._ranges = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        "Get a cached list for ``key`` or `None` if it is not cached."
+        value = self.backend.get(key)
+        if value is None:
+            # the entry was evicted, forget about it
+            self._forget(key)
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, from_path, to_path):
+        """
+        Store a list ``value`` for ``key`` which covers paths from
+        ``from_path`` (inclusive) to ``to_path`` (exclusive, `None`
+        means the end of the tree).
+        """
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._lock.acquire()
+        try:
+            # the range is known before the entry can be read, so
+            # invalidation in another thread can't miss it.
+            self._ranges.setdefault(key[0], {})[key] = (from_path, to_path)
+            evicted = self.backend.set(key, value)
+            for evicted_key in evicted or ():
+                self._forget(evicted_key)
+        finally:
+            self._lock.release()
+
+    def _forget(self, key):
+        "Forget the range of an entry which is not in the backend anymore."
+        self._lock.acquire()
+        try:
+            ranges = self._ranges.get(key[0])
+            if ranges is not None:
+                ranges.pop(key, None)
+                if not ranges:
+                    del self._ranges[key[0]]
+        finally:
+            self._lock.release()
+
+    def invalidate(self, tree_id, from_path, to_path):
+        """
+        Drop all the entries of tree ``tree_id`` with path ranges overlapping
+        with the range from ``from_path`` to ``to_path`` (the same semantic
+        as in :meth:`set`).
+        """
+        self._lock.acquire()
+        try:
+            ranges = self._ranges.get(tree_id)
+            if not ranges:
+                return
+            for key, (entry_from, entry_to) in list(ranges.items()):
+                if (entry_to is None or from_path < entry_to) \
+                        and (to_path is None or entry_from < to_path):
+                    self.backend.delete(key)
+                    self._forget(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        "Drop all the entries."
+        self._lock.acquire()
+        try:
+            for ranges in self._ranges.values():
+                for key in ranges:
+                    self.backend.delete(key)
+            self._ranges.clear()
+        finally:
+            self._lock.release()
+
+
+_subtree_end = object()
+
 class MPOptions(object):
     """
     A container for options for one tree table.
@@ -186,16 +531,44 @@ class MPOptions(object):
                  tree_id_field='mp_tree_id',
                  steplen=None,
                  pathlen=None,
+                 cache=None,
+                 track_versions=False,
+                 concurrency=None,
+                 tree_locks=False,
+                 node_order_by=None,
+                 binary_paths=False,
+                 alphabet=None,
                  _attach_columns=True):
 
         self.table = table
 
+        assert concurrency in (None, 'lock', 'retry'), \
+               "Unknown concurrency strategy: %r" % (concurrency, )
+        self.concurrency = concurrency
+
+        if cache is True:
+            cache = SubtreeCache()
+        self.cache = cache
+
         if steplen is not None:
             self.steplen = steplen
         else:
             self.steplen = STEP_LENGTH
+        if isinstance(self.steplen, int):
+            self.steplens = (self.steplen, )
+        else:
+            # lengths of steps of the first levels, the last one is used
+            # for all the deeper levels.
+            self.steplens = tuple(self.steplen)
+        assert self.steplens and min(self.steplens) > 0, \
+               "Invalid steplen: %r" % (self.steplen, )
         # pathlen is set later, after creating a column object
 
+        assert alphabet is None or len(alphabet) > 1 and \
+               list(alphabet) == sorted(set(alphabet)), \
+               "Alphabet should consist of unique characters " \
+               "in ascending order"
+
         assert len(table.primary_key.columns) == 1, \
                "Composite primary keys are not supported"
         [self.pk_field] = table.primary_key.columns
@@ -209,6 +582,14 @@ class MPOptions(object):
             assert parent_id_field.table is table
             self.parent_id_field = parent_id_field
 
+        self.node_order_by = None
+        if node_order_by is not None:
+            self.node_order_by = []
+            for column in node_order_by:
+                if isinstance(column, basestring):
+                    column = table.columns[column]
+                self.node_order_by.append(column)
+
         # If path length was not provided, we omit passing it to checker
         # function and let :class:`PathField` set the default length.
         path_params = {}
@@ -216,7 +597,9 @@ class MPOptions(object):
             path_params = {'length': pathlen}
 
         self.path_field = self.check_or_create_field(
-            table, 'path', path_field, PathField, _attach_columns, path_params
+            table, 'path', path_field,
+            binary_paths and BinaryPathField or PathField,
+            _attach_columns, path_params
         )
         self.depth_field = self.check_or_create_field(
             table, 'depth', depth_field, DepthField, _attach_columns
@@ -226,11 +609,58 @@ class MPOptions(object):
         )
         self.fields = (self.path_field, self.depth_field, self.tree_id_field)
 
+        self.versions_table = None
+        if track_versions:
+            # side table holding one row per tree
+            self.versions_table = sqlalchemy.Table(
+                '%s__mp_versions' % table.name, table.metadata,
+                sqlalchemy.Column('tree_id', sqlalchemy.Integer,
+                                  primary_key=True, autoincrement=False),
+                sqlalchemy.Column('version', sqlalchemy.Integer,
+                                  nullable=False)
+            )
+
+        self.locks_table = None
+        if tree_locks:
+            # rows to lock on databases without advisory locks
+            self.locks_table = sqlalchemy.Table(
+                '%s__mp_locks' % table.name, table.metadata,
+                sqlalchemy.Column('tree_id', sqlalchemy.Integer,
+                                  primary_key=True, autoincrement=False)
+            )
+            # the first key of PostgreSQL advisory locks, the second
+            # one is tree id.
+            self._lock_key = zlib.crc32(table.name.encode('utf-8')) \
+                             & 0x7fffffff
+
         # Getting path length from the actual column length, no matter if
         # we're dealing with custom path field object, or just created one.
         self.pathlen = self.path_field.type.length
-        self.max_children = len(ALPHABET) ** self.steplen
-        self.max_depth = (self.pathlen // self.steplen) + 1
+        self.binary_paths = isinstance(self.path_field.type, BinaryPathField)
+        if alphabet is not None:
+            self.alphabet = alphabet
+        elif self.binary_paths:
+            self.alphabet = BINARY_ALPHABET
+        else:
+            self.alphabet = ALPHABET
+        self.max_children = len(self.alphabet) ** min(self.steplens)
+        self.max_depth = self.path_depth('x' * self.pathlen) + 1
+
+        # Statement templates are built on first use as in declarative
+        # setup columns are not attached to the table at this point yet.
+        self._statements = None
+        self._compiled_cache = {}
+        # templates of `chunk_end()` with their compiled cache, keyed
+        # by chunk size, least recently used go first.
+        self._chunk_end_statements = OrderedDict()
+        self._chunk_end_lock = threading.Lock()
+        # ranges of paths to drop from the cache when transaction
+        # is committed, keyed by connection.
+        self._pending_invalidations = weakref.WeakKeyDictionary()
+        # values allocated in `insertion_params()` for nodes which
+        # are flushed but not inserted yet, keyed by session. Values
+        # are pairs of weak reference to flush's transaction and a dict.
+        self._pending_insertions = weakref.WeakKeyDictionary()
 
         if _attach_columns:
             self.declare_indices()
@@ -305,6 +735,342 @@ class MPOptions(object):
                              .order_by(None) \
                              .order_by(self.tree_id_field, self.path_field)
 
+    def _build_statements(self):
+        """
+        Build templates of statements which are used by :class:`MPClassManager`
+        and the mapper extension. All the values in templates are bound
+        parameters (prefixed with ``sqlamp_`` in order not to clash with
+        table's column names), so the very same statement objects are used
+        for all the calls and get compiled only once (see :meth:`execute`).
+
+        Statements which filter by a range of paths go in two variants:
+        keyed by a tuple ``(name, True)`` for ranges with the upper bound
+        and ``(name, False)`` for ranges without it.
+        """
+        bindparam = sqlalchemy.bindparam
+        select = sqlalchemy.select
+        statements = {}
+
+        node_by_pk = self.pk_field == bindparam('sqlamp_node_id')
+        columns = [self.parent_id_field, self.path_field,
+                   self.depth_field, self.tree_id_field]
+        statements['node'] = select(columns).where(node_by_pk)
+        statements['node_and_anchor'] = select(columns).where(node_by_pk) \
+                .union_all(select(columns).where(
+                    self.pk_field == bindparam('sqlamp_anchor_id')
+                ))
+        statements['path'] = select([self.path_field]).where(node_by_pk)
+        statements['children'] = select([self.pk_field] + columns) \
+                .where(self.parent_id_field == bindparam('sqlamp_parent_id')) \
+                .order_by(self.path_field)
+        lock_parent = select([self.pk_field]).where(
+            self.pk_field == bindparam('sqlamp_parent_id')
+        )
+        if hasattr(lock_parent, 'with_for_update'):
+            lock_parent = lock_parent.with_for_update()
+        else:
+            # SQLAlchemy < 0.9
+            lock_parent.for_update = True
+        statements['lock_parent'] = lock_parent
+        statements['max_tree_id'] = select(
+            [sqlalchemy.func.max(self.tree_id_field)]
+        )
+        parent_id = bindparam('sqlamp_parent_id')
+        statements['insertion_params'] = select(
+            [
+                self.tree_id_field.label('tree_id'),
+                (self.depth_field + 1).label('depth'),
+                self.path_field.label('parent_path'),
+                select([sqlalchemy.func.max(self.path_field)])
+                    .where(self.parent_id_field == parent_id)
+                    .label('last_child_path'),
+            ]
+        ).where(self.pk_field == parent_id)
+        statements['reparent'] = self.table.update().where(node_by_pk) \
+                .values({self.parent_id_field:
+                             bindparam('sqlamp_new_parent_id')})
+        statements['set_node'] = self.table.update().where(node_by_pk) \
+                .values({self.tree_id_field: bindparam('sqlamp_tree_id'),
+                         self.path_field: bindparam('sqlamp_path'),
+                         self.depth_field: bindparam('sqlamp_depth')})
+
+        new_path_expr = sqlalchemy.func.substr(
+            self.path_field, bindparam('sqlamp_cut_pos',
+                                       type_=sqlalchemy.Integer)
+        )
+        if self.binary_paths:
+            path_type = self.path_field.type
+            new_path_expr.type = path_type
+            # SQLite turns concatenated blobs into text, which
+            # doesn't compare with blobs.
+            new_path_expr = sqlalchemy.cast(
+                bindparam('sqlamp_new_path', type_=path_type)
+                    .concat(new_path_expr),
+                path_type
+            )
+        else:
+            # this is needed for concatenation of function
+            # and literal to work with SQLAlchemy 0.5.x
+            new_path_expr.type = sqlalchemy.String()
+            new_path_expr = bindparam('sqlamp_new_path',
+                                      type_=sqlalchemy.String) + new_path_expr
+        new_depth_expr = self.depth_field + \
+                bindparam('sqlamp_depth_delta', type_=sqlalchemy.Integer)
+
+        for bounded in (True, False):
+            range_ = self._range_clause(bounded)
+            statements['delete', bounded] = \
+                    self.table.delete().where(range_)
+            statements['update_subtree', bounded] = \
+                    self.table.update().where(range_) \
+                        .values({self.tree_id_field:
+                                     bindparam('sqlamp_new_tree_id'),
+                                 self.depth_field: new_depth_expr,
+                                 self.path_field: new_path_expr})
+            level = range_ & (self.depth_field == bindparam('sqlamp_depth'))
+            statements['level', bounded] = \
+                    select([self.pk_field, self.path_field]).where(level) \
+                        .order_by(self.tree_id_field, self.path_field)
+            subtree_path = sqlalchemy.func.substr(
+                self.path_field, 1,
+                bindparam('sqlamp_path_len', type_=sqlalchemy.Integer),
+                type_=self.path_field.type
+            ).label('subtree_path')
+            statements['subtree_sizes', bounded] = \
+                    select([subtree_path,
+                            sqlalchemy.func.count(self.pk_field)]) \
+                        .where(range_) \
+                        .group_by('subtree_path') \
+                        .order_by('subtree_path')
+            statements['last_in_level', bounded] = \
+                    select([self.path_field]).where(level) \
+                        .order_by(self.tree_id_field.desc(),
+                                  self.path_field.desc()) \
+                        .limit(1)
+            statements['nodes', bounded] = \
+                    select([self.pk_field, self.path_field]).where(range_) \
+                        .order_by(self.path_field)
+            # copies get all the columns except primary key and tree
+            # fields from the originals. Columns are compared in a set
+            # as `==` makes a clause of them.
+            tree_fields = set((self.pk_field, self.parent_id_field)
+                              + self.fields)
+            columns = [column for column in self.table.columns
+                       if column not in tree_fields]
+            insert = self.table.insert()
+            if hasattr(insert, 'from_select'):
+                # SQLAlchemy 0.8.3+
+                values = columns + [
+                    bindparam('sqlamp_new_parent_id',
+                              type_=self.parent_id_field.type),
+                    bindparam('sqlamp_new_tree_id', type_=sqlalchemy.Integer),
+                    new_depth_expr,
+                    new_path_expr,
+                ]
+                statements['copy_subtree', bounded] = insert.from_select(
+                    columns + [self.parent_id_field, self.tree_id_field,
+                               self.depth_field, self.path_field],
+                    select(values).where(range_)
+                )
+            else:
+                # rows are fetched and their copies are inserted
+                # by one batched statement.
+                statements['copy_subtree', bounded] = select(
+                    [column.label(column.key) for column in columns]
+                    + [self.depth_field.label('sqlamp_depth'),
+                       self.path_field.label('sqlamp_path')]
+                ).where(range_)
+                statements['insert_copies'] = insert
+
+        if self.node_order_by is not None:
+            # the first sibling which has to follow the node, the order
+            # is compared with the node's row itself. NULLs go after
+            # all the other values.
+            node = self.table.alias()
+            follows = None
+            for column in reversed(self.node_order_by):
+                node_column = node.corresponding_column(column)
+                clause = (node_column != None) & \
+                         ((column > node_column) | (column == None))
+                if follows is not None:
+                    equals = (column == node_column) | \
+                             ((column == None) & (node_column == None))
+                    clause |= equals & follows
+                follows = clause
+            statements['next_in_order'] = select([self.pk_field]) \
+                    .where(node.corresponding_column(self.pk_field) ==
+                           bindparam('sqlamp_node_id')) \
+                    .where(self.parent_id_field ==
+                           bindparam('sqlamp_parent_id')) \
+                    .where(self.pk_field !=
+                           node.corresponding_column(self.pk_field)) \
+                    .where(follows) \
+                    .order_by(self.path_field) \
+                    .limit(1)
+        if self.versions_table is not None:
+            version = self.versions_table.c.version
+            by_tree_id = self.versions_table.c.tree_id == \
+                         bindparam('sqlamp_tree_id')
+            statements['bump_version'] = self.versions_table.update() \
+                    .where(by_tree_id).values({version: version + 1})
+            statements['insert_version'] = self.versions_table.insert() \
+                    .values({self.versions_table.c.tree_id:
+                                 bindparam('sqlamp_tree_id'),
+                             version: 1})
+        if self.locks_table is not None:
+            tree_id = self.locks_table.c.tree_id
+            statements['lock_tree'] = self.locks_table.update() \
+                    .where(tree_id == bindparam('sqlamp_tree_id')) \
+                    .values({tree_id: tree_id})
+            statements['insert_lock'] = self.locks_table.insert() \
+                    .values({tree_id: bindparam('sqlamp_tree_id')})
+            statements['advisory_lock'] = select([
+                sqlalchemy.func.pg_advisory_xact_lock(
+                    bindparam('sqlamp_lock_key', type_=sqlalchemy.Integer),
+                    bindparam('sqlamp_tree_id', type_=sqlalchemy.Integer)
+                )
+            ])
+        return statements
+
+    def _range_clause(self, bounded):
+        """
+        Build a clause filtering nodes by range of paths in one tree
+        for statement templates, see :meth:`execute_in_range`.
+        """
+        bindparam = sqlalchemy.bindparam
+        range_ = (self.tree_id_field == bindparam('sqlamp_tree_id')) & \
+                 (self.path_field >= bindparam('sqlamp_from_path'))
+        if bounded:
+            range_ &= self.path_field < bindparam('sqlamp_to_path')
+        return range_
+
+    def execute(self, bind, name, params=None):
+        """
+        Execute a statement template ``name`` (see :meth:`_build_statements`)
+        with parameters ``params`` using per-options compiled cache.
+
+        :param bind:
+            a session or a connection to execute statement with.
+        """
+        if self._statements is None:
+            self._statements = self._build_statements()
+        statement = self._statements[name]
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=statement)
+        if hasattr(bind, 'execution_options'):
+            # SQLAlchemy 0.6.5+ is able to reuse compiled statements
+            bind = bind.execution_options(compiled_cache=self._compiled_cache)
+        return bind.execute(statement, params or {})
+
+    def execute_in_range(self, bind, name, tree_id, from_path, to_path,
+                         params=None):
+        """
+        The same as :meth:`execute` but for statements filtering nodes
+        of tree ``tree_id`` with paths from ``from_path`` (inclusive)
+        to ``to_path`` (exclusive, `None` means the end of the tree).
+        """
+        params = dict(params or {})
+        params.update(sqlamp_tree_id=tree_id, sqlamp_from_path=from_path)
+        if to_path is not None:
+            params['sqlamp_to_path'] = to_path
+        return self.execute(bind, (name, to_path is not None), params)
+
+    def chunk_end(self, bind, tree_id, from_path, to_path, chunk_size):
+        """
+        Get the path of the node following the first ``chunk_size`` nodes
+        in the range of paths (see :meth:`execute_in_range`), so it is
+        the upper bound of that chunk of the range. `None` is returned
+        if there are no more nodes in the range.
+        """
+        # limits can't be bound parameters in older SQLAlchemy
+        # versions, so there is a template per chunk size. Only
+        # templates of a few recently used sizes are kept.
+        self._chunk_end_lock.acquire()
+        try:
+            statements = self._chunk_end_statements.pop(chunk_size, None)
+            if statements is None:
+                if len(self._chunk_end_statements) >= _CHUNK_END_SIZES:
+                    self._chunk_end_statements.popitem(last=False)
+                statements = ({}, {})
+                for bounded in (True, False):
+                    statements[0][bounded] = \
+                        sqlalchemy.select([self.path_field]) \
+                            .where(self._range_clause(bounded)) \
+                            .order_by(self.tree_id_field, self.path_field) \
+                            .limit(1).offset(chunk_size)
+            self._chunk_end_statements[chunk_size] = statements
+        finally:
+            self._chunk_end_lock.release()
+        templates, compiled_cache = statements
+        statement = templates[to_path is not None]
+        params = {'sqlamp_tree_id': tree_id, 'sqlamp_from_path': from_path}
+        if to_path is not None:
+            params['sqlamp_to_path'] = to_path
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=statement)
+        if hasattr(bind, 'execution_options'):
+            bind = bind.execution_options(compiled_cache=compiled_cache)
+        return bind.execute(statement, params).scalar()
+
+    def insertion_params(self, bind, parent_id, pending=None):
+        """
+        Calculate values of `tree_id`, `path` and `depth` fields
+        for a new node.
+
+        :param bind: a session or a connection to execute queries with.
+        :param parent_id: parent's node primary key, may be `None`.
+        :param pending:
+            a dict of values which were allocated for nodes that are
+            not inserted yet, keyed by parent id (`None` for root nodes).
+            It gets updated with the new values, so it can be passed
+            to subsequent calls.
+        :return: three-element tuple ``(tree_id, path, depth)``.
+        """
+        if pending is None:
+            pending = {}
+        if parent_id is None:
+            # a new instance will be a root node.
+            # `tree_id` is next unused integer value,
+            # `depth` for root nodes is equal to zero,
+            # `path` should be empty string.
+            [tree_id] = self.execute(bind, 'max_tree_id').fetchone()
+            if None in pending:
+                tree_id = max(tree_id or 0, pending[None][0])
+            params = ((tree_id or 0) + 1, '', 0)
+        else:
+            # a new instance has at least one ancestor.
+            # `tree_id` can be used from parent's value,
+            # `depth` is parent's depth plus one,
+            # `path` will be calculated from two values -
+            # the path of the parent node itself and it's
+            # last child's path.
+            if self.concurrency == 'lock':
+                # concurrent insertions of parent's children wait
+                # here till this transaction ends.
+                self.execute(bind, 'lock_parent',
+                             {'sqlamp_parent_id': parent_id})
+            query = self.execute(bind, 'insertion_params',
+                                 {'sqlamp_parent_id': parent_id}).fetchone()
+            last_child_path = query['last_child_path']
+            if parent_id in pending:
+                last_child_path = max(last_child_path or '',
+                                      pending[parent_id][1])
+            if not last_child_path:
+                # node is the first child.
+                path = self.child_path(query['parent_path'])
+            else:
+                try:
+                    path = self.next_path(last_child_path)
+                except PathOverflowError:
+                    # transform exception `PathOverflowError`, raised by
+                    # `inc_path()` to more convenient `TooManyChildrenError`.
+                    raise TooManyChildrenError()
+            if len(path) > self.pathlen:
+                raise PathTooDeepError()
+            params = (query['tree_id'], path, query['depth'])
+        pending[parent_id] = params
+        return params
+
     def filter_descendants(self, tree_id, path, and_self):
         """
         Get a filter condition for descendants of node with known
@@ -318,12 +1084,7 @@ class MPOptions(object):
         """
         # we are not using queries like `WHERE path LIKE '0.1.%` instead
         # they looks like `WHERE path > '0.1' AND path < '0.2'`
-        try:
-            next_sibling_path = inc_path(path, self.steplen)
-        except PathOverflowError:
-            # this node is theoretically last, will not check
-            # for `path < next_sibling_path`
-            next_sibling_path = None
+        path, next_sibling_path = self.path_range(path)
         # always filter by `tree_id`:
         filter_ = self.tree_id_field == tree_id
         if and_self:
@@ -335,6 +1096,288 @@ class MPOptions(object):
             filter_ &= self.path_field < next_sibling_path
         return filter_
 
+    def path_range(self, path):
+        """
+        Get the range of paths of a subtree starting from node with
+        path ``path``.
+
+        :return:
+            two-element tuple: ``path`` itself and the path of the following
+            sibling, which is the first path out of the subtree. The second
+            element is `None` if the subtree is the last possible one.
+        """
+        try:
+            next_sibling_path = self.next_path(path)
+        except PathOverflowError:
+            # this node is theoretically last, nothing can follow it
+            next_sibling_path = None
+        return path, next_sibling_path
+
+    def step_length(self, depth):
+        """
+        Get the number of characters of the last part of paths
+        of nodes at level ``depth`` (starting from 1).
+        """
+        return self.steplens[min(depth, len(self.steplens)) - 1]
+
+    def path_length(self, depth):
+        "Get the length of paths of nodes at level ``depth``."
+        steplens = self.steplens
+        if depth <= len(steplens):
+            return sum(steplens[:depth])
+        return sum(steplens) + (depth - len(steplens)) * steplens[-1]
+
+    def path_depth(self, path):
+        """
+        Get the level of a node by its ``path``. Paths with lengths which
+        don't match any level are taken for the nearest upper level
+        (the deepest one with shorter paths).
+        """
+        length = len(path)
+        depth = total = 0
+        for steplen in self.steplens:
+            if total + steplen > length:
+                return depth
+            depth += 1
+            total += steplen
+        return depth + (length - total) // self.steplens[-1]
+
+    def parent_path(self, path):
+        "Get the path of the parent of a node with path ``path``."
+        return path[:-self.step_length(self.path_depth(path))]
+
+    def child_path(self, parent_path, index=0):
+        """
+        Get the path of ``index``-th (zero-based) child of a node with
+        path ``parent_path``.
+
+        :raises TooManyChildrenError:
+            if ``index`` doesn't fit in the step.
+        """
+        steplen = self.step_length(self.path_depth(parent_path) + 1)
+        return parent_path + _index_to_path(index, steplen, self.alphabet)
+
+    def child_index(self, path):
+        "Get the zero-based index of a node with path ``path``."
+        return _path_to_index(path, self.step_length(self.path_depth(path)),
+                              self.alphabet)
+
+    def next_path(self, path):
+        """
+        Get the path of the next sibling of a node with path ``path``.
+
+        :raises PathOverflowError:
+            if there can be no such sibling.
+        """
+        if not path:
+            raise PathOverflowError()
+        return inc_path(path, self.step_length(self.path_depth(path)),
+                        self.alphabet)
+
+    def same_steps(self, depth, other_depth):
+        """
+        Check whether descendants of nodes at levels ``depth``
+        and ``other_depth`` have steps of the same lengths, so subtrees
+        can be moved between the levels by cutting path prefixes.
+        """
+        return depth == other_depth or all(
+                   self.step_length(depth + level) ==
+                   self.step_length(other_depth + level)
+                   for level in range(1, len(self.steplens) + 1))
+
+    def rebase_path(self, path, old_path, old_depth, new_path, new_depth):
+        """
+        Get the new path and depth of a node with path ``path`` when
+        its ancestor (or the node itself) moves from path ``old_path``
+        at level ``old_depth`` to ``new_path`` at level ``new_depth``.
+        Each step below the ancestor keeps its number but gets the length
+        of the new level.
+        """
+        suffix = path[len(old_path):]
+        path, depth = new_path, new_depth
+        while suffix:
+            steplen = self.step_length(old_depth + 1)
+            index = _path_to_index(suffix[:steplen], steplen, self.alphabet)
+            old_depth += 1
+            depth += 1
+            path += _index_to_path(index, self.step_length(depth),
+                                   self.alphabet)
+            suffix = suffix[steplen:]
+        return path, depth
+
+    def invalidate_cache(self, bind, tree_id, path, to_path=_subtree_end):
+        """
+        Drop cached entries which overlap with the changed range of paths
+        in tree ``tree_id``. The range covers the whole subtree of ``path``
+        unless ``to_path`` is given explicitly. Does nothing if the cache
+        is not enabled.
+
+        Entries are dropped when the transaction of ``bind`` (a session
+        or a connection) is committed, till then the transaction doesn't
+        use the cache for that tree (see :meth:`cache_usable`), so neither
+        stale entries are read by it, nor uncommitted data is cached.
+        With SQLAlchemy < 0.7, without ``bind`` or outside of transaction
+        entries are dropped right away.
+        """
+        if self.cache is None:
+            return
+        if to_path is _subtree_end:
+            path, to_path = self.path_range(path)
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=self.table)
+        if event is None or bind is None or not bind.in_transaction():
+            self.cache.invalidate(tree_id, path, to_path)
+            return
+        pending = self._pending_invalidations.get(bind)
+        if pending is None:
+            # listeners stay with the connection for further transactions
+            pending = self._pending_invalidations[bind] = []
+            event.listen(bind, 'commit', self._invalidate_pending)
+            event.listen(bind, 'rollback', self._forget_pending)
+        pending.append((tree_id, path, to_path))
+
+    def _invalidate_pending(self, connection):
+        "Drop entries changed in the transaction being committed."
+        pending = self._pending_invalidations.get(connection)
+        while pending:
+            self.cache.invalidate(*pending.pop())
+
+    def _forget_pending(self, connection):
+        "Forget ranges changed in the transaction being rolled back."
+        del self._pending_invalidations.get(connection, [])[:]
+
+    def cache_usable(self, bind, tree_id):
+        """
+        Check if the transaction of ``bind`` (a session or a connection)
+        can use cached entries of tree ``tree_id``, that is it has not
+        changed the tree (see :meth:`invalidate_cache`). Queries without
+        a session (of detached nodes) don't use the cache.
+        """
+        if bind is None:
+            return False
+        if not self._pending_invalidations:
+            return True
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=self.table)
+        return all(pending_tree_id != tree_id for pending_tree_id, _, _ in
+                   self._pending_invalidations.get(bind, ()))
+
+    def subtree_range(self, tree_id, path):
+        "Get :class:`PathRange` of a subtree starting from ``path``."
+        return PathRange(tree_id, *self.path_range(path))
+
+    def dispatch_event(self, name, *args):
+        """
+        Call listeners of event ``name`` (see `events`_) with arguments
+        ``args``. Does nothing with SQLAlchemy versions prior to 0.7.
+        """
+        if event is not None:
+            getattr(self.dispatch, name)(*args)
+
+    def bump_versions(self, bind, tree_ids):
+        """
+        Increment versions of trees ``tree_ids`` if versions tracking
+        is enabled.
+
+        :param bind:
+            a session or a connection to execute queries within
+            the transaction that modifies the trees.
+        """
+        if self.versions_table is None:
+            return
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=self.table)
+        name = ('upsert_version', bind.dialect.name)
+        if self._statements is None:
+            self._statements = self._build_statements()
+        if name not in self._statements:
+            self._statements[name] = self._version_upsert(bind.dialect.name)
+        tree_ids = list(set(tree_ids))
+        tree_ids.sort()
+        for tree_id in tree_ids:
+            params = {'sqlamp_tree_id': tree_id}
+            if self._statements[name] is not None:
+                self.execute(bind, name, params)
+            else:
+                self._update_or_insert(bind, 'bump_version',
+                                       'insert_version', params)
+
+    def _version_upsert(self, dialect_name):
+        """
+        Build a statement which inserts the first version of a tree or
+        increments the existing one for dialect ``dialect_name``. `None`
+        is returned if SQLAlchemy doesn't support upserts in the dialect.
+        """
+        table = self.versions_table
+        values = {table.c.tree_id: sqlalchemy.bindparam('sqlamp_tree_id'),
+                  table.c.version: 1}
+        try:
+            if dialect_name in ('postgresql', 'sqlite'):
+                # SQLAlchemy 1.1+ (1.4+ for SQLite)
+                insert = __import__('sqlalchemy.dialects.' + dialect_name,
+                                    fromlist=['insert']).insert
+                return insert(table).values(values).on_conflict_do_update(
+                    index_elements=[table.c.tree_id],
+                    set_={table.c.version.key: table.c.version + 1}
+                )
+            elif dialect_name == 'mysql':
+                # SQLAlchemy 1.2+
+                from sqlalchemy.dialects.mysql import insert
+                return insert(table).values(values).on_duplicate_key_update(
+                    {table.c.version.key: table.c.version + 1}
+                )
+        except (ImportError, AttributeError):
+            pass
+        return None
+
+    def _update_or_insert(self, bind, update, insert, params):
+        """
+        Execute statement template ``update`` and if it doesn't match
+        any row insert one with template ``insert``. If a concurrent
+        transaction inserts the same row first, the insertion is rolled
+        back to a savepoint and the update is repeated.
+
+        :param bind:
+            a connection of the transaction.
+        """
+        while not self.execute(bind, update, params).rowcount:
+            savepoint = bind.begin_nested()
+            try:
+                self.execute(bind, insert, params)
+            except sqlalchemy.exc.IntegrityError:
+                savepoint.rollback()
+            else:
+                savepoint.commit()
+                return
+
+    def lock_trees(self, bind, tree_ids):
+        """
+        Lock trees ``tree_ids`` till the end of transaction if tree locks
+        are enabled. Transaction-level advisory locks are used with
+        PostgreSQL and rows of the locks table with other databases.
+        Trees are locked in order of their ids, so transactions locking
+        the same trees don't deadlock.
+
+        :param bind:
+            a session or a connection of the transaction.
+        """
+        if self.locks_table is None:
+            return
+        if isinstance(bind, sqlalchemy.orm.session.Session):
+            bind = bind.connection(clause=self.table)
+        advisory = bind.dialect.name == 'postgresql'
+        tree_ids = list(set(tree_ids))
+        tree_ids.sort()
+        for tree_id in tree_ids:
+            params = {'sqlamp_tree_id': tree_id}
+            if advisory:
+                params['sqlamp_lock_key'] = self._lock_key
+                self.execute(bind, 'advisory_lock', params)
+            else:
+                # the row is inserted by the first lock of the tree
+                self._update_or_insert(bind, 'lock_tree', 'insert_lock',
+                                       params)
+
     def filter_children(self, tree_id, path, depth):
         """
         The same as :meth:`filter_descendants` but filters children nodes
@@ -351,11 +1394,21 @@ class MPOptions(object):
 
     def filter_ancestors(self, tree_id, path, depth, and_self):
         "The same as :meth:`filter_descendants` but filters ancestor nodes."
-        # WHERE tree_id = <node.tree_id> AND <node.path> LIKE path || '%'
-        filter_ = (self.tree_id_field == tree_id) \
-                  & sqlalchemy.sql.expression.literal(
-                        path, sqlalchemy.String
-                    ).like(self.path_field + '%')
+        if self.binary_paths or self.alphabet != ALPHABET:
+            # LIKE doesn't apply to binary strings, and characters of custom
+            # alphabets may be wildcards or escape characters of LIKE,
+            # so ancestors' paths are looked up in the index instead.
+            filter_ = (self.tree_id_field == tree_id) \
+                      & self.path_field.in_([
+                            path[:self.path_length(level)]
+                            for level in range(depth + 1)
+                        ])
+        else:
+            # WHERE tree_id = <node.tree_id> AND <node.path> LIKE path || '%'
+            filter_ = (self.tree_id_field == tree_id) \
+                      & sqlalchemy.sql.expression.literal(
+                            path, sqlalchemy.String
+                        ).like(self.path_field + '%')
         if and_self:
             filter_ &= self.depth_field  <= depth
         else:
@@ -369,122 +1422,142 @@ class MPOptions(object):
         filter_ = self.pk_field == parent_id
         return filter_
 
-class _InsertionsParamsSelector(object):
-    """
-    Instances of this class used as values for :class:`TreeIdField`,
-    :class:`PathField` and :class:`DepthField` when tree nodes are
-    created. It makes a "lazy" query to determine actual values for
-    this fields.
+if event is not None:
+    class MPEvents(event.Events):
+        """
+        Structural change events of the trees. Listeners are registered
+        using SQLAlchemy's event API with either :class:`MPManager`,
+        :class:`MPClassManager` or the mapper extension as a target::
 
-    :param opts: instance of :class:`MPOptions`.
-    :param session: session which will be used for query.
-    :param parent_id: parent's node primary key, may be `None`.
-    """
-    def __init__(self, opts, session, parent_id):
-        self._mp_opts = opts
-        self.parent_id = parent_id
-        self.session = session
-        self._query_result = None
+            def on_moved(session, node_id, old_range, new_range):
+                ...
+            sqlalchemy.event.listen(Node.mp, 'subtree_moved', on_moved)
 
-    def _perform_query(self):
-        """
-        Make a query, get an actual values for `path`, `tree_id`
-        and `depth` fields and put them in dict `self._query_result`.
-        """
-        opts = self._mp_opts
-        if self.parent_id is None:
-            # a new instance will be a root node.
-            # `tree_id` is next unused integer value,
-            # `depth` for root nodes is equal to zero,
-            # `path` should be empty string.
-            [tree_id] = self.session.execute(
-                sqlalchemy.func.max(opts.tree_id_field)
-            ).fetchone()
-            if tree_id is None:
-                tree_id = 1
-            else:
-                tree_id += 1
-            self._query_result = dict(path='', depth=0, tree_id=tree_id)
-        else:
-            # a new instance has at least one ancestor.
-            # `tree_id` can be used from parent's value,
-            # `depth` is parent's depth plus one,
-            # `path` will be calculated from two values -
-            # the path of the parent node itself and it's
-            # last child's path.
-            query = self.session.execute(sqlalchemy.select(
-                [
-                    opts.tree_id_field.label('tree_id'),
-                    (opts.depth_field + 1).label('depth'),
-                    opts.path_field.label('parent_path'),
-                    sqlalchemy.select(
-                        [sqlalchemy.func.max(opts.path_field)],
-                        opts.parent_id_field == self.parent_id
-                    ).label('last_child_path'),
-                ],
-                opts.pk_field == self.parent_id
-            )).fetchone()
-            steplen = self._mp_opts.steplen
-            if not query['last_child_path']:
-                # node is the first child.
-                path = query['parent_path'] + ALPHABET[0] * steplen
-            else:
-                try:
-                    path = inc_path(query['last_child_path'], steplen)
-                except PathOverflowError:
-                    # transform exception `PathOverflowError`, raised by
-                    # `inc_path()` to more convenient `TooManyChildrenError`.
-                    raise TooManyChildrenError()
-            if len(path) > opts.pathlen:
-                raise PathTooDeepError()
-            self._query_result = dict(
-                path=path, depth=query['depth'], tree_id=query['tree_id']
-            )
+        The first argument of all the events is the session which
+        performs the change (the one being flushed for
+        :meth:`node_inserted`), so listeners can query the database
+        within its transaction. Ranges passed to listeners are
+        :class:`PathRange` instances.
 
-    @property
-    def query_result(self):
+        .. versionadded:: 0.7
         """
-        Get query result dict, calling `self._perform_query()`
-        for the first time.
-        """
-        if self._query_result is None:
-            self._perform_query()
-        return self._query_result
+        _dispatch_target = MPOptions
+
+        @classmethod
+        def _accept_with(cls, target):
+            target = getattr(target, '_mp_opts', target)
+            if isinstance(target, MPOptions):
+                return target
+            return None
+
+        def node_inserted(self, session, instance, new_range):
+            """
+            A node ``instance`` was inserted. Called from the mapper
+            extension's `after_insert` hook.
+            """
+
+        def subtree_moved(self, session, node_id, old_range, new_range):
+            """
+            A subtree starting from node with pk ``node_id`` was moved
+            to another place (possibly to another tree).
+            """
+
+        def subtree_deleted(self, session, node_id, old_range):
+            "A subtree starting from node with pk ``node_id`` was deleted."
+
+        def subtree_copied(self, session, node_id, new_node_id, new_range):
+            """
+            A subtree starting from node with pk ``node_id`` was copied,
+            ``new_node_id`` is the pk of the copy of that node.
+            """
+
+        def subtree_created(self, session, node_id, new_range):
+            """
+            A whole tree or subtree starting from node with pk ``node_id``
+            was created at once by :meth:`MPClassManager.import_tree`
+            or :meth:`MPClassManager.create_tree`, bypassing the mapper
+            extension (so :meth:`node_inserted` is not dispatched for
+            its nodes).
+            """
+
+        def subtree_rebuilt(self, session, node_id, new_range):
+            """
+            Descendants of node with pk ``node_id`` were rebuilt on the
+            basis of adjacency relations by
+            :meth:`MPClassManager.rebuild_subtree`,
+            :meth:`MPClassManager.rebuild_tree` or
+            :meth:`MPClassManager.rebuild_all_trees`. Any node within
+            ``new_range`` may have changed its path, nodes could also
+            come to that range from other places.
+            """
+
+        def siblings_shifted(self, session, old_range, new_range):
+            """
+            Following siblings of some node were shifted one step up
+            or down together with their subtrees. Ranges cover all the
+            shifted nodes.
+            """
+
+    if not hasattr(MPOptions, 'dispatch'):
+        # SQLAlchemy before 0.8 doesn't support `_dispatch_target`
+        MPOptions.dispatch = event.dispatcher(MPEvents)
 
 
 class TreeIdField(sqlalchemy.types.TypeDecorator):
     "Integer field subtype representing node's tree identifier."
     impl = sqlalchemy.Integer
-    def process_bind_param(self, value, dialect):
-        if not isinstance(value, _InsertionsParamsSelector):
-            return value
-        return value.query_result['tree_id']
+    cache_ok = True
 
 class DepthField(sqlalchemy.types.TypeDecorator):
     "Integer field subtype representing node's depth level."
     impl = sqlalchemy.Integer
-    def process_bind_param(self, value, dialect):
-        if not isinstance(value, _InsertionsParamsSelector):
-            return value
-        return value.query_result['depth']
+    cache_ok = True
 
 class PathField(sqlalchemy.types.TypeDecorator):
     "Varchar field subtype representing node's path."
     impl = sqlalchemy.String
+    cache_ok = True
     def __init__(self, length=None):
         if length is None:
             length = PATH_FIELD_LENGTH
         super(PathField, self).__init__(length)
-    def process_bind_param(self, value, dialect):
-        if not isinstance(value, _InsertionsParamsSelector):
-            return value
-        return value.query_result['path']
     def adapt_operator(self, op):
         # required for concatenation to work right
         return self.impl.adapt_operator(op)
 
+class BinaryPathField(PathField):
+    """
+    Binary field subtype representing node's path. Each character
+    of the path is stored as one byte (see ``binary_paths`` option
+    of :class:`MPManager`), values in Python are strings as usual.
+
+    .. versionadded:: 0.7
+    """
+    # `LargeBinary` was called `Binary` before SQLAlchemy 0.6
+    impl = getattr(sqlalchemy, 'LargeBinary', None) or sqlalchemy.Binary
+    cache_ok = True
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            # BLOB columns can't be indexed without prefix length.
+            from sqlalchemy.dialects.mysql import VARBINARY
+            return dialect.type_descriptor(VARBINARY(self.impl.length))
+        return dialect.type_descriptor(self.impl)
+    def process_bind_param(self, value, dialect):
+        if value is not None and not isinstance(value, bytes):
+            value = value.encode('latin-1')
+        return value
+    def process_result_value(self, value, dialect):
+        if value is not None and not isinstance(value, str):
+            value = bytes(value).decode('latin-1')
+        return value
+
+
+# `MapperExtension` is deprecated since SQLAlchemy 0.7 in favour
+# of mapper events and is gone in newer versions.
+_MapperExtension = getattr(sqlalchemy.orm.interfaces, 'MapperExtension',
+                           object)
 
-class MPMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
+class MPMapperExtension(_MapperExtension):
     """
     An extension to node class' mapper.
 
@@ -494,15 +1567,47 @@ class MPMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
         super(MPMapperExtension, self).__init__()
         self._mp_opts = opts
 
+    def register(self, mapper):
+        """
+        Attach the extension to ``mapper`` (or mapped class) which
+        is already set up. With SQLAlchemy 0.7+ mapper events are used,
+        with older versions the extension gets appended to mapper's
+        extensions list.
+
+        .. versionadded:: 0.7
+        """
+        if isinstance(mapper, type):
+            mapper = class_mapper(mapper)
+        if event is None:
+            # SQLAlchemy < 0.7
+            mapper.extension.append(self)
+        else:
+            event.listen(mapper, 'before_insert', self.before_insert,
+                         propagate=True)
+            event.listen(mapper, 'after_insert', self.after_insert,
+                         propagate=True)
+            event.listen(mapper, 'after_update', self.after_update,
+                         propagate=True)
+            event.listen(mapper, 'after_delete', self.after_delete,
+                         propagate=True)
+
     def before_insert(self, mapper, connection, instance):
         """
-        Creates an :class:`_InsertionsParamsSelector` instance and
-        sets values of tree_id, depth and path fields to it.
+        Calculates values of tree_id, depth and path fields of a new
+        node and sets them to the instance, so they get inserted as
+        ordinary parameters.
         """
         opts = self._mp_opts
-        parent = getattr(instance, opts.parent_id_field.name)
-        tree_id = depth = path = _InsertionsParamsSelector(
-            opts, sqlalchemy.orm.session.object_session(instance), parent
+        session = sqlalchemy.orm.session.object_session(instance)
+        # values left from a flush that failed must not be used
+        transaction, pending = opts._pending_insertions.get(session,
+                                                            (None, None))
+        if transaction is None or transaction() is not session.transaction:
+            pending = {}
+            opts._pending_insertions[session] = \
+                    (weakref.ref(session.transaction), pending)
+        tree_id, path, depth = opts.insertion_params(
+            connection, getattr(instance, opts.parent_id_field.name), pending
         )
         setattr(instance, opts.tree_id_field.name, tree_id)
         setattr(instance, opts.path_field.name, path)
@@ -510,17 +1615,54 @@ class MPMapperExtension(sqlalchemy.orm.interfaces.MapperExtension):
 
     def after_insert(self, mapper, connection, instance):
         """
-        Replaces :class:`_InsertionsParamsSelector` instance (which
-        is remains after flush) with actual values of tree_id, depth
-        and path fields.
+        Invalidates cached results and tree version of a tree
+        the new node was inserted in. In trees with ``node_order_by``
+        option the node is moved to its place among siblings.
         """
         opts = self._mp_opts
-        params_selector = getattr(instance, opts.path_field.name)
-        assert isinstance(params_selector, _InsertionsParamsSelector)
-        query_result = params_selector.query_result
-        setattr(instance, opts.tree_id_field.name, query_result['tree_id'])
-        setattr(instance, opts.path_field.name, query_result['path'])
-        setattr(instance, opts.depth_field.name, query_result['depth'])
+        session = sqlalchemy.orm.session.object_session(instance)
+        # by the time the first `after_insert()` is called all nodes
+        # of the flush batch are inserted, so values allocated for
+        # them are visible to further queries.
+        opts._pending_insertions.pop(session, None)
+        tree_id = getattr(instance, opts.tree_id_field.name)
+        path = getattr(instance, opts.path_field.name)
+        parent_id = getattr(instance, opts.parent_id_field.name)
+        if opts.node_order_by is not None and parent_id is not None:
+            # the node was inserted as the last child, now it goes
+            # to its place among siblings.
+            class_manager = MPClassManager(mapper.base_mapper.class_, opts)
+            node_id = getattr(instance, opts.pk_field.name)
+            class_manager._move_subtree_in_order(session, node_id,
+                                                 parent_id)
+            [[path]] = opts.execute(connection, 'path',
+                                    {'sqlamp_node_id': node_id})
+            sqlalchemy.orm.attributes.set_committed_value(
+                instance, opts.path_field.name, path
+            )
+        opts.invalidate_cache(connection, tree_id, path)
+        opts.bump_versions(connection, [tree_id])
+        opts.dispatch_event('node_inserted', session, instance,
+                            opts.subtree_range(tree_id, path))
+
+    def after_update(self, mapper, connection, instance):
+        """
+        Invalidates cached results which contain the updated node.
+        """
+        opts = self._mp_opts
+        path = getattr(instance, opts.path_field.name)
+        # the range of the node itself, paths of its descendants
+        # start with the smallest digit appended.
+        opts.invalidate_cache(connection,
+                              getattr(instance, opts.tree_id_field.name),
+                              path, path + opts.alphabet[0])
+
+    def after_delete(self, mapper, connection, instance):
+        """
+        The same as :meth:`after_update`, for a node deleted
+        from a session.
+        """
+        self.after_update(mapper, connection, instance)
 
 
 class MPClassManager(object):
@@ -550,7 +1692,7 @@ class MPClassManager(object):
         "The maximum level of nesting in this tree, readonly."
         return self._mp_opts.max_depth
 
-    def detach_subtree(self, session, node_id):
+    def detach_subtree(self, session, node_id, chunk_size=None):
         """
         Create a new distinct tree with root ``node_id``.
 
@@ -562,27 +1704,27 @@ class MPClassManager(object):
             session object for DML queries.
         :param node_id:
             primary key of to-be-new-root node.
+        :param chunk_size:
+            if given, subtrees are updated by chunks of at most that
+            many nodes, see `moving huge subtrees`_.
 
         See also general notes on `moving nodes`_.
         """
         opts = self._mp_opts
-        [[old_parent_id, old_path, old_depth, old_tree_id]] = session.execute(
-            sqlalchemy.select([opts.parent_id_field, opts.path_field,
-                               opts.depth_field, opts.tree_id_field],
-                               opts.pk_field == node_id)
+        self._lock_trees_of(session, [node_id])
+        [[old_parent_id, old_path, old_depth, old_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': node_id}
         )
         assert old_parent_id, "Node %s is already a root of own tree" % node_id
 
         # new tree will have next available tree_id
-        new_tree_id = session.execute(sqlalchemy.select([
-            sqlalchemy.func.max(opts.tree_id_field) + 1
-        ])).scalar()
+        new_tree_id = opts.execute(session, 'max_tree_id').scalar() + 1
         self._reparent(session, node_id, new_parent_id=None,
                        new_tree_id=new_tree_id, new_path='', new_depth=0,
                        old_tree_id=old_tree_id, old_path=old_path,
-                       old_depth=old_depth)
+                       old_depth=old_depth, chunk_size=chunk_size)
 
-    def delete_subtree(self, session, node_id):
+    def delete_subtree(self, session, node_id, close_gap=True):
         """
         Delete a whole tree/subtree starting from root ``node_id``.
 
@@ -590,6 +1732,12 @@ class MPClassManager(object):
             session object for DML queries.
         :param node_id:
             primary key of root of tree/subtree to be deleted.
+        :param close_gap:
+            if `False`, following siblings are not moved up. Pass parent ids
+            of deleted nodes to :meth:`compact` later to close gaps of many
+            deletions at once.
+        :returns:
+            the parent id of deleted node.
 
         This method differs from performing something like ::
 
@@ -615,15 +1763,515 @@ class MPClassManager(object):
             http://dev.mysql.com/doc/refman/5.5/en/innodb-foreign-key-constraints.html
         """
         opts = self._mp_opts
-        [[old_path, old_depth, old_tree_id]] = session.execute(
-            sqlalchemy.select([opts.path_field, opts.depth_field,
-                               opts.tree_id_field], opts.pk_field == node_id)
+        self._lock_trees_of(session, [node_id])
+        [[parent_id, old_path, old_depth, old_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': node_id}
         )
-        filter_ = opts.filter_descendants(old_tree_id, old_path, and_self=True)
-        session.execute(sqlalchemy.delete(opts.table, filter_))
-        self._pull_nodes('up', session, old_tree_id, old_path, old_depth)
+        opts.execute_in_range(session, 'delete', old_tree_id,
+                              *opts.path_range(old_path))
+        opts.invalidate_cache(session, old_tree_id, old_path)
+        opts.dispatch_event('subtree_deleted', session, node_id,
+                            opts.subtree_range(old_tree_id, old_path))
+        if close_gap:
+            self._pull_nodes('up', session, old_tree_id, old_path, old_depth)
+        opts.bump_versions(session, [old_tree_id])
+        return parent_id
+
+    def delete_subtrees(self, session, node_ids, batch_size=100):
+        """
+        Delete several trees/subtrees at once.
 
-    def move_subtree_before(self, session, node_id, anchor_id):
+        :param session:
+            session object for DML queries.
+        :param node_ids:
+            primary keys of roots of trees/subtrees to be deleted. Nodes
+            which are descendants of other ones are deleted along with them.
+        :param batch_size:
+            the number of nodes to fetch and the number of subtrees
+            to delete with one statement.
+
+        The result is the same as calling :meth:`delete_subtree` for
+        each node, but subtrees are fetched and deleted by batches
+        and children of each parent which lost some of them are renumbered
+        once.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        node_ids = list(set(node_ids))
+        def fetch_nodes():
+            nodes = []
+            for start in range(0, len(node_ids), batch_size):
+                nodes.extend(session.execute(
+                    sqlalchemy.select([opts.pk_field, opts.parent_id_field,
+                                       opts.tree_id_field, opts.path_field])
+                        .where(opts.pk_field.in_(
+                            node_ids[start:start + batch_size]
+                        ))
+                ).fetchall())
+            return nodes
+        nodes = fetch_nodes()
+        if opts.locks_table is not None:
+            # see `_lock_trees_of()`
+            locked = set()
+            while True:
+                tree_ids = set(tree_id for _, _, tree_id, _ in nodes)
+                if tree_ids.issubset(locked):
+                    break
+                opts.lock_trees(session, tree_ids - locked)
+                locked.update(tree_ids)
+                nodes = fetch_nodes()
+
+        # dropping nodes nested in other ones, they go in a row
+        # after their ancestor when sorted by paths.
+        nodes.sort(key=lambda node: (node[2], node[3]))
+        subtrees = []
+        for node in nodes:
+            if subtrees and subtrees[-1][2] == node[2] and \
+                    node[3].startswith(subtrees[-1][3]):
+                continue
+            subtrees.append(node)
+
+        for start in range(0, len(subtrees), batch_size):
+            ranges = []
+            for _, _, tree_id, path in subtrees[start:start + batch_size]:
+                from_path, to_path = opts.path_range(path)
+                range_ = (opts.tree_id_field == tree_id) & \
+                         (opts.path_field >= from_path)
+                if to_path is not None:
+                    range_ &= opts.path_field < to_path
+                ranges.append(range_)
+            session.execute(opts.table.delete()
+                                .where(sqlalchemy.or_(*ranges)))
+        for node_id, _, tree_id, path in subtrees:
+            opts.invalidate_cache(session, tree_id, path)
+            opts.dispatch_event('subtree_deleted', session, node_id,
+                                opts.subtree_range(tree_id, path))
+        parent_ids = set(parent_id for _, parent_id, _, _ in subtrees
+                         if parent_id is not None)
+        for parent_id in parent_ids:
+            self.reorder_children(session, parent_id, opts.path_field)
+        opts.bump_versions(session, [tree_id for _, _, tree_id, _ in subtrees])
+
+    def copy_subtree(self, session, node_id, new_parent_id,
+                     position='bottom'):
+        """
+        Copy tree/subtree starting from ``node_id`` to make the copy
+        a child of node with pk ``new_parent_id``.
+
+        :param session:
+            session object for DML queries.
+        :param node_id:
+            primary key of root of tree/subtree to be copied.
+        :param new_parent_id:
+            primary key of a node which should become a parent of the copy.
+        :param position:
+            either ``'top'`` or ``'bottom'``, whether the copy should become
+            the first or the last child of the new parent. In trees with
+            ``node_order_by`` option the copy is put in order instead.
+        :returns:
+            primary key of the copy of node ``node_id``.
+
+        Copies get all the columns except the primary key and the tree
+        fields from original nodes, primary keys have to be generated
+        by the database. All the nodes are copied by one
+        ``INSERT ... SELECT`` statement with paths rewritten the same way
+        as `moving nodes`_ do, then parent ids of copies are remapped
+        by one batched ``UPDATE``. SQLAlchemy older than 0.8.3 can't build
+        ``INSERT ... SELECT``, so with those versions nodes are fetched
+        and their copies are inserted by one batched statement.
+
+        .. versionadded:: 0.7
+        """
+        assert position in ('top', 'bottom'), \
+               "Unknown position: %r" % (position, )
+        opts = self._mp_opts
+        self._lock_trees_of(session, [node_id, new_parent_id])
+        [[_, parents_path, parents_depth, new_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': new_parent_id}
+        )
+        new_depth = parents_depth + 1
+        [[_, old_path, old_depth, old_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': node_id}
+        )
+        # shifting children of the new parent would change the original
+        # if it is copied into own subtree, such copy is made at
+        # the bottom and moved to the top afterwards.
+        into_itself = old_tree_id == new_tree_id and \
+                      parents_path.startswith(old_path)
+        if position == 'top' and not into_itself:
+            new_path = self._make_place(session, 'top', new_tree_id,
+                                        parents_path, new_depth)
+            # the original might have been shifted
+            [[old_path]] = opts.execute(session, 'path',
+                                        {'sqlamp_node_id': node_id})
+        else:
+            new_path = self._make_place(session, 'bottom', new_tree_id,
+                                        parents_path, new_depth)
+        copied = opts.execute_in_range(
+            session, 'copy_subtree', old_tree_id, *opts.path_range(old_path),
+            params={'sqlamp_new_parent_id': new_parent_id,
+                    'sqlamp_new_tree_id': new_tree_id,
+                    'sqlamp_depth_delta': new_depth - old_depth,
+                    'sqlamp_new_path': new_path,
+                    'sqlamp_cut_pos': len(old_path) + 1}
+        )
+        if not hasattr(opts.table.insert(), 'from_select'):
+            # SQLAlchemy < 0.8.3, see `MPOptions._build_statements()`
+            params = []
+            for row in copied.fetchall():
+                values = dict(zip(row.keys(), row))
+                depth = values.pop('sqlamp_depth')
+                path = values.pop('sqlamp_path')
+                values.update({
+                    opts.parent_id_field.key: new_parent_id,
+                    opts.tree_id_field.key: new_tree_id,
+                    opts.depth_field.key: depth + new_depth - old_depth,
+                    opts.path_field.key: new_path + path[len(old_path):]
+                })
+                params.append(values)
+            opts.execute(session, 'insert_copies', params)
+        copies = opts.execute_in_range(session, 'nodes', new_tree_id,
+                                       *opts.path_range(new_path)).fetchall()
+        node_ids = dict((path, copy_id) for copy_id, path in copies)
+        new_node_id = node_ids[new_path]
+        # parts of paths after the copy's own one are still split
+        # into steps of the original's levels.
+        def parent_id(path):
+            parents_path = opts.parent_path(old_path + path[len(new_path):])
+            return node_ids[new_path + parents_path[len(old_path):]]
+        params = [{'sqlamp_node_id': copy_id,
+                   'sqlamp_new_parent_id': parent_id(path)}
+                  for copy_id, path in copies if path != new_path]
+        if params:
+            opts.execute(session, 'reparent', params)
+            if not opts.same_steps(old_depth, new_depth):
+                self._do_rebuild_subtree(session, new_node_id, new_path,
+                                         new_depth, new_tree_id,
+                                         opts.path_field)
+        opts.invalidate_cache(session, new_tree_id, new_path)
+        opts.dispatch_event('subtree_copied', session, node_id, new_node_id,
+                            opts.subtree_range(new_tree_id, new_path))
+        opts.bump_versions(session, [new_tree_id])
+        if opts.node_order_by is not None:
+            self._move_subtree_in_order(session, new_node_id, new_parent_id)
+        elif position == 'top' and into_itself:
+            self.move_subtree_to_top(session, new_node_id, new_parent_id)
+        return new_node_id
+
+    def merge_tree(self, session, tree_id, new_parent_id,
+                   position='bottom'):
+        """
+        Make a whole tree ``tree_id`` a subtree of node ``new_parent_id``
+        from another tree.
+
+        :param session:
+            session object for DML queries.
+        :param tree_id:
+            id of the tree to merge.
+        :param new_parent_id:
+            primary key of a node which should become a parent of the tree's
+            root node.
+        :param position:
+            see :meth:`copy_subtree`.
+        :raises MovingToDescendantError:
+            if the new parent belongs to the tree ``tree_id``.
+        :raises sqlalchemy.orm.exc.NoResultFound:
+            if there is no tree ``tree_id``.
+
+        The result is the same as of moving the root node with
+        :meth:`move_subtree_to_top` or :meth:`move_subtree_to_bottom`,
+        but all the nodes are updated by one statement over the whole tree,
+        without looking for them by the root's path. The tree id becomes
+        unused, so it is taken by the next new tree if it was the greatest
+        one.
+
+        .. versionadded:: 0.7
+        """
+        assert position in ('top', 'bottom'), \
+               "Unknown position: %r" % (position, )
+        opts = self._mp_opts
+        self._lock_trees_of(session, [new_parent_id], [tree_id])
+        [[_, parents_path, parents_depth, new_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': new_parent_id}
+        )
+        if new_tree_id == tree_id:
+            raise MovingToDescendantError()
+        root_id = session.execute(
+            sqlalchemy.select([opts.pk_field])
+                .where(opts.tree_id_field == tree_id)
+                .where(opts.path_field == '')
+        ).scalar()
+        if root_id is None:
+            raise sqlalchemy.orm.exc.NoResultFound(
+                "Tree %r has no root node" % (tree_id, )
+            )
+        new_depth = parents_depth + 1
+        new_path = self._make_place(session, position, new_tree_id,
+                                    parents_path, new_depth)
+        opts.execute(session, 'reparent',
+                     {'sqlamp_node_id': root_id,
+                      'sqlamp_new_parent_id': new_parent_id})
+        self._update_subtree(session, root_id, new_tree_id, new_path,
+                             new_depth, tree_id, '', 0)
+        opts.dispatch_event('subtree_moved', session, root_id,
+                            opts.subtree_range(tree_id, ''),
+                            opts.subtree_range(new_tree_id, new_path))
+        opts.bump_versions(session, [tree_id, new_tree_id])
+        if opts.node_order_by is not None:
+            self._move_subtree_in_order(session, root_id, new_parent_id)
+
+    def export_tree(self, session, tree_id, fileobj, chunk_size=10000):
+        """
+        Write all nodes of tree ``tree_id`` to a file.
+
+        :param session:
+            session object for queries.
+        :param tree_id:
+            id of the tree to export.
+        :param fileobj:
+            a file-like object open for writing text.
+        :param chunk_size:
+            the number of rows to fetch in one query.
+
+        The format is JSON lines: the first line is a header object with
+        a list of column names (``columns``), lengths of steps (``steplen``,
+        always a list) and the ``alphabet`` of paths, each of the following
+        lines is a list of values of one node, nodes go in order of their
+        paths. Primary key, parent id and tree id are not exported, paths
+        and depths are. Values of all the other columns have to be
+        serializable to JSON. See :meth:`import_tree`.
+
+        .. versionadded:: 0.7
+        """
+        if json is None:
+            raise ImportError("export_tree() requires json or simplejson")
+        opts = self._mp_opts
+        skipped = set([opts.pk_field, opts.parent_id_field,
+                       opts.tree_id_field])
+        columns = [column for column in opts.table.columns
+                   if column not in skipped]
+        keys = [column.key for column in columns]
+        fileobj.write(json.dumps({'columns': keys,
+                                  'steplen': list(opts.steplens),
+                                  'alphabet': opts.alphabet}) + '\n')
+        path_index = keys.index(opts.path_field.key)
+        query = sqlalchemy.select(columns) \
+                    .where(opts.tree_id_field == tree_id) \
+                    .order_by(opts.path_field) \
+                    .limit(chunk_size)
+        rows = session.execute(query).fetchall()
+        while rows:
+            for row in rows:
+                fileobj.write(json.dumps(list(row)) + '\n')
+            rows = session.execute(query.where(
+                opts.path_field > rows[-1][path_index]
+            )).fetchall()
+
+    def import_tree(self, session, fileobj, chunk_size=10000):
+        """
+        Load a tree written by :meth:`export_tree` as a new tree.
+
+        :param session:
+            session object for DML queries.
+        :param fileobj:
+            a file-like object (or any iterable of lines) with the tree.
+        :param chunk_size:
+            the number of nodes to insert or update by one batched
+            statement.
+        :returns:
+            id of the new tree.
+        :raises ValueError:
+            if the tree was exported with other ``steplen`` or ``alphabet``
+            options, its paths would be meaningless in this table.
+
+        Nodes are inserted with their paths and depths as they are, so none
+        of them is calculated. Then parent ids are set by paths. Primary keys
+        have to be generated by the database. The mapper extension is not
+        involved, so the whole tree is reported by one
+        :meth:`~MPEvents.subtree_created` event.
+
+        .. versionadded:: 0.7
+        """
+        if json is None:
+            raise ImportError("import_tree() requires json or simplejson")
+        opts = self._mp_opts
+        lines = iter(fileobj)
+        header = json.loads(next(lines))
+        if tuple(header['steplen']) != opts.steplens:
+            raise ValueError("The tree was exported with steplen %r, "
+                             "can't import it with steplen %r"
+                             % (header['steplen'], list(opts.steplens)))
+        if header['alphabet'] != opts.alphabet:
+            raise ValueError("The tree was exported with alphabet %r, "
+                             "can't import it with alphabet %r"
+                             % (header['alphabet'], opts.alphabet))
+        keys = header['columns']
+        tree_id = (opts.execute(session, 'max_tree_id').scalar() or 0) + 1
+        insert = opts.table.insert()
+        params = []
+        for line in lines:
+            values = dict(zip(keys, json.loads(line)))
+            values[opts.tree_id_field.key] = tree_id
+            params.append(values)
+            if len(params) == chunk_size:
+                session.execute(insert, params)
+                params = []
+        if params:
+            session.execute(insert, params)
+
+        # nodes come in order of their paths, so the parent of each
+        # one is in the chain of its ancestors.
+        ancestors = []
+        query = sqlalchemy.select([opts.pk_field, opts.path_field]) \
+                    .where(opts.tree_id_field == tree_id) \
+                    .order_by(opts.path_field) \
+                    .limit(chunk_size)
+        rows = session.execute(query).fetchall()
+        root_id = None
+        if rows:
+            root_id = rows[0][0]
+        while rows:
+            params = []
+            for node_id, path in rows:
+                while ancestors and not path.startswith(ancestors[-1][0]):
+                    ancestors.pop()
+                if ancestors:
+                    params.append({'sqlamp_node_id': node_id,
+                                   'sqlamp_new_parent_id': ancestors[-1][1]})
+                ancestors.append((path, node_id))
+            if params:
+                opts.execute(session, 'reparent', params)
+            rows = session.execute(query.where(
+                opts.path_field > rows[-1][1]
+            )).fetchall()
+        opts.bump_versions(session, [tree_id])
+        if root_id is not None:
+            opts.dispatch_event('subtree_created', session, root_id,
+                                opts.subtree_range(tree_id, ''))
+        return tree_id
+
+    def create_tree(self, session, nested_data, parent_id=None,
+                    children_key='children'):
+        """
+        Insert a whole tree/subtree described by nested dictionaries.
+
+        :param session:
+            session object for DML queries.
+        :param nested_data:
+            a dictionary of column values (by column keys) of the root node.
+            Its ``children_key`` item, if any, is a list of such
+            dictionaries for children of the node, and so on.
+        :param parent_id:
+            primary key of a node which should become a parent of the root
+            node (it becomes the last child, or is put in order in trees
+            with ``node_order_by`` option). With default value ``None``
+            a new tree is created.
+        :param children_key:
+            the name of an item holding children.
+        :returns:
+            primary key of the root node.
+        :raises TooManyChildrenError:
+            if some node has more than :attr:`max_children` children.
+        :raises PathTooDeepError:
+            if the tree can not fit in :attr:`max_depth` levels.
+
+        Paths are assigned in memory, then all the nodes are inserted
+        by one batched ``INSERT`` (one per a set of given columns),
+        and parent ids are set by one batched ``UPDATE``. Primary keys
+        have to be generated by the database. Like with :meth:`import_tree`
+        the mapper extension is not involved, the new nodes are reported
+        by one :meth:`~MPEvents.subtree_created` event. In trees with
+        ``node_order_by`` option children are sorted in memory, so
+        the values of ordering columns have to be given.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        if parent_id is None:
+            tree_id = (opts.execute(session, 'max_tree_id').scalar() or 0) + 1
+            root_path, root_depth = '', 0
+        else:
+            self._lock_trees_of(session, [parent_id])
+            [[_, parents_path, parents_depth, tree_id]] = opts.execute(
+                session, 'node', {'sqlamp_node_id': parent_id}
+            )
+            root_depth = parents_depth + 1
+            root_path = self._make_place(session, 'bottom', tree_id,
+                                         parents_path, root_depth)
+        if opts.node_order_by is None:
+            order_key = None
+        else:
+            keys = [column.key for column in opts.node_order_by]
+            # NULLs go last as in `next_in_order` statement
+            order_key = lambda data: [(data.get(key) is None,
+                                       data.get(key)) for key in keys]
+
+        groups = {}
+        stack = [(nested_data, root_path, root_depth)]
+        while stack:
+            data, path, depth = stack.pop()
+            if len(path) > opts.pathlen:
+                raise PathTooDeepError()
+            values = dict((key, value) for key, value in data.items()
+                          if key != children_key)
+            values[opts.tree_id_field.key] = tree_id
+            values[opts.path_field.key] = path
+            values[opts.depth_field.key] = depth
+            if depth == root_depth:
+                values[opts.parent_id_field.key] = parent_id
+            groups.setdefault(frozenset(values), []).append(values)
+            children = data.get(children_key) or []
+            if order_key is not None:
+                children = sorted(children, key=order_key)
+            for index, child in enumerate(children):
+                stack.append((child, opts.child_path(path, index),
+                              depth + 1))
+        insert = opts.table.insert()
+        for params in groups.values():
+            session.execute(insert, params)
+
+        nodes = opts.execute_in_range(session, 'nodes', tree_id,
+                                      *opts.path_range(root_path)).fetchall()
+        node_ids = dict((path, node_id) for node_id, path in nodes)
+        params = [{'sqlamp_node_id': node_id,
+                   'sqlamp_new_parent_id': node_ids[opts.parent_path(path)]}
+                  for node_id, path in nodes if path != root_path]
+        if params:
+            opts.execute(session, 'reparent', params)
+        root_id = node_ids[root_path]
+        opts.invalidate_cache(session, tree_id, root_path)
+        opts.bump_versions(session, [tree_id])
+        opts.dispatch_event('subtree_created', session, root_id,
+                            opts.subtree_range(tree_id, root_path))
+        if opts.node_order_by is not None and parent_id is not None:
+            self._move_subtree_in_order(session, root_id, parent_id)
+        return root_id
+
+    def _make_place(self, session, position, tree_id, parents_path, depth):
+        """
+        Get a path for a new child of the node with path ``parents_path``
+        in tree ``tree_id``. For ``'top'`` position all the children are
+        shifted down, ``'bottom'`` position is after the last child.
+        """
+        opts = self._mp_opts
+        first_path = opts.child_path(parents_path)
+        if position == 'top':
+            self._pull_nodes('down', session, tree_id, first_path, depth)
+            return first_path
+        last_child_path = opts.execute_in_range(
+            session, 'last_in_level', tree_id, *opts.path_range(parents_path),
+            params={'sqlamp_depth': depth}
+        ).scalar()
+        if last_child_path is None:
+            return first_path
+        try:
+            return opts.next_path(last_child_path)
+        except PathOverflowError:
+            raise TooManyChildrenError()
+
+    def move_subtree_before(self, session, node_id, anchor_id,
+                            chunk_size=None):
         """
         Move tree/subtree starting from ``node_id`` to make it preceding
         sibling of node with pk ``anchor_id``. Anchor node is expected not
@@ -636,20 +2284,25 @@ class MPClassManager(object):
         :param anchor_id:
             primary key of a node which target node should become previous
             sibling to.
+        :param chunk_size:
+            see :meth:`detach_subtree`.
 
         See also general notes on `moving nodes`_.
         """
-        self._move_subtree_by_sibling('before', session, node_id, anchor_id)
+        self._move_subtree_by_sibling('before', session, node_id, anchor_id,
+                                      chunk_size)
 
-    def move_subtree_after(self, session, node_id, anchor_id):
+    def move_subtree_after(self, session, node_id, anchor_id,
+                           chunk_size=None):
         """
         The same as :meth:`move_subtree_before` but makes target tree/subtree
         root the immediately following sibling of anchor node.
         """
-        self._move_subtree_by_sibling('after', session, node_id, anchor_id)
+        self._move_subtree_by_sibling('after', session, node_id, anchor_id,
+                                      chunk_size)
 
     def _move_subtree_by_sibling(self, before_or_after, session,
-                                 node_id, anchor_id):
+                                 node_id, anchor_id, chunk_size):
         """
         The common code for :meth:`move_subtree_before`
         and :meth:`move_subtree_after`.
@@ -668,25 +2321,27 @@ class MPClassManager(object):
                "Use detach_subtree() for creating a new distinct tree"
 
         if before_or_after == 'after':
-            anchors_path = inc_path(anchors_path, opts.steplen)
+            anchors_path = opts.next_path(anchors_path)
         else:
             assert before_or_after == 'before'
 
         # Freeing a place for target node.
-        self._pull_nodes('down', session, new_tree_id, anchors_path, new_depth)
+        self._pull_nodes('down', session, new_tree_id, anchors_path, new_depth,
+                         chunk_size)
         # Target node could be thw following sibling or to be the descendant
         # of one of following siblings. In that case its path has been updated
         # on the previous step, so we need to fetch it again. If the target
         # node belongs to different tree or to one of previous siblings,
         # this query is redundant, but harmless.
-        [[old_path]] = session.execute(
-            sqlalchemy.select([opts.path_field], opts.pk_field == node_id)
-        )
+        [[old_path]] = opts.execute(session, 'path',
+                                    {'sqlamp_node_id': node_id})
         new_path = anchors_path
         self._reparent(session, node_id, new_parent_id, new_tree_id, new_path,
-                       new_depth, old_tree_id, old_path, old_depth)
+                       new_depth, old_tree_id, old_path, old_depth,
+                       chunk_size)
 
-    def move_subtree_to_top(self, session, node_id, new_parent_id):
+    def move_subtree_to_top(self, session, node_id, new_parent_id,
+                            chunk_size=None):
         """
         Move tree/subtree starting from ``node_id`` to make it the first child
         of node with pk ``anchor_id``.
@@ -698,29 +2353,53 @@ class MPClassManager(object):
         :param anchor_id:
             primary key of a node which should become a new parent
             for target node.
+        :param chunk_size:
+            see :meth:`detach_subtree`.
+
+        In trees with ``node_order_by`` option the node is placed among
+        new siblings according to that order instead, see `ordered trees`_.
 
         See also general notes on `moving nodes`_.
         """
         opts = self._mp_opts
+        if opts.node_order_by is not None:
+            self._move_subtree_in_order(session, node_id, new_parent_id,
+                                        chunk_size)
+            return
         old_path, old_depth, old_tree_id, \
             parents_parent_id, parents_path, parents_depth, new_tree_id \
             = self._prepare_to_move_subtree(session, node_id, new_parent_id)
         new_depth = parents_depth + 1
 
-        new_path = parents_path + ALPHABET[0] * opts.steplen
+        new_path = opts.child_path(parents_path)
         # Pulling down all new parent's children.
-        self._pull_nodes('down', session, new_tree_id, new_path, new_depth)
+        self._pull_nodes('down', session, new_tree_id, new_path, new_depth,
+                         chunk_size)
         # Updating target node's path (see _move_subtree_by_sibling).
-        [[old_path]] = session.execute(
-            sqlalchemy.select([opts.path_field], opts.pk_field == node_id)
-        )
+        [[old_path]] = opts.execute(session, 'path',
+                                    {'sqlamp_node_id': node_id})
         self._reparent(session, node_id, new_parent_id, new_tree_id, new_path,
-                       new_depth, old_tree_id, old_path, old_depth)
+                       new_depth, old_tree_id, old_path, old_depth,
+                       chunk_size)
 
-    def move_subtree_to_bottom(self, session, node_id, new_parent_id):
+    def move_subtree_to_bottom(self, session, node_id, new_parent_id,
+                               chunk_size=None):
         """
         The same as :meth:`move_subtree_before` but makes target tree/subtree
-        root the last child of anchor node.
+        root the last child of anchor node (or puts it in order in trees
+        with ``node_order_by`` option).
+        """
+        if self._mp_opts.node_order_by is not None:
+            self._move_subtree_in_order(session, node_id, new_parent_id,
+                                        chunk_size)
+        else:
+            self._move_subtree_to_bottom(session, node_id, new_parent_id,
+                                         chunk_size)
+
+    def _move_subtree_to_bottom(self, session, node_id, new_parent_id,
+                                chunk_size=None):
+        """
+        The implementation of :meth:`move_subtree_to_bottom`.
         """
         opts = self._mp_opts
         old_path, old_depth, old_tree_id, \
@@ -728,33 +2407,66 @@ class MPClassManager(object):
             = self._prepare_to_move_subtree(session, node_id, new_parent_id)
         new_depth = parents_depth + 1
 
-        children_filter = opts.filter_children(new_tree_id, parents_path,
-                                               parents_depth)
-        last_child_path = session.execute(
-            sqlalchemy.select([opts.path_field], children_filter) \
-                      .order_by(opts.tree_id_field.desc(),
-                                opts.path_field.desc()) \
-                      .limit(1)
+        last_child_path = opts.execute_in_range(
+            session, 'last_in_level', new_tree_id,
+            *opts.path_range(parents_path),
+            params={'sqlamp_depth': new_depth}
         ).fetchall()
         if not last_child_path:
             # The new parent doesn't have any child nodes.
             # Target node will be the first.
-            new_path = parents_path + ALPHABET[0] * opts.steplen
+            new_path = opts.child_path(parents_path)
         else:
             # Target node path will be the next after last child.
             [[last_child_path]] = last_child_path
             try:
-                new_path = inc_path(last_child_path, opts.steplen)
+                new_path = opts.next_path(last_child_path)
             except PathOverflowError:
                 raise TooManyChildrenError()
         self._reparent(session, node_id, new_parent_id, new_tree_id, new_path,
-                       new_depth, old_tree_id, old_path, old_depth)
+                       new_depth, old_tree_id, old_path, old_depth,
+                       chunk_size)
+
+    def _move_subtree_in_order(self, session, node_id, new_parent_id,
+                               chunk_size=None):
+        """
+        Move tree/subtree starting from ``node_id`` to node ``new_parent_id``
+        right before the first child which follows it according
+        to ``node_order_by`` option, or to the bottom if there is no such
+        child. Nothing is done if the node is already the last child of
+        the new parent and has to stay so.
+        """
+        opts = self._mp_opts
+        anchor_id = opts.execute(session, 'next_in_order',
+                                 {'sqlamp_node_id': node_id,
+                                  'sqlamp_parent_id': new_parent_id}).scalar()
+        if anchor_id is not None:
+            self._move_subtree_by_sibling('before', session, node_id,
+                                          anchor_id, chunk_size)
+            return
+        [[old_parent_id, old_path, old_depth, old_tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': node_id}
+        )
+        if old_parent_id == new_parent_id:
+            [[last_child_path]] = opts.execute_in_range(
+                session, 'last_in_level', old_tree_id,
+                *opts.path_range(opts.parent_path(old_path)),
+                params={'sqlamp_depth': old_depth}
+            )
+            if last_child_path == old_path:
+                return
+        self._move_subtree_to_bottom(session, node_id, new_parent_id,
+                                     chunk_size)
 
-    def _prepare_to_move_subtree(self, session, node_id, anchor_id):
+    def _prepare_to_move_subtree(self, session, node_id, anchor_id,
+                                 lock=True):
         """
         Fetch target and anchor nodes data and check that moving operation
         is valid for that pair of nodes.
 
+        :param lock:
+            whether to lock trees of both nodes (if tree locks are enabled).
+
         :raises MovingToDescendantError:
             If anchor node is descendant of target node.
         :returns:
@@ -762,64 +2474,557 @@ class MPClassManager(object):
             and parent_id, path, depth, tree_id of anchor node.
         """
         opts = self._mp_opts
-        columns = [opts.parent_id_field, opts.path_field,
-                   opts.depth_field, opts.tree_id_field]
-        node_select = sqlalchemy.select(columns, opts.pk_field == node_id)
-        anchor_select = sqlalchemy.select(columns, opts.pk_field == anchor_id)
+        if lock:
+            self._lock_trees_of(session, [node_id, anchor_id])
         [[old_parent_id, old_path, old_depth, old_tree_id],
          [anchor_parent_id, anchor_path, anchor_depth, anchor_tree_id]] \
-                 = session.execute(node_select.union_all(anchor_select))
+                 = opts.execute(session, 'node_and_anchor',
+                                {'sqlamp_node_id': node_id,
+                                 'sqlamp_anchor_id': anchor_id})
         if old_tree_id == anchor_tree_id and anchor_path.startswith(old_path):
             raise MovingToDescendantError()
         return old_path, old_depth, old_tree_id, \
                anchor_parent_id, anchor_path, anchor_depth, anchor_tree_id
 
+    def apply_moves(self, session, operations):
+        """
+        Perform several moves at once.
+
+        :param session:
+            session object for DML queries.
+        :param operations:
+            sequence of tuples ``(operation, node_id, anchor_id)``, where
+            ``operation`` is a name of one of ``move_subtree_*`` methods
+            and the rest are the arguments for it.
+
+        The result is the same as calling the methods one by one, but the
+        final order of children of every affected parent is calculated
+        in memory first and then only nodes which change the position
+        among siblings or the parent are written, each of them once
+        (together with their subtrees). So the cost is proportional
+        to the number of nodes which actually change position, not to the
+        number of operations.
+
+        Listeners of ``subtree_moved`` event are called for each of those
+        nodes, ``siblings_shifted`` event is not fired.
+
+        In trees with ``node_order_by`` option ``move_subtree_to_top``
+        and ``move_subtree_to_bottom`` operations put nodes in order
+        among their new siblings, as the methods themselves do. Values
+        of ordering columns of the siblings are queried for that.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        node_ids = []
+        for operation, node_id, anchor_id in operations:
+            node_ids.extend([node_id, anchor_id])
+        self._lock_trees_of(session, node_ids)
+
+        # current state of loaded nodes: (parent_id, path, depth, tree_id)
+        nodes = {}
+        # final parents of moved nodes
+        parents = {}
+        # final order of children of affected parents
+        children = {}
+
+        def node(node_id):
+            if node_id not in nodes:
+                [row] = opts.execute(session, 'node',
+                                     {'sqlamp_node_id': node_id}).fetchall()
+                nodes[node_id] = tuple(row)
+            return nodes[node_id]
+
+        def parent_of(node_id):
+            if node_id in parents:
+                return parents[node_id]
+            return node(node_id)[0]
+
+        def children_of(parent_id):
+            if parent_id not in children:
+                children[parent_id] = []
+                for row in opts.execute(session, 'children',
+                                        {'sqlamp_parent_id': parent_id}):
+                    nodes[row[0]] = tuple(row[1:])
+                    children[parent_id].append(row[0])
+            return children[parent_id]
+
+        # values of `node_order_by` columns, NULLs go last
+        order_keys = {}
+        def load_order_keys(node_ids):
+            missing = [node_id for node_id in node_ids
+                       if node_id not in order_keys]
+            # some databases limit the number of bound parameters
+            for start in range(0, len(missing), 500):
+                rows = session.execute(
+                    sqlalchemy.select([opts.pk_field] + opts.node_order_by)
+                        .where(opts.pk_field.in_(missing[start:start + 500]))
+                )
+                for row in rows.fetchall():
+                    order_keys[row[0]] = [(value is None, value)
+                                          for value in row[1:]]
+
+        for operation, node_id, anchor_id in operations:
+            ancestor_id = anchor_id
+            while ancestor_id is not None:
+                if ancestor_id == node_id:
+                    raise MovingToDescendantError()
+                ancestor_id = parent_of(ancestor_id)
+            if operation in ('move_subtree_before', 'move_subtree_after'):
+                new_parent_id = parent_of(anchor_id)
+                assert new_parent_id is not None, \
+                       "Use detach_subtree() for creating a new distinct tree"
+            else:
+                assert operation in ('move_subtree_to_top',
+                                     'move_subtree_to_bottom'), \
+                       "Unknown operation: %r" % (operation, )
+                new_parent_id = anchor_id
+
+            old_parent_id = parent_of(node_id)
+            if old_parent_id is not None:
+                children_of(old_parent_id).remove(node_id)
+            siblings = children_of(new_parent_id)
+            if operation == 'move_subtree_before':
+                index = siblings.index(anchor_id)
+            elif operation == 'move_subtree_after':
+                index = siblings.index(anchor_id) + 1
+            elif opts.node_order_by is not None:
+                # right before the first sibling which follows the node
+                load_order_keys(siblings + [node_id])
+                key = order_keys[node_id]
+                index = len(siblings)
+                for sibling_index, sibling_id in enumerate(siblings):
+                    if order_keys[sibling_id] > key:
+                        index = sibling_index
+                        break
+            elif operation == 'move_subtree_to_top':
+                index = 0
+            else:
+                index = len(siblings)
+            siblings.insert(index, node_id)
+            parents[node_id] = new_parent_id
+
+        # final positions: (tree_id, path, depth)
+        positions = {}
+        def position(node_id):
+            if node_id not in positions:
+                parent_id = parent_of(node_id)
+                if parent_id is None:
+                    positions[node_id] = (node(node_id)[3], '', 0)
+                else:
+                    tree_id, path, depth = position(parent_id)
+                    if parent_id in children:
+                        index = children[parent_id].index(node_id)
+                    else:
+                        index = opts.child_index(node(node_id)[1])
+                    path = opts.child_path(path, index)
+                    positions[node_id] = (tree_id, path, depth + 1)
+            return positions[node_id]
+
+        relocations = []
+        for parent_id, siblings in children.items():
+            for index, node_id in enumerate(siblings):
+                old_parent_id, old_path, old_depth, old_tree_id = node(node_id)
+                if old_parent_id == parent_id and \
+                        opts.child_index(old_path) == index:
+                    # moves along with its parent (if at all)
+                    continue
+                new_tree_id, new_path, new_depth = position(node_id)
+                relocations.append((node_id, old_parent_id, parent_id,
+                                    old_tree_id, old_path, old_depth,
+                                    new_tree_id, new_path, new_depth))
+        self._relocate(session, relocations)
+
+    def reorder_children(self, session, parent_id, order_by):
+        """
+        Sort children of a node.
+
+        :param session:
+            session object for DML queries.
+        :param parent_id:
+            primary key of a node whose children should be reordered.
+        :param order_by:
+            an "order by clause" for sorting children, the same as
+            for :meth:`rebuild_all_trees`.
+
+        The new order is queried once and only subtrees of children which
+        change their position get updated, the rest of the tree (including
+        the parent node itself) is left untouched.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        self._lock_trees_of(session, [parent_id])
+        current = opts.execute(session, 'children',
+                               {'sqlamp_parent_id': parent_id}).fetchall()
+        if not current:
+            return
+        rows = dict((row[0], tuple(row[1:])) for row in current)
+        ordered = session.execute(
+            sqlalchemy.select([opts.pk_field])
+                .where(opts.parent_id_field == parent_id)
+                .order_by(order_by)
+        )
+        relocations = []
+        for index, (node_id, ) in enumerate(ordered.fetchall()):
+            _, old_path, depth, tree_id = rows[node_id]
+            new_path = opts.child_path(opts.parent_path(old_path), index)
+            if new_path != old_path:
+                relocations.append((node_id, parent_id, parent_id, tree_id,
+                                    old_path, depth, tree_id, new_path, depth))
+        self._relocate(session, relocations)
+
+    def compact(self, session, after=None, batch_size=100, pause=None,
+                parent_ids=None):
+        """
+        Renumber children of nodes which have gaps among them, for example
+        after deleting nodes bypassing :meth:`delete_subtree` or with
+        ``close_gap=False``.
+
+        :param session:
+            session object for DML queries. The transaction gets committed
+            after each batch.
+        :param after:
+            a checkpoint yielded before, the job continues from the next
+            parent node.
+        :param batch_size:
+            the number of parent nodes checked in one transaction.
+        :param pause:
+            number of seconds to sleep between transactions.
+        :param parent_ids:
+            if given, only these parent nodes are checked instead of all
+            of them.
+        :returns:
+            an iterator which does the job and yields a checkpoint (the last
+            checked parent id) after committing each batch. The job can be
+            stopped at any time and resumed later from the last checkpoint.
+
+        Parent nodes are walked in order of their primary keys and children
+        of each sparse one are renumbered by :meth:`reorder_children`
+        keeping their order.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        query = sqlalchemy.select([opts.parent_id_field,
+                                   sqlalchemy.func.count(opts.pk_field),
+                                   sqlalchemy.func.max(opts.path_field)]) \
+                    .where(opts.parent_id_field != None) \
+                    .group_by(opts.parent_id_field) \
+                    .order_by(opts.parent_id_field) \
+                    .limit(batch_size)
+        if parent_ids is not None:
+            parent_ids = sorted(set(parent_id for parent_id in parent_ids
+                                    if parent_id is not None))
+        while True:
+            batch = query
+            if parent_ids is not None:
+                checked = [parent_id for parent_id in parent_ids
+                           if after is None or parent_id > after]
+                checked = checked[:batch_size]
+                batch = batch.where(opts.parent_id_field.in_(checked))
+            elif after is not None:
+                batch = batch.where(opts.parent_id_field > after)
+            batch = session.execute(batch).fetchall()
+            if parent_ids is None:
+                checked = [parent_id for parent_id, _, _ in batch]
+            if not checked:
+                return
+            for parent_id, count, last_child_path in batch:
+                if opts.child_index(last_child_path) + 1 != count:
+                    self.reorder_children(session, parent_id,
+                                          opts.path_field)
+            session.commit()
+            after = checked[-1]
+            yield after
+            if len(checked) < batch_size:
+                return
+            if pause:
+                time.sleep(pause)
+
+    def _relocate(self, session, relocations):
+        """
+        Move several subtrees to new places at once.
+
+        :param relocations:
+            list of tuples ``(node_id, old_parent_id, new_parent_id,
+            old_tree_id, old_path, old_depth, new_tree_id, new_path,
+            new_depth)``. New places
+            have to be free when all the subtrees are moved out, while
+            they may be taken by other relocated subtrees at the moment.
+            Subtrees may be nested, in that case paths of inner subtrees
+            are ones before any relocation and their new places are not
+            affected by relocations of outer ones.
+
+        All the subtrees are moved to distinct staging trees first (the
+        deepest ones first, so outer subtrees don't take inner ones with
+        them) and then to their new places.
+        """
+        if not relocations:
+            return
+        opts = self._mp_opts
+        # new tree ids may be not taken yet
+        staging_tree_id = max(
+            [opts.execute(session, 'max_tree_id').scalar()] +
+            [relocation[6] for relocation in relocations]
+        )
+        staged = []
+        relocations = list(relocations)
+        relocations.sort(key=lambda relocation: -relocation[5])
+        for node_id, old_parent_id, new_parent_id, old_tree_id, old_path, \
+                old_depth, _, _, _ in relocations:
+            if new_parent_id != old_parent_id:
+                opts.execute(session, 'reparent',
+                             {'sqlamp_node_id': node_id,
+                              'sqlamp_new_parent_id': new_parent_id})
+            staging_tree_id += 1
+            # the level is kept, so steps of paths don't change twice
+            self._update_subtree(session, node_id, staging_tree_id, old_path,
+                                 old_depth, old_tree_id, old_path, old_depth)
+            staged.append(staging_tree_id)
+        tree_ids = []
+        for relocation, staging_tree_id in zip(relocations, staged):
+            node_id, _, _, old_tree_id, old_path, old_depth, \
+                    new_tree_id, new_path, new_depth = relocation
+            self._update_subtree(session, node_id, new_tree_id, new_path,
+                                 new_depth, staging_tree_id, old_path,
+                                 old_depth)
+            opts.dispatch_event('subtree_moved', session, node_id,
+                                opts.subtree_range(old_tree_id, old_path),
+                                opts.subtree_range(new_tree_id, new_path))
+            tree_ids.extend([old_tree_id, new_tree_id])
+        opts.bump_versions(session, tree_ids)
+
+    def estimate(self, session, operation, node_id, anchor_id=None,
+                 chunk_size=None):
+        """
+        Estimate how many rows and statements a structural operation
+        would take, without modifying any data.
+
+        :param session:
+            session object for queries.
+        :param operation:
+            name of the method to estimate: ``'detach_subtree'``,
+            ``'delete_subtree'`` or one of ``'move_subtree_*'``.
+        :param node_id:
+            primary key of root of tree/subtree to be moved or deleted.
+        :param anchor_id:
+            ``anchor_id`` or ``new_parent_id`` argument of move methods.
+        :param chunk_size:
+            ``chunk_size`` argument of move methods, ignored for
+            ``'delete_subtree'``.
+        :returns:
+            :class:`OperationCost` instance.
+        :raises MovingToDescendantError:
+            if the operation is not valid for this pair of nodes.
+
+        Numbers are calculated from current state of the tree. If target
+        and anchor nodes are siblings, a few of them may be shifted twice
+        in fact. Statements updating tree versions and locks (one per tree)
+        are counted too, the first version or lock of a tree may take one
+        more statement on databases without upserts.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        shifted = []
+        if operation in ('detach_subtree', 'delete_subtree'):
+            [[_, old_path, old_depth, old_tree_id]] = opts.execute(
+                session, 'node', {'sqlamp_node_id': node_id}
+            )
+            locked_trees = set([old_tree_id])
+            if operation == 'delete_subtree':
+                # deleted subtrees are never updated by chunks
+                chunk_size = None
+                changed_trees = 1
+            else:
+                # the old tree and the new one, which is not locked
+                changed_trees = 2
+        else:
+            old_path, old_depth, old_tree_id, \
+                _, anchor_path, anchor_depth, anchor_tree_id \
+                = self._prepare_to_move_subtree(session, node_id, anchor_id,
+                                                lock=False)
+            # siblings pulled down to free a place for target node
+            if operation == 'move_subtree_before':
+                shifted += self._subtree_sizes(session, anchor_tree_id,
+                                               anchor_path, anchor_depth)
+            elif operation == 'move_subtree_after':
+                shifted += self._subtree_sizes(
+                    session, anchor_tree_id,
+                    opts.next_path(anchor_path), anchor_depth
+                )
+            elif operation == 'move_subtree_to_top':
+                shifted += self._subtree_sizes(
+                    session, anchor_tree_id,
+                    opts.child_path(anchor_path), anchor_depth + 1
+                )
+            else:
+                assert operation == 'move_subtree_to_bottom', \
+                       "Unknown operation: %r" % (operation, )
+            locked_trees = set([old_tree_id, anchor_tree_id])
+            changed_trees = len(locked_trees)
+        # siblings pulled up to fill a gap
+        _, next_sibling_path = opts.path_range(old_path)
+        if next_sibling_path is not None:
+            shifted += self._subtree_sizes(session, old_tree_id,
+                                           next_sibling_path, old_depth)
+        subtree_size = 0
+        for [_, size] in opts.execute_in_range(
+                session, 'subtree_sizes', old_tree_id,
+                *opts.path_range(old_path),
+                params={'sqlamp_path_len': len(old_path)}):
+            subtree_size += size
+
+        def updates(size):
+            if chunk_size is None:
+                return 1
+            return max(1, (size + chunk_size - 1) // chunk_size)
+        statements = 0
+        for size in shifted:
+            statements += updates(size)
+        if operation == 'delete_subtree':
+            statements += 1
+        else:
+            # updating parent id and then the subtree
+            statements += 1 + updates(subtree_size)
+        if opts.versions_table is not None:
+            statements += changed_trees
+        if opts.locks_table is not None and \
+                session.connection(clause=opts.table).dialect.name \
+                != 'postgresql':
+            # advisory locks of PostgreSQL don't take DML
+            statements += len(locked_trees)
+        rows = subtree_size
+        for size in shifted:
+            rows += size
+        return OperationCost(subtree_size, shifted, rows, statements)
+
+    def _subtree_sizes(self, session, tree_id, from_path, depth):
+        """
+        Get the list of sizes of subtrees starting from node with path
+        ``from_path`` and following siblings of it, which are the nodes
+        shifted by :meth:`_pull_nodes`.
+        """
+        if depth == 0:
+            # roots have no siblings
+            return []
+        opts = self._mp_opts
+        _, end_path = opts.path_range(opts.parent_path(from_path))
+        return [size for [_, size] in opts.execute_in_range(
+            session, 'subtree_sizes', tree_id, from_path, end_path,
+            params={'sqlamp_path_len': len(from_path)}
+        )]
+
+    def _lock_trees_of(self, session, node_ids, tree_ids=()):
+        """
+        Lock trees which nodes ``node_ids`` belong to and trees
+        ``tree_ids``, if tree locks are enabled (see
+        :meth:`MPOptions.lock_trees`). All the trees are locked at once,
+        in order of their ids. While waiting for the locks nodes may be
+        moved to other trees by concurrent transactions, so the trees are
+        looked up again after locking and the new ones are locked too.
+        Only in that case locks are taken out of order, and a deadlock
+        that may result from that is resolved by the database.
+        """
+        opts = self._mp_opts
+        if opts.locks_table is None:
+            return
+        locked = set()
+        while True:
+            trees = set(tree_ids)
+            for node_id in node_ids:
+                [[_, _, _, tree_id]] = opts.execute(
+                    session, 'node', {'sqlamp_node_id': node_id}
+                )
+                trees.add(tree_id)
+            if trees.issubset(locked):
+                return
+            opts.lock_trees(session, trees - locked)
+            locked.update(trees)
+
     def _reparent(self, session, node_id, new_parent_id, new_tree_id, new_path,
-                  new_depth, old_tree_id, old_path, old_depth):
+                  new_depth, old_tree_id, old_path, old_depth,
+                  chunk_size=None):
         """
         Update node's parent_id , then :meth:`_update_subtree` and then fill
         the gap left from moving a subtree to a new place by pulling following
         siblings up.
         """
         opts = self._mp_opts
-        session.execute(
-            opts.table.update().where(opts.pk_field == node_id) \
-                               .values({opts.parent_id_field: new_parent_id})
-        )
+        opts.execute(session, 'reparent',
+                     {'sqlamp_node_id': node_id,
+                      'sqlamp_new_parent_id': new_parent_id})
         self._update_subtree(session, node_id, new_tree_id, new_path,
-                             new_depth, old_tree_id, old_path, old_depth)
-        self._pull_nodes('up', session, old_tree_id, old_path, old_depth)
+                             new_depth, old_tree_id, old_path, old_depth,
+                             chunk_size)
+        opts.dispatch_event('subtree_moved', session, node_id,
+                            opts.subtree_range(old_tree_id, old_path),
+                            opts.subtree_range(new_tree_id, new_path))
+        self._pull_nodes('up', session, old_tree_id, old_path, old_depth,
+                         chunk_size)
+        opts.bump_versions(session, [old_tree_id, new_tree_id])
 
     def _update_subtree(self, session, node_id, new_tree_id, new_path,
-                        new_depth, old_tree_id, old_path, old_depth):
+                        new_depth, old_tree_id, old_path, old_depth,
+                        chunk_size=None):
         """
         Update subtree (starting from node ``node_id``) nodes' depth, path
         and tree_id.
 
         The method doesn't deal with recalculating paths, it only can cut
-        and/or concatenate them.
+        and/or concatenate them. Only if the subtree moves to a level with
+        other lengths of steps below it (see ``steplen`` option
+        of :class:`MPManager`), new paths are calculated for each node
+        and written by batched statements.
+
+        If ``chunk_size`` is given nodes are updated by chunks of that size
+        in order of their paths.
+        The new range of paths is always free and doesn't overlap with
+        the old one, so updated nodes leave the old range and each chunk
+        starts from its beginning.
         """
         opts = self._mp_opts
-        descendants_filter = opts.filter_descendants(old_tree_id, old_path,
-                                                     and_self=True)
-        depth_delta = new_depth - old_depth
-        # Will use updates with sql expressions
-        new_depth = opts.depth_field + depth_delta
-        new_path_expr = sqlalchemy.func.substr(
-            opts.path_field, opts.steplen * old_depth + 1
-        )
-        # this is needed for concatenation of function
-        # and literal to work with SQLAlchemy 0.5.x
-        new_path_expr.type = sqlalchemy.String()
-        new_path = new_path + new_path_expr
-        session.execute(
-            opts.table.update().where(descendants_filter) \
-                               .values({opts.tree_id_field: new_tree_id,
-                                        opts.depth_field: new_depth,
-                                        opts.path_field: new_path})
-        )
-
-    def _pull_nodes(self, up_or_down, session, tree_id, from_path, depth):
+        from_path, to_path = opts.path_range(old_path)
+        if not opts.same_steps(old_depth, new_depth):
+            nodes = opts.execute_in_range(session, 'nodes', old_tree_id,
+                                          from_path, to_path).fetchall()
+            params = []
+            for descendant_id, path in nodes:
+                path, depth = opts.rebase_path(path, old_path, old_depth,
+                                               new_path, new_depth)
+                params.append({'sqlamp_node_id': descendant_id,
+                               'sqlamp_tree_id': new_tree_id,
+                               'sqlamp_path': path,
+                               'sqlamp_depth': depth})
+            batch_size = chunk_size or len(params)
+            for start in range(0, len(params), batch_size):
+                opts.execute(session, 'set_node',
+                             params[start:start + batch_size])
+            opts.invalidate_cache(session, old_tree_id, old_path)
+            opts.invalidate_cache(session, new_tree_id, new_path)
+            return
+        # Paths are updated with sql expression, which cuts off the old
+        # subtree root's path and puts the new one in place of it.
+        params = {'sqlamp_new_tree_id': new_tree_id,
+                  'sqlamp_depth_delta': new_depth - old_depth,
+                  'sqlamp_new_path': new_path,
+                  'sqlamp_cut_pos': len(old_path) + 1}
+        while chunk_size is not None:
+            chunk_end = opts.chunk_end(session, old_tree_id,
+                                       from_path, to_path, chunk_size)
+            if chunk_end is None:
+                # the rest of nodes fit in the last chunk
+                break
+            opts.execute_in_range(session, 'update_subtree', old_tree_id,
+                                  from_path, chunk_end, params=params)
+        opts.execute_in_range(session, 'update_subtree', old_tree_id,
+                              from_path, to_path, params=params)
+        opts.invalidate_cache(session, old_tree_id, old_path)
+        opts.invalidate_cache(session, new_tree_id, new_path)
+
+    def _pull_nodes(self, up_or_down, session, tree_id, from_path, depth,
+                    chunk_size=None):
         """
         Move all nodes in tree ``tree_id`` starting from path ``from_path``
         with depth ``depth`` and same parent as node with path ``from_path``
@@ -835,45 +3040,48 @@ class MPClassManager(object):
 
         opts = self._mp_opts
 
-        # TODO: move this to MPOptions.filter_siblings_after()
-        filter_ = (opts.tree_id_field == tree_id) & \
-                  (opts.path_field >= from_path) & \
-                  (opts.depth_field == depth)
-        parent_path = from_path[:-opts.steplen]
-        if parent_path:
-            filter_ &= (opts.path_field < inc_path(parent_path, opts.steplen))
-
-        nodes = session.execute(
-            sqlalchemy.select([opts.pk_field, opts.path_field], filter_) \
-                      .order_by(opts.tree_id_field, opts.path_field)
-        )
+        parent_path = opts.parent_path(from_path)
+        _, end_path = opts.path_range(parent_path)
+        nodes = opts.execute_in_range(session, 'level', tree_id,
+                                      from_path, end_path,
+                                      params={'sqlamp_depth': depth})
         # We can't do path math at sql side without resorting to DBMS-specific
         # things or to using stored procedures. Therefore we have to process
         # siblings sequentially.
+        nodes = nodes.fetchall()
+        if not nodes:
+            return
+        [_, first_path] = nodes[0]
         if up_or_down == 'down':
             # Moving several nodes in a row down has to be done
             # in backwards direction.
-            nodes = list(reversed(nodes.fetchall()))
-            if not nodes:
-                return
+            nodes.reverse()
             _, lastnodepath = nodes[0]
             try:
-                prev_path = inc_path(lastnodepath, opts.steplen)
+                prev_path = opts.next_path(lastnodepath)
             except PathOverflowError:
                 # The last sibling is the last possible node.
                 raise TooManyChildrenError()
+            new_first_path = opts.next_path(first_path)
         else:
             assert up_or_down == 'up'
-            prev_path = from_path
+            prev_path = new_first_path = from_path
         for [node_id, path] in nodes:
             self._update_subtree(session, node_id, tree_id, prev_path,
-                                 depth, tree_id, path, depth)
+                                 depth, tree_id, path, depth,
+                                 chunk_size)
             prev_path = path
+        opts.dispatch_event('siblings_shifted', session,
+                            PathRange(tree_id, first_path, end_path),
+                            PathRange(tree_id, new_first_path, end_path))
 
     def _do_rebuild_subtree(self, session, root_node_id, root_path,
-                            root_depth, tree_id, order_by):
+                            root_depth, tree_id, order_by, batch_size=500,
+                            repair_others=False):
         """
-        The main recursive function for rebuilding trees.
+        The main function for rebuilding trees: recalculates paths,
+        depths and tree ids of all descendants of a node on the basis
+        of adjacency relations.
 
         :param session:
             session object for DML queries.
@@ -887,26 +3095,398 @@ class MPClassManager(object):
             the pre-calculated identifier for this tree.
         :param order_by:
             the children sort order.
+        :param batch_size:
+            the number of parents to fetch children of in one query.
+        :param repair_others:
+            if true, nodes which are left in the old range of the subtree
+            (their parent ids were changed to point outside of it) are
+            moved to one more spare tree id and put in place by
+            :meth:`repair`.
+
+        Descendants are fetched level by level and written by batched
+        statements to a spare tree id first, then they are moved to
+        the tree ``tree_id`` by one ``UPDATE``. So the number of statements
+        depends on the number of descendants only and nodes never clash
+        on unique index with old paths of other nodes being rebuilt.
         """
         opts = self._mp_opts
-        path = root_path + ALPHABET[0] * opts.steplen
+        staging_tree_id = opts.execute(session, 'max_tree_id').scalar() + 1
+        level = [(root_node_id, root_path)]
         depth = root_depth + 1
-        children = session.execute(sqlalchemy.select(
-            [opts.pk_field],
-            opts.parent_id_field == root_node_id
-        ).order_by(order_by))
-        query = opts.table.update()
-        for child in children.fetchall():
-            [child] = child
-            session.execute(
-                query.where(opts.pk_field == child) \
-                     .values({opts.path_field: path, \
-                              opts.depth_field: depth, \
-                              opts.tree_id_field: tree_id})
+        while level:
+            next_level = []
+            for start in range(0, len(level), batch_size):
+                parents = dict(level[start:start + batch_size])
+                children = session.execute(
+                    sqlalchemy.select([opts.pk_field, opts.parent_id_field])
+                        .where(opts.parent_id_field.in_(list(parents)))
+                        .order_by(opts.parent_id_field, order_by)
+                )
+                last_parent_id = None
+                params = []
+                for child, parent_id in children.fetchall():
+                    if parent_id != last_parent_id:
+                        path = opts.child_path(parents[parent_id])
+                        last_parent_id = parent_id
+                    else:
+                        path = opts.next_path(path)
+                    params.append({'sqlamp_node_id': child,
+                                   'sqlamp_path': path,
+                                   'sqlamp_depth': depth,
+                                   'sqlamp_tree_id': staging_tree_id})
+                    next_level.append((child, path))
+                if params:
+                    opts.execute(session, 'set_node', params)
+            level = next_level
+            depth += 1
+        if repair_others:
+            # all the descendants are staged already, whatever is left
+            # in the old range would clash with their new paths.
+            others_tree_id = staging_tree_id + 1
+            opts.execute_in_range(session, 'update_subtree', tree_id,
+                                  root_path + opts.alphabet[0],
+                                  opts.path_range(root_path)[1],
+                                  params={'sqlamp_new_tree_id':
+                                              others_tree_id,
+                                          'sqlamp_depth_delta': 0,
+                                          'sqlamp_new_path': '',
+                                          'sqlamp_cut_pos': 1})
+        opts.execute_in_range(session, 'update_subtree', staging_tree_id,
+                              '', None,
+                              params={'sqlamp_new_tree_id': tree_id,
+                                      'sqlamp_depth_delta': 0,
+                                      'sqlamp_new_path': '',
+                                      'sqlamp_cut_pos': 1})
+        if repair_others:
+            self.repair(session, from_tree_id=others_tree_id,
+                        to_tree_id=others_tree_id)
+
+    def check_alphabet(self, session):
+        """
+        Check that the database sorts digits of paths (see ``alphabet``
+        option of :class:`MPManager`) the same way Python does.
+
+        :param session:
+            session object for queries.
+        :returns:
+            `True` if the order is the same, `False` otherwise.
+
+        Besides single digits, pairs of them are compared, as some
+        collations skip certain characters on the first pass. Digits are
+        compared as literals of the path field's type, so a collation set
+        explicitly on the path column is not taken into account. It is
+        recommended to call this method once on application startup
+        with custom alphabets.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        alphabet = opts.alphabet
+        values = []
+        for digit in alphabet:
+            values.extend([digit, digit + alphabet[0], digit + alphabet[-1]])
+        literal = lambda value: sqlalchemy.sql.expression.literal(
+            value, opts.path_field.type
+        )
+        comparisons = [literal(value) < literal(next_value)
+                       for value, next_value in zip(values, values[1:])]
+        # some databases limit the number of bound parameters
+        for start in range(0, len(comparisons), 100):
+            query = sqlalchemy.select([sqlalchemy.case(
+                [(sqlalchemy.and_(*comparisons[start:start + 100]), 1)],
+                else_=0
+            )])
+            if not session.execute(query).scalar():
+                return False
+        return True
+
+    def check_integrity(self, session, chunk_size=10000,
+                        from_tree_id=None, to_tree_id=None):
+        """
+        Check that paths, depths and tree ids agree with each other
+        and with adjacency relations.
+
+        :param session:
+            session object for queries.
+        :param chunk_size:
+            the number of rows to fetch in one query.
+        :param from_tree_id, to_tree_id:
+            if given, only trees with ids from that range (inclusive) are
+            checked. Ranges of trees are independent, so they can be checked
+            in parallel using separate sessions.
+        :returns:
+            an iterator of :class:`IntegrityProblem` instances.
+
+        All the nodes are read once in order of their tree ids and paths
+        by queries returning at most ``chunk_size`` rows each. Only
+        the ancestors of the current node are kept in memory.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        query = sqlalchemy.select([opts.pk_field, opts.parent_id_field,
+                                   opts.path_field, opts.depth_field,
+                                   opts.tree_id_field]) \
+                    .order_by(opts.tree_id_field, opts.path_field) \
+                    .limit(chunk_size)
+        if from_tree_id is not None:
+            query = query.where(opts.tree_id_field >= from_tree_id)
+        if to_tree_id is not None:
+            query = query.where(opts.tree_id_field <= to_tree_id)
+
+        # entries are [node_id, path, number of children seen]
+        ancestors = []
+        last_tree_id = last_path = None
+        rows = session.execute(query).fetchall()
+        while rows:
+            for node_id, parent_id, path, depth, tree_id in rows:
+                report = lambda problem: IntegrityProblem(node_id, tree_id,
+                                                          path, problem)
+                if tree_id != last_tree_id:
+                    ancestors = []
+                    if parent_id is not None or path:
+                        yield report('root')
+                elif path <= last_path:
+                    yield report('order')
+                elif parent_id is None:
+                    yield report('root')
+                last_tree_id, last_path = tree_id, path
+
+                if len(path) != opts.path_length(depth):
+                    yield report('depth')
+                while ancestors and not (path.startswith(ancestors[-1][1])
+                                         and path != ancestors[-1][1]):
+                    ancestors.pop()
+                if parent_id is not None:
+                    parent = ancestors and ancestors[-1] or None
+                    parents_path = opts.parent_path(path)
+                    if parent is None or parent[0] != parent_id \
+                            or parent[1] != parents_path:
+                        yield report('parent')
+                    if parent is not None and parent[1] == parents_path:
+                        try:
+                            expected = opts.child_path(parent[1], parent[2])
+                        except TooManyChildrenError:
+                            expected = None
+                        if path != expected:
+                            yield report('gap')
+                            try:
+                                # don't report following siblings as well
+                                parent[2] = opts.child_index(path)
+                            except ValueError:
+                                pass
+                        parent[2] += 1
+                ancestors.append([node_id, path, 0])
+            rows = session.execute(query.where(
+                (opts.tree_id_field > last_tree_id) |
+                ((opts.tree_id_field == last_tree_id) &
+                 (opts.path_field > last_path))
+            )).fetchall()
+
+    def repair(self, session, chunk_size=10000,
+               from_tree_id=None, to_tree_id=None):
+        """
+        Fix paths of nodes whose parent ids were changed bypassing
+        :mod:`sqlamp` API and gaps among siblings, updating only affected
+        subtrees.
+
+        :param session:
+            session object for DML queries.
+        :param chunk_size, from_tree_id, to_tree_id:
+            see :meth:`check_integrity`.
+        :returns:
+            a list of :class:`IntegrityProblem` instances which were fixed.
+        :raises MovingToDescendantError:
+            if adjacency relations have a cycle.
+
+        Problems of kinds ``'parent'``, ``'gap'`` and ``'root'`` are fixed.
+        Children of every parent which either got or lost a child (or has
+        a gap among children) are renumbered once: old children keep their
+        order and new ones are put after them. Nodes which got empty parent
+        id become roots of new trees. Subtrees whose positions change are
+        moved with the same statements as `moving nodes`_ use.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        problems = [problem for problem in self.check_integrity(
+                        session, chunk_size, from_tree_id, to_tree_id
+                    ) if problem.problem in ('parent', 'gap', 'root')]
+        if not problems:
+            return problems
+
+        # current state of involved nodes: (parent_id, path, depth, tree_id)
+        rows = {}
+        def row(node_id):
+            if node_id not in rows:
+                [row] = opts.execute(session, 'node',
+                                     {'sqlamp_node_id': node_id}).fetchall()
+                rows[node_id] = tuple(row)
+            return rows[node_id]
+
+        # parents to renumber children of and nodes to become roots
+        parents = set()
+        new_roots = []
+        for problem in problems:
+            parent_id, path, _, tree_id = row(problem.node_id)
+            if parent_id is not None:
+                parents.add(parent_id)
+            elif path and problem.node_id not in new_roots:
+                new_roots.append(problem.node_id)
+            if problem.problem != 'gap' and path:
+                # the node has left children of the node its path points to
+                old_parent_id = session.execute(
+                    sqlalchemy.select([opts.pk_field])
+                        .where(opts.tree_id_field == tree_id)
+                        .where(opts.path_field == opts.parent_path(path))
+                ).scalar()
+                if old_parent_id is not None:
+                    parents.add(old_parent_id)
+        self._lock_trees_of(session, list(parents) + new_roots)
+
+        # final order of children of each parent and their indices
+        indices = {}
+        for parent_id in parents:
+            _, parent_path, _, parent_tree_id = row(parent_id)
+            native, adopted = [], []
+            for child in opts.execute(session, 'children',
+                                      {'sqlamp_parent_id': parent_id}):
+                rows[child[0]] = tuple(child[1:])
+                _, path, _, tree_id = rows[child[0]]
+                if tree_id == parent_tree_id and \
+                        opts.parent_path(path) == parent_path:
+                    native.append(((path, ), child[0]))
+                else:
+                    adopted.append(((tree_id, path), child[0]))
+            native.sort()
+            adopted.sort()
+            for index, (_, node_id) in enumerate(native + adopted):
+                indices[node_id] = index
+        new_tree_id = opts.execute(session, 'max_tree_id').scalar()
+        targets = {}
+        for node_id in new_roots:
+            new_tree_id += 1
+            targets[node_id] = (new_tree_id, '', 0)
+        candidates = list(targets) + list(indices)
+        # relocated nodes by their current positions, for looking up
+        # the closest relocated ancestor by prefixes of a path
+        candidates_by_path = {}
+        for node_id in candidates:
+            _, path, _, tree_id = rows[node_id]
+            candidates_by_path.setdefault((tree_id, path), node_id)
+
+        # final positions: (tree_id, path, depth)
+        positions = {}
+        def position(node_id, visiting=()):
+            if node_id in visiting:
+                raise MovingToDescendantError()
+            visiting += (node_id, )
+            if node_id not in positions:
+                if node_id in targets:
+                    positions[node_id] = targets[node_id]
+                elif node_id in indices:
+                    tree_id, path, depth = position(row(node_id)[0],
+                                                    visiting)
+                    path = opts.child_path(path, indices[node_id])
+                    positions[node_id] = (tree_id, path, depth + 1)
+                else:
+                    positions[node_id] = implied_position(node_id, visiting)
+            return positions[node_id]
+
+        def implied_position(node_id, visiting=()):
+            # the position the node gets if it is not relocated itself,
+            # that is, moved along with the closest relocated ancestor.
+            _, path, _, tree_id = row(node_id)
+            ancestor_path = None
+            for length in range(len(path) - 1, -1, -1):
+                ancestor_id = candidates_by_path.get((tree_id, path[:length]))
+                if ancestor_id is not None:
+                    ancestor_path = path[:length]
+                    break
+            if ancestor_path is None:
+                return (tree_id, path, opts.path_depth(path))
+            tree_id, new_path, depth = position(ancestor_id, visiting)
+            return (tree_id, ) + opts.rebase_path(
+                path, ancestor_path, opts.path_depth(ancestor_path),
+                new_path, depth
             )
-            self._do_rebuild_subtree(session, child, path, depth,
-                                     tree_id, order_by)
-            path = inc_path(path, opts.steplen)
+
+        relocations = []
+        for node_id in candidates:
+            parent_id, path, _, tree_id = rows[node_id]
+            new_position = position(node_id)
+            if new_position != implied_position(node_id):
+                relocations.append((node_id, parent_id, parent_id, tree_id,
+                                    path, opts.path_depth(path))
+                                   + new_position)
+        self._relocate(session, relocations)
+        return problems
+
+    def rebuild_subtree(self, session, node_id, order_by=None):
+        """
+        Rebuild descendants of node ``node_id`` on the basis of adjacency
+        relations. The node itself keeps its path, depth and tree id.
+
+        :param session:
+            session object for DML queries. The transaction is not
+            committed.
+        :param node_id:
+            primary key of a node whose descendants should be rebuilt.
+        :param order_by:
+            an "order by clause" for sorting children nodes, see
+            :meth:`rebuild_all_trees`.
+
+        Nodes which were in the subtree but got parent ids outside of it
+        are put in place among children of their new parents the same
+        way as :meth:`repair` does.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        self._lock_trees_of(session, [node_id])
+        [[_, path, depth, tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': node_id}
+        )
+        self._do_rebuild_subtree(session, node_id, path, depth, tree_id,
+                                 order_by or opts.pk_field,
+                                 repair_others=True)
+        opts.invalidate_cache(session, tree_id, path)
+        opts.bump_versions(session, [tree_id])
+        opts.dispatch_event('subtree_rebuilt', session, node_id,
+                            opts.subtree_range(tree_id, path))
+
+    def rebuild_tree(self, session, root_id, order_by=None):
+        """
+        Rebuild a whole tree with root ``root_id`` on the basis of adjacency
+        relations. Root node keeps its tree id.
+
+        :param session:
+            session object for DML queries. The transaction is not
+            committed.
+        :param root_id:
+            primary key of the tree's root node.
+        :param order_by:
+            an "order by clause" for sorting children nodes, see
+            :meth:`rebuild_all_trees`.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        self._lock_trees_of(session, [root_id])
+        [[parent_id, _, _, tree_id]] = opts.execute(
+            session, 'node', {'sqlamp_node_id': root_id}
+        )
+        assert parent_id is None, "Node %s is not a root node" % root_id
+        opts.execute(session, 'set_node',
+                     {'sqlamp_node_id': root_id, 'sqlamp_path': '',
+                      'sqlamp_depth': 0, 'sqlamp_tree_id': tree_id})
+        self._do_rebuild_subtree(session, root_id, '', 0, tree_id,
+                                 order_by or opts.pk_field,
+                                 repair_others=True)
+        opts.invalidate_cache(session, tree_id, '')
+        opts.bump_versions(session, [tree_id])
+        opts.dispatch_event('subtree_rebuilt', session, root_id,
+                            opts.subtree_range(tree_id, ''))
 
     def drop_indices(self, session):
         """
@@ -971,22 +3551,25 @@ class MPClassManager(object):
         """
         opts = self._mp_opts
         order_by = order_by or opts.pk_field
-        roots = session.execute(sqlalchemy.select(
-            [opts.pk_field], opts.parent_id_field == None
-        ).order_by(order_by))
-        update_query = opts.table.update()
+        roots = session.execute(
+            sqlalchemy.select([opts.pk_field])
+                .where(opts.parent_id_field == None)
+                .order_by(order_by)
+        )
         for tree_id, root_node in enumerate(roots.fetchall()):
             [node_id] = root_node
             # resetting path, depth and tree_id for root node:
-            session.execute(
-                update_query.where(opts.pk_field == node_id) \
-                            .values({opts.tree_id_field: tree_id + 1,
-                                     opts.path_field: '',
-                                     opts.depth_field: 0}) \
-            )
+            opts.execute(session, 'set_node',
+                         {'sqlamp_node_id': node_id, 'sqlamp_path': '',
+                          'sqlamp_depth': 0, 'sqlamp_tree_id': tree_id + 1})
             self._do_rebuild_subtree(session, node_id, '', 0,
                                      tree_id + 1, order_by)
+            opts.bump_versions(session, [tree_id + 1])
+            opts.dispatch_event('subtree_rebuilt', session, node_id,
+                                opts.subtree_range(tree_id + 1, ''))
         session.commit()
+        if opts.cache is not None:
+            opts.cache.clear()
 
     def query(self, session):
         """
@@ -1005,6 +3588,83 @@ class MPClassManager(object):
         return self._mp_opts.query(self.node_class, session)
     query_all_trees = query
 
+    def flush(self, session, retries=3):
+        """
+        Flush new nodes in ``session`` according to the concurrency
+        strategy (see `concurrency`_).
+
+        With ``'retry'`` strategy the flush is done in a savepoint and if
+        it fails with `IntegrityError` (which happens when a concurrent
+        transaction took the same path for its node) the savepoint is
+        rolled back and the flush is repeated, up to ``retries`` times.
+        Note that rolling back the savepoint expires unflushed changes
+        of persistent objects, so it is best to use this method for
+        flushing new nodes only. With other strategies this is the same
+        as ``session.flush()``.
+
+        .. versionadded:: 0.7
+        """
+        opts = self._mp_opts
+        if opts.concurrency != 'retry':
+            session.flush()
+            return
+        # other new objects are flushed by `begin_nested()` outside
+        # of the savepoint.
+        new_nodes = [obj for obj in session.new
+                     if isinstance(obj, self.node_class)]
+        for attempt in range(retries + 1):
+            # `begin_nested()` flushes the session before emitting
+            # the savepoint, so new nodes are put aside for that time.
+            for node in new_nodes:
+                session.expunge(node)
+            savepoint = session.begin_nested()
+            session.add_all(new_nodes)
+            try:
+                session.flush()
+            except sqlalchemy.exc.IntegrityError:
+                # rolling back the savepoint expunges new nodes,
+                # they are added back on the next attempt.
+                savepoint.rollback()
+                session.add_all(new_nodes)
+                if attempt == retries:
+                    raise
+            except Exception:
+                savepoint.rollback()
+                session.add_all(new_nodes)
+                raise
+            else:
+                savepoint.commit()
+                return
+
+    def get_versions(self, session, tree_ids):
+        """
+        Get current versions of several trees in one query.
+
+        Requires :class:`MPManager` to be set up with ``track_versions``
+        option. See `tree versions`_.
+
+        :param session:
+            session object for the query.
+        :param tree_ids:
+            sequence of tree identifiers.
+        :returns:
+            a dict which maps each of ``tree_ids`` to its version. Trees
+            that have not been modified since versions tracking was
+            enabled have version of zero.
+
+        .. versionadded:: 0.7
+        """
+        table = self._mp_opts.versions_table
+        assert table is not None, "Versions tracking is not enabled"
+        tree_ids = list(tree_ids)
+        versions = dict.fromkeys(tree_ids, 0)
+        if tree_ids:
+            versions.update(session.execute(
+                sqlalchemy.select([table.c.tree_id, table.c.version])
+                    .where(table.c.tree_id.in_(tree_ids))
+            ).fetchall())
+        return versions
+
 
 def _get_none():
     # used as a result callable for MPInstanceManager.__reduce__
@@ -1176,6 +3836,55 @@ class MPInstanceManager(object):
         return self._get_query(self._get_obj(), session) \
                    .filter(self.filter_children())
 
+    def _get_cached(self, kind, depth_limit, query):
+        """
+        Get a list of nodes from the cache of :class:`MPOptions` if it
+        is enabled, otherwise (or in case of cache miss) perform query
+        ``query`` and store its result in the cache.
+        """
+        cache = self._mp_opts.cache
+        if cache is None:
+            return query.all()
+        tree_id, path, depth = self._get_values()
+        if not self._mp_opts.cache_usable(query.session, tree_id):
+            return query.all()
+        key = (tree_id, path, kind, depth_limit)
+        nodes = cache.get(key)
+        if nodes is not None:
+            # the same approach as SQLAlchemy's caching example uses:
+            # put detached copies to the session without hitting the db.
+            if hasattr(query, 'merge_result'):
+                return list(query.merge_result(nodes, load=False))
+            # SQLAlchemy 0.5
+            return [query.session.merge(node, dont_load=True)
+                    for node in nodes]
+        nodes = query.all()
+        from_path, to_path = self._mp_opts.path_range(path)
+        cache.set(key, nodes, from_path, to_path)
+        return nodes
+
+    def get_descendants(self, session=None, and_self=False):
+        """
+        The same as :meth:`query_descendants` but returns a list of nodes
+        instead of query object. If :class:`MPManager` was set up with
+        `cache` option the list is taken from the cache when possible.
+
+        .. versionadded:: 0.7
+        """
+        query = self.query_descendants(session, and_self=and_self)
+        kind = and_self and 'descendants_and_self' or 'descendants'
+        return self._get_cached(kind, None, query)
+
+    def get_children(self, session=None):
+        """
+        The same as :meth:`get_descendants` but for children nodes.
+
+        .. versionadded:: 0.7
+        """
+        query = self.query_children(session)
+        tree_id, path, depth = self._get_values()
+        return self._get_cached('children', depth + 1, query)
+
     def filter_ancestors(self, and_self=False):
         "The same as :meth:`filter_descendants` but filters ancestor nodes."
         tree_id, path, depth = self._get_values()
@@ -1250,10 +3959,69 @@ class MPManager(object):
         an integer, the number of characters in each part of the path.
         See `limits`_.
 
+        .. versionchanged:: 0.7
+            It can also be a list of integers, the numbers of characters
+            in parts of paths of nodes at the first, the second and so on
+            levels. The last one is used for all the deeper levels.
+
     :param instance_manager_key='_mp_instance_manager':
         name for node instance's attribute to cache node's instance
         manager.
 
+    :param cache=None:
+        an instance of :class:`SubtreeCache` or `True` for creating
+        one with default in-process backend. Enables caching of results
+        of :meth:`MPInstanceManager.get_descendants`
+        and :meth:`MPInstanceManager.get_children`.
+
+        .. versionadded:: 0.7
+
+    :param track_versions=False:
+        if `True`, a side table ``<table name>__mp_versions`` is declared
+        in the table's metadata and each modification of a tree increments
+        the tree's version there. See `tree versions`_.
+
+        .. versionadded:: 0.7
+
+    :param concurrency=None:
+        a strategy of dealing with concurrent insertions of children
+        of the same parent: ``'lock'`` or ``'retry'``. See `concurrency`_.
+
+        .. versionadded:: 0.7
+
+    :param tree_locks=False:
+        if `True`, trees are locked before detaching, deleting and moving
+        their nodes, so such operations on different trees don't interfere
+        and can run concurrently. A side table ``<table name>__mp_locks``
+        is declared in the table's metadata for databases without
+        advisory locks. See `concurrency`_.
+
+        .. versionadded:: 0.7
+
+    :param node_order_by=None:
+        a list of columns (or their names) which children of each node
+        are kept sorted by (in ascending order). See `ordered trees`_.
+
+        .. versionadded:: 0.7
+
+    :param binary_paths=False:
+        if `True`, the path field is created with :class:`BinaryPathField`
+        type, so paths are compared byte by byte regardless of collation
+        and every character of them holds 256 values instead of 36.
+        See `limits`_.
+
+        .. versionadded:: 0.7
+
+    :param alphabet=None:
+        a string of unique characters in ascending order which are digits
+        of paths. By default it is ``0-9A-Z`` for text paths and all byte
+        values for binary ones. A longer alphabet allows more children
+        with the same ``steplen``, but the database has to sort its
+        characters the same way, see :meth:`MPClassManager.check_alphabet`
+        and `limits`_.
+
+        .. versionadded:: 0.7
+
     .. warning::
         Do not change the values of `MPManager` constructor's attributes
         after saving a first tree node. Doing this will corrupt the tree.
@@ -1474,7 +4242,10 @@ class DeclarativeMeta(BaseDeclarativeMeta):
 
         opts = {}
         for opt in ['path_field', 'depth_field', 'tree_id_field',
-                    'steplen', 'pathlen', 'instance_manager_key']:
+                    'steplen', 'pathlen', 'instance_manager_key',
+                    'cache', 'track_versions', 'concurrency',
+                    'tree_locks', 'node_order_by', 'binary_paths',
+                    'alphabet']:
             optname = '__mp_%s__' % opt
             if hasattr(cls, optname):
                 opts[opt] = getattr(cls, optname)
@@ -1496,15 +4267,4 @@ class DeclarativeMeta(BaseDeclarativeMeta):
         mp_manager._mp_opts.declare_indices()
 
         setattr(cls, mp_manager_name, mp_manager)
-        mapper_ext = mp_manager.mapper_extension
-        if hasattr(cls.__mapper__, 'extension'):
-            # SQLAlchemy < 0.7
-            cls.__mapper__.extension.append(mapper_ext)
-        else:
-            # SQLAlchemy 0.7+
-            from sqlalchemy import event
-            event.listen(cls.__mapper__, 'before_insert',
-                         mapper_ext.before_insert, propagate=True)
-            event.listen(cls.__mapper__, 'after_insert',
-                         mapper_ext.after_insert, propagate=True)
-
+        mp_manager.mapper_extension.register(cls.__mapper__)
@@ -54,6 +54,217 @@ class BenchmarkTestCase(_testlib._BaseTestCase):
               "(%.2f insertions per second)" % \
               (num_nodes, elapsed, transactions, num_nodes / elapsed))
 
+    def _flush_insertion_benchmark(self, num_nodes, num_flushes):
+        root = Cls()
+        self.sess.add(root)
+        self.sess.flush()
+        start = time()
+        for x in range(num_flushes):
+            self.sess.add_all([Cls(parent_id=root.id)
+                               for y in range(num_nodes // num_flushes)])
+            self.sess.flush()
+        self.sess.commit()
+        elapsed = time() - start
+        print("%d insertions in %.2f seconds in %d flushes " \
+              "(%.2f insertions per second)" % \
+              (num_nodes, elapsed, num_flushes, num_nodes / elapsed))
+
+    def _concurrent_insertion_benchmark(self, concurrency, num_threads,
+                                        num_nodes):
+        import tempfile
+        import threading
+        db_uri = os.environ['DB_URI']
+        if db_uri.startswith('sqlite'):
+            # threads need a database file to share
+            fd, filename = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+            engine = sqlalchemy.create_engine('sqlite:///' + filename)
+            # pysqlite doesn't start transactions before SELECTs
+            # and breaks savepoints, see SQLAlchemy's notes on that.
+            def connect(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None
+            def begin(connection):
+                connection.execute('BEGIN')
+            sqlalchemy.event.listen(engine, 'connect', connect)
+            sqlalchemy.event.listen(engine, 'begin', begin)
+        else:
+            filename = None
+            engine = sqlalchemy.create_engine(db_uri)
+        metadata = sqlalchemy.MetaData()
+        table = sqlalchemy.Table('concurrent_tbl', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('pid',
+                              sqlalchemy.ForeignKey('concurrent_tbl.id'))
+        )
+        class Node(object):
+            mp = sqlamp.MPManager(table, concurrency=concurrency)
+        mapper_extension = Node.mp
+        sqlalchemy.orm.mapper(Node, table)
+        mapper_extension.register(Node)
+        metadata.create_all(engine)
+        make_engine_session = sqlalchemy.orm.sessionmaker(bind=engine)
+
+        # unique violations as well as lock timeouts and deadlocks
+        conflicts = []
+        def count_conflict(context):
+            conflicts.append(1)
+        sqlalchemy.event.listen(engine, 'handle_error', count_conflict)
+
+        sess = make_engine_session()
+        root = Node()
+        sess.add(root)
+        sess.commit()
+        root_id = root.id
+        sess.close()
+
+        def worker():
+            sess = make_engine_session()
+            try:
+                for x in range(num_nodes // num_threads):
+                    while True:
+                        node = Node()
+                        node.pid = root_id
+                        sess.add(node)
+                        try:
+                            Node.mp.flush(sess)
+                            sess.commit()
+                        except (sqlalchemy.exc.IntegrityError,
+                                sqlalchemy.exc.OperationalError):
+                            # the application has to repeat the transaction
+                            sess.rollback()
+                        else:
+                            break
+            finally:
+                sess.close()
+
+        threads = [threading.Thread(target=worker)
+                   for x in range(num_threads)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - start
+
+        sess = make_engine_session()
+        num_children = sess.query(Node).filter_by(pid=root_id).count()
+        sess.close()
+        metadata.drop_all(engine)
+        engine.dispose()
+        if filename is not None:
+            os.remove(filename)
+        print("%d insertions in %d threads with %s concurrency strategy " \
+              "in %.2f seconds (%.2f insertions per second, %d conflicts)" % \
+              (num_children, num_threads, concurrency, elapsed,
+               num_children / elapsed, len(conflicts)))
+
+    def _deletion_benchmark(self, num_nodes, close_gap):
+        root = Cls()
+        self.sess.add(root)
+        self.sess.flush()
+        self.sess.add_all([Cls(parent_id=root.id) for x in range(num_nodes)])
+        self.sess.commit()
+        node_ids = [node.id for node in root.mp.query_children()]
+        start = time()
+        parent_ids = [Cls.mp.delete_subtree(self.sess, node_id, close_gap)
+                      for node_id in node_ids[::2]]
+        if not close_gap:
+            list(Cls.mp.compact(self.sess, parent_ids=parent_ids))
+        self.sess.commit()
+        elapsed = time() - start
+        print("%d deletions %s closing gaps in %.2f seconds " \
+              "(%.2f deletions per second)" % \
+              (len(parent_ids), close_gap and 'with' or 'without', elapsed,
+               len(parent_ids) / elapsed))
+
+    def _export_import_benchmark(self, num_nodes):
+        import random
+        import tempfile
+        root = Cls()
+        self.sess.add(root)
+        self.sess.flush()
+        parents = [root.id]
+        for x in range(num_nodes // 100):
+            nodes = [Cls(parent_id=random.choice(parents))
+                     for y in range(100)]
+            self.sess.add_all(nodes)
+            self.sess.flush()
+            parents.extend(node.id for node in nodes[:10])
+        self.sess.commit()
+        fileobj = tempfile.TemporaryFile(mode='w+')
+        start = time()
+        Cls.mp.export_tree(self.sess, root.mp_tree_id, fileobj)
+        exported = time() - start
+        fileobj.seek(0)
+        start = time()
+        Cls.mp.import_tree(self.sess, fileobj)
+        self.sess.commit()
+        imported = time() - start
+        fileobj.close()
+        print("%d nodes exported in %.2f seconds, imported in %.2f seconds " \
+              "(%.2f nodes per second)" % \
+              (num_nodes, exported, imported, num_nodes / imported))
+
+    def _create_tree_benchmark(self, num_nodes):
+        import random
+        root = {'children': []}
+        parents = [root]
+        for x in range(num_nodes - 1):
+            node = {'children': []}
+            random.choice(parents)['children'].append(node)
+            if len(parents) < num_nodes // 10:
+                parents.append(node)
+        start = time()
+        Cls.mp.create_tree(self.sess, root)
+        self.sess.commit()
+        elapsed = time() - start
+        print("%d nodes created in %.2f seconds (%.2f nodes per second)" % \
+              (num_nodes, elapsed, num_nodes / elapsed))
+
+    def _path_encoding_benchmark(self, binary_paths, num_nodes):
+        metadata = sqlalchemy.MetaData()
+        table = sqlalchemy.Table('encoding_tbl', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('pid', sqlalchemy.ForeignKey('encoding_tbl.id'))
+        )
+        # about the same number of children in each node for both encodings
+        class Node(object):
+            mp = sqlamp.MPManager(table, binary_paths=binary_paths,
+                                  steplen=binary_paths and 2 or 3)
+        mapper_extension = Node.mp
+        sqlalchemy.orm.mapper(Node, table)
+        mapper_extension.register(Node)
+        metadata.create_all(self.sess.bind)
+        try:
+            # wide at the top, narrow below
+            leaves = [{} for x in range(num_nodes // 10)]
+            groups = [{'children': leaves[x:x + 9]}
+                      for x in range(0, len(leaves), 9)]
+            Node.mp.create_tree(self.sess, {'children': groups})
+            self.sess.commit()
+            key_length = self.sess.execute(sqlalchemy.select([
+                sqlalchemy.func.avg(sqlalchemy.func.length(table.c.mp_path))
+            ])).scalar()
+            paths = [row[0] for row in self.sess.execute(
+                sqlalchemy.select([table.c.mp_path])
+                    .where(table.c.mp_depth == 1)
+            )]
+            opts = Node.mp._mp_opts
+            start = time()
+            for path in paths:
+                self.sess.execute(
+                    sqlalchemy.select([sqlalchemy.func.count(table.c.id)])
+                        .where(opts.filter_descendants(1, path, True))
+                ).scalar()
+            elapsed = time() - start
+            print("%s paths: average length of %.2f bytes, %d subtree scans " \
+                  "in %.2f seconds (%.2f scans per second)" % \
+                  (binary_paths and "binary" or "text", key_length,
+                   len(paths), elapsed, len(paths) / elapsed))
+        finally:
+            self.sess.close()
+            metadata.drop_all(self.sess.bind)
+
     def _descendants_benchmark(self, num_passes):
         total_children = 0
         total_nodes = self.sess.query(Cls).count()
@@ -80,6 +291,19 @@ class BenchmarkTestCase(_testlib._BaseTestCase):
             commit_once=True, num_nodes=1000, num_roots=10
         )
         self._descendants_benchmark(num_passes=2)
+        self.sess.query(Cls).delete()
+        self.sess.commit()
+        self._flush_insertion_benchmark(num_nodes=1000, num_flushes=10)
+        self._export_import_benchmark(num_nodes=10000)
+        self._create_tree_benchmark(num_nodes=10000)
+        for binary_paths in (False, True):
+            self._path_encoding_benchmark(binary_paths, num_nodes=20000)
+        for close_gap in (True, False):
+            self._deletion_benchmark(num_nodes=400, close_gap=close_gap)
+        for concurrency in (None, 'lock', 'retry'):
+            self._concurrent_insertion_benchmark(
+                concurrency, num_threads=4, num_nodes=400
+            )
 
 
 def get_suite():
@@ -87,7 +311,6 @@ def get_suite():
 
 
 if __name__ == '__main__':
-    import os
     os.environ['BENCHMARK'] = '1'
     unittest.TextTestRunner(verbosity=2).run(get_suite())
 
@@ -2,7 +2,9 @@
 """
 `sqlamp` functional tests.
 """
+import json
 import random
+import sys
 import unittest
 import pickle
 
@@ -40,6 +42,38 @@ class _BaseFunctionalTestCase(_testlib._BaseTestCase):
             ]),
             ("root3", []),
         ]
+        self._tree_tables = []
+
+    def tearDown(self):
+        super(_BaseFunctionalTestCase, self).tearDown()
+        for table in reversed(self._tree_tables):
+            table.drop()
+            metadata.remove(table)
+
+    def _make_tree_class(self, table_name, columns=(), **mp_opts):
+        """
+        Create a table ``table_name`` with ``id``, ``pid`` and ``columns``
+        and a node class mapped to it with ``MPManager(**mp_opts)``.
+        The tables (including versions and locks ones) are dropped
+        in `tearDown`.
+        """
+        table = sqlalchemy.Table(table_name, metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('pid',
+                              sqlalchemy.ForeignKey(table_name + '.id')),
+            *columns
+        )
+        class Node(Cls):
+            mp = sqlamp.MPManager(table, **mp_opts)
+        rel = sqlalchemy.orm.relation(Node, remote_side=[table.c.id])
+        sqlalchemy.orm.mapper(Node, table, extension=[Node.mp],
+                              properties={'parent': rel})
+        opts = Node.mp._mp_opts
+        for table in (table, opts.versions_table, opts.locks_table):
+            if table is not None:
+                table.create()
+                self._tree_tables.append(table)
+        return Node
 
     def n(self, node_name):
         return Cls.mp.query(self.sess).filter_by(name=node_name).one()
@@ -159,6 +193,181 @@ class RebuildTestCase(_BaseFunctionalTestCase):
         data_after = query.execute().fetchall()
         self.assertEqual(data_before, data_after)
 
+    def test_rebuild_tree(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        data_before = self.sess.execute(query).fetchall()
+        roots = self._corrupt_tree(including_roots=False)
+        data_corrupted = self.sess.execute(query).fetchall()
+        for root in roots:
+            Cls.mp.rebuild_tree(self.sess, root.id)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_before)
+        # transaction is left to the caller
+        self.sess.rollback()
+        self.assertEqual(self.sess.execute(query).fetchall(), data_corrupted)
+
+    def test_rebuild_subtree(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        data_before = self.sess.execute(query).fetchall()
+        child21 = self.n('child21')
+        for node in child21.mp.query_descendants():
+            node.mp_path = node.mp_path[::-1] + '_'
+            node.mp_depth = 0
+        self.sess.flush()
+        self.sess.expire_all()
+        Cls.mp.rebuild_subtree(self.sess, child21.id)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_before)
+
+    def test_rebuild_subtree_moved_out(self):
+        self._fill_tree()
+        ids = dict((name, self.n(name).id) for name in
+                   ('child21', 'child211', 'child22'))
+        # child212 takes the old path of child211
+        self.sess.execute(tbl.update().where(tbl.c.id == ids['child211'])
+                                      .values(parent_id=ids['child22']))
+        self.sess.expire_all()
+        Cls.mp.rebuild_subtree(self.sess, ids['child21'])
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+        root2 = self.n('root2')
+        self.assertEqual(
+            [(node.name, node.mp_path) for node in
+             root2.mp.query_descendants()],
+            [('child21', '00'), ('child212', '0000'), ('child2121', '000000'),
+             ('child2122', '000001'), ('child21221', '00000100'),
+             ('child21222', '00000101'), ('child22', '01'),
+             ('child211', '0100'), ('child23', '02')]
+        )
+
+    def test_check_integrity(self):
+        self._fill_tree()
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+        n = lambda name: self.n(name).id
+        ids = dict((name, n(name)) for name in
+                   ('root1', 'child11', 'child12', 'child2121', 'child22',
+                    'root3'))
+        self.sess.execute(tbl.delete().where(tbl.c.id == ids['child11']))
+        self.sess.execute(tbl.update().where(tbl.c.id == ids['child2121'])
+                                      .values(mp_depth=7))
+        self.sess.execute(tbl.update().where(tbl.c.id == ids['child22'])
+                                      .values(parent_id=ids['root1']))
+        self.sess.execute(tbl.update().where(tbl.c.id == ids['root3'])
+                                      .values(mp_path='9'))
+        problems = list(Cls.mp.check_integrity(self.sess, chunk_size=3))
+        self.assertEqual(
+            [(problem.node_id, problem.problem) for problem in problems],
+            [(ids['child12'], 'gap'), (ids['child2121'], 'depth'),
+             (ids['child22'], 'parent'), (ids['root3'], 'root'),
+             (ids['root3'], 'depth')]
+        )
+        self.assertEqual(problems[0],
+                         sqlamp.IntegrityProblem(ids['child12'], 1, '01',
+                                                 'gap'))
+        problems = Cls.mp.check_integrity(self.sess, from_tree_id=2,
+                                          to_tree_id=2)
+        self.assertEqual([problem.node_id for problem in problems],
+                         [ids['child2121'], ids['child22']])
+
+    def test_repair(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        ids = dict((node.name, node.id) for node in Cls.mp.query(self.sess))
+        Cls.mp.delete_subtree(self.sess, ids['child11'])
+        Cls.mp.detach_subtree(self.sess, ids['child12'])
+        Cls.mp.move_subtree_to_bottom(self.sess, ids['child22'],
+                                      ids['root1'])
+        Cls.mp.move_subtree_to_bottom(self.sess, ids['child211'],
+                                      ids['child13'])
+        Cls.mp.move_subtree_to_bottom(self.sess, ids['child2121'],
+                                      ids['child21'])
+        data_expected = self.sess.execute(query).fetchall()
+        self.sess.rollback()
+
+        update = lambda name, **values: self.sess.execute(
+            tbl.update().where(tbl.c.id == ids[name]).values(**values)
+        )
+        self.sess.execute(tbl.delete().where(tbl.c.id == ids['child11']))
+        update('child12', parent_id=None)
+        update('child22', parent_id=ids['root1'])
+        update('child211', parent_id=ids['child13'])
+        update('child2121', parent_id=ids['child21'])
+        problems = Cls.mp.repair(self.sess, chunk_size=4)
+        self.assertEqual(
+            sorted((problem.node_id, problem.problem)
+                   for problem in problems),
+            sorted([(ids['child12'], 'root'), (ids['child13'], 'gap'),
+                    (ids['child22'], 'parent'), (ids['child211'], 'parent'),
+                    (ids['child2121'], 'parent')])
+        )
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+        self.assertEqual(Cls.mp.repair(self.sess), [])
+
+        update('child212', parent_id=ids['child2122'])
+        self.assertRaises(sqlamp.MovingToDescendantError,
+                          Cls.mp.repair, self.sess)
+
+    def test_export_import_tree(self):
+        self._fill_tree()
+        def tree(tree_id):
+            nodes = self.sess.query(Cls).filter_by(mp_tree_id=tree_id) \
+                                        .order_by(tbl.c.mp_path).all()
+            return [(node.name, node.mp_path, node.mp_depth,
+                     node.parent and node.parent.name) for node in nodes]
+        class Lines(list):
+            write = list.append
+        lines = Lines()
+        Cls.mp.export_tree(self.sess, 2, lines, chunk_size=3)
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(json.loads(lines[0]), {
+            'columns': ['name', 'mp_path', 'mp_depth'], 'steplen': [2],
+            'alphabet': sqlamp.ALPHABET
+        })
+        self.assertEqual(json.loads(lines[1]), ['root2', '', 0])
+
+        tree_id = Cls.mp.import_tree(self.sess, lines, chunk_size=4)
+        self.assertEqual(tree_id, 4)
+        self.assertEqual(tree(tree_id), tree(2))
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+
+    def test_create_tree(self):
+        self._fill_tree()
+        data = {'name': 'new', 'children': [
+            {'name': 'new1', 'children': [{'name': 'new11'}]},
+            {'name': 'new2'},
+            {'name': 'new3', 'children': []},
+        ]}
+        root_id = Cls.mp.create_tree(self.sess, data)
+        self.assertEqual(
+            [(node.name, node.mp_path, node.mp_depth,
+              node.parent and node.parent.name) for node in
+             self.sess.query(Cls).filter_by(mp_tree_id=4)
+                                 .order_by(tbl.c.mp_path)],
+            [('new', '', 0, None), ('new1', '00', 1, 'new'),
+             ('new11', '0000', 2, 'new1'), ('new2', '01', 1, 'new'),
+             ('new3', '02', 1, 'new')]
+        )
+        self.assertEqual(self.sess.query(Cls).get(root_id).name, 'new')
+
+        child12 = self.n('child12')
+        subtree_id = Cls.mp.create_tree(self.sess, data, child12.id)
+        subtree_root = self.sess.query(Cls).get(subtree_id)
+        self.assertEqual(
+            (subtree_root.mp_tree_id, subtree_root.mp_path,
+             subtree_root.parent),
+            (1, '0100', child12)
+        )
+        self.assertEqual(
+            [node.name for node in subtree_root.mp.get_descendants()],
+            ['new1', 'new11', 'new2', 'new3']
+        )
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+
+        self.assertRaises(sqlamp.TooManyChildrenError, Cls.mp.create_tree,
+                          self.sess, {'name': 'wide', 'children': [
+                              {'name': 'child'}
+                          ] * (Cls.mp.max_children + 1)})
+
     def test_drop_indices(self):
         Cls.mp.drop_indices(self.sess)
         [index] =Cls.mp._mp_opts.indices
@@ -336,6 +545,36 @@ class SetupTestCase(_BaseFunctionalTestCase):
         finally:
             Node.__table__.delete()
 
+    def test_register_mapper_extension(self):
+        tbl = sqlalchemy.Table('tbl9', metadata,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('pid', sqlalchemy.ForeignKey('tbl9.id'))
+        )
+        class Node(Cls):
+            mp = sqlamp.MPManager(tbl, steplen=1)
+        mapper_extension = Node.mp
+        # no relations, so nodes are inserted in batches
+        sqlalchemy.orm.mapper(Node, tbl)
+        mapper_extension.register(Node)
+        tbl.create()
+        try:
+            self.sess.add_all([Node(id=1), Node(id=2)])
+            self.sess.flush()
+            self.sess.add_all([Node(id=id_, pid=1) for id_ in (3, 4, 5)])
+            self.sess.add(Node(id=6, pid=2))
+            self.sess.flush()
+            self.sess.expunge_all()
+            nodes = self.sess.query(Node).order_by(Node.id).all()
+            self.assertEqual(
+                [(n.mp_tree_id, n.mp_path, n.mp_depth) for n in nodes],
+                [(1, '', 0), (2, '', 0), (1, '0', 1), (1, '1', 1),
+                 (1, '2', 1), (2, '0', 1)]
+            )
+        finally:
+            self.sess.rollback()
+            tbl.drop()
+            metadata.remove(tbl)
+
     def test_implicit_pk_fk(self):
         tbl = sqlalchemy.Table('tbl2', metadata,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
@@ -915,6 +1154,343 @@ class MoveNodesTestCase(_BaseFunctionalTestCase):
         data_after = query.execute().fetchall()
         self.assertEqual(data_before, data_after)
 
+    def test_everything_chunked(self):
+        self._fill_tree()
+        # tree ids are not restored by detaching, so they are not compared
+        columns = [tbl.c.id, tbl.c.name, tbl.c.parent_id,
+                   tbl.c.mp_path, tbl.c.mp_depth]
+        query = sqlalchemy.select(columns).order_by(tbl.c.id)
+        data_before = self.sess.execute(query).fetchall()
+        n = lambda name: self.n(name).id
+
+        def take_apart(**kwargs):
+            Cls.mp.detach_subtree(self.sess, n('child212'), **kwargs)
+            Cls.mp.move_subtree_before(self.sess, n('child23'), n('child21'),
+                                       **kwargs)
+            Cls.mp.move_subtree_to_top(self.sess, n('root1'), n('child22'),
+                                       **kwargs)
+            Cls.mp.move_subtree_to_bottom(self.sess, n('child2122'),
+                                          n('child23'), **kwargs)
+
+        def put_together(**kwargs):
+            Cls.mp.move_subtree_after(self.sess, n('child2122'),
+                                      n('child2121'), **kwargs)
+            Cls.mp.move_subtree_after(self.sess, n('child212'),
+                                      n('child211'), **kwargs)
+            Cls.mp.move_subtree_to_bottom(self.sess, n('child23'),
+                                          n('root2'), **kwargs)
+            Cls.mp.detach_subtree(self.sess, n('root1'), **kwargs)
+
+        take_apart()
+        data_apart = self.sess.execute(query).fetchall()
+        put_together()
+        self.assertNotEqual(data_apart, data_before)
+
+        take_apart(chunk_size=1)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_apart)
+        put_together(chunk_size=2)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_before)
+
+    def test_estimate(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        data_before = self.sess.execute(query).fetchall()
+        n = lambda name: self.n(name).id
+
+        dml = []
+        def count_dml(conn, cursor, statement, *args):
+            if statement.split()[0] in ('UPDATE', 'DELETE'):
+                dml.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_dml)
+        try:
+            for operation, node, anchor, chunk_size, expected in [
+                ('move_subtree_before', 'child23', 'child21', None,
+                 (1, [7, 1, 1])),
+                ('move_subtree_after', 'child21', 'child11', 2,
+                 (7, [1, 1, 1, 1])),
+                ('move_subtree_to_top', 'root1', 'child212', None,
+                 (4, [1, 3])),
+                ('move_subtree_to_bottom', 'child2122', 'root3', 1,
+                 (3, [])),
+                ('detach_subtree', 'child212', None, None, (5, [])),
+                # chunk size doesn't apply to deletions
+                ('delete_subtree', 'child11', None, 1, (1, [1, 1])),
+            ]:
+                args = [n(node)]
+                if anchor is not None:
+                    args.append(n(anchor))
+                cost = Cls.mp.estimate(self.sess, operation, *args,
+                                       **{'chunk_size': chunk_size})
+                self.assertEqual(self.sess.execute(query).fetchall(),
+                                 data_before)
+                self.assertEqual((cost.subtree_size, cost.shifted_subtrees),
+                                 expected)
+                self.assertEqual(cost.rows, sum(expected[1]) + expected[0])
+
+                del dml[:]
+                kwargs = {}
+                if operation != 'delete_subtree':
+                    kwargs['chunk_size'] = chunk_size
+                getattr(Cls.mp, operation)(self.sess, *args, **kwargs)
+                self.assertEqual(cost.statements, len(dml))
+                self.sess.rollback()
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    count_dml)
+
+        self.assertRaises(sqlamp.MovingToDescendantError, Cls.mp.estimate,
+                          self.sess, 'move_subtree_to_top', n('root2'),
+                          n('child212'))
+
+    def test_apply_moves(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        n = lambda name: self.n(name).id
+        operations = [
+            ('move_subtree_before', n('child23'), n('child21')),
+            ('move_subtree_to_top', n('child2122'), n('child11')),
+            ('move_subtree_after', n('child21'), n('child13')),
+            ('move_subtree_to_bottom', n('root3'), n('child22')),
+            ('move_subtree_before', n('child12'), n('child11')),
+            ('move_subtree_after', n('child211'), n('child212')),
+            ('move_subtree_to_top', n('child21222'), n('child21')),
+        ]
+
+        dml = []
+        def count_dml(conn, cursor, statement, *args):
+            if statement.split()[0] == 'UPDATE':
+                dml.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_dml)
+        try:
+            for operation, node_id, anchor_id in operations:
+                getattr(Cls.mp, operation)(self.sess, node_id, anchor_id)
+            data_expected = self.sess.execute(query).fetchall()
+            sequential_updates = len(dml)
+            self.sess.rollback()
+
+            del dml[:]
+            Cls.mp.apply_moves(self.sess, operations)
+            self.assertEqual(self.sess.execute(query).fetchall(),
+                             data_expected)
+            self.assert_(len(dml) < sequential_updates)
+
+            # moving nodes back and forth writes nothing
+            del dml[:]
+            Cls.mp.apply_moves(self.sess, [
+                ('move_subtree_to_top', n('child211'), n('root1')),
+                ('move_subtree_after', n('child211'), n('child212')),
+            ])
+            self.assertEqual(dml, [])
+            self.assertEqual(self.sess.execute(query).fetchall(),
+                             data_expected)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                    count_dml)
+
+        self.assertRaises(sqlamp.MovingToDescendantError, Cls.mp.apply_moves,
+                          self.sess, [
+            ('move_subtree_to_top', n('child11'), n('child211')),
+            ('move_subtree_to_top', n('child21'), n('child11')),
+        ])
+
+    def test_reorder_children(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        root1 = self.n('root1')
+        names = sorted([child.name for child in root1.mp.query_children()],
+                       reverse=True)
+        for name in names:
+            Cls.mp.move_subtree_to_bottom(self.sess, self.n(name).id,
+                                          root1.id)
+        data_expected = self.sess.execute(query).fetchall()
+        self.sess.rollback()
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            Cls.mp.reorder_children(self.sess, root1.id, tbl.c.name.desc())
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+        self.assertEqual([child.name for child in root1.mp.query_children()],
+                         names)
+        # parent ids stay the same, so they are not updated
+        self.assertEqual([statement for statement in statements
+                          if 'SET parent_id' in statement], [])
+        # reordering by the same clause again changes nothing
+        Cls.mp.reorder_children(self.sess, root1.id, tbl.c.name.desc())
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+        # leaf nodes are fine too
+        Cls.mp.reorder_children(self.sess, self.n('child11').id, tbl.c.name)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+
+    def test_compact(self):
+        self._fill_tree()
+        ids = dict((node.name, node.id) for node in Cls.mp.query(self.sess))
+        # deleting leaf nodes without closing gaps
+        self.sess.execute(tbl.delete().where(tbl.c.id.in_([
+            ids['child11'], ids['child211'], ids['child2121'], ids['child22']
+        ])))
+        self.sess.commit()
+        self.assertEqual(
+            sorted(set(problem.node_id for problem in
+                       Cls.mp.check_integrity(self.sess))),
+            [ids['child12'], ids['child212'], ids['child2122'],
+             ids['child23']]
+        )
+
+        job = Cls.mp.compact(self.sess, batch_size=1)
+        checkpoint = next(job)
+        job.close()
+        self.assertEqual(checkpoint, ids['root1'])
+        self.assertEqual(
+            sorted(set(problem.node_id for problem in
+                       Cls.mp.check_integrity(self.sess))),
+            [ids['child212'], ids['child2122'], ids['child23']]
+        )
+
+        checkpoints = list(Cls.mp.compact(self.sess, after=checkpoint,
+                                          batch_size=2))
+        self.assertEqual(checkpoints, [ids['child21'], ids['child2122']])
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+        self.assertEqual(
+            [node.name for node in Cls.mp.query(self.sess)],
+            ['root1', 'child12', 'child13',
+             'root2', 'child21', 'child212', 'child2122', 'child21221',
+             'child21222', 'child23', 'root3']
+        )
+
+    def test_copy_subtree(self):
+        self._fill_tree()
+        def subtree(node_id):
+            node = self.sess.query(Cls).get(node_id)
+            return [(descendant.name,
+                     descendant.mp_path[len(node.mp_path):],
+                     descendant.mp_depth - node.mp_depth)
+                    for descendant in node.mp.query_descendants(and_self=True)]
+        ids = dict((node.name, node.id) for node in Cls.mp.query(self.sess))
+        child21 = ids['child21']
+        original = subtree(child21)
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            copy1 = Cls.mp.copy_subtree(self.sess, child21, ids['root1'])
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.split()[0] != 'SELECT']), 2)
+        copy2 = Cls.mp.copy_subtree(self.sess, child21, ids['root2'],
+                                    position='top')
+        # copying into own descendant
+        copy3 = Cls.mp.copy_subtree(self.sess, child21,
+                                    ids['child2122'], position='top')
+        self.sess.expire_all()
+        self.assertEqual(list(Cls.mp.check_integrity(self.sess)), [])
+        self.assertEqual(subtree(copy1), original)
+        self.assertEqual(subtree(copy2), original)
+        self.assertEqual(subtree(copy3), original)
+        root1, root2, copied = [self.sess.query(Cls).get(node_id)
+                                for node_id in (ids['root1'], ids['root2'],
+                                                child21)]
+        self.assertEqual([node.name for node in root1.mp.query_children()],
+                         ['child11', 'child12', 'child13', 'child21'])
+        self.assertEqual([node.id for node in root2.mp.query_children()],
+                         [copy2, child21, ids['child22'], ids['child23']])
+        self.assertEqual([descendant.id for descendant in
+                          copied.mp.query_descendants()
+                          if descendant.name == 'child21'],
+                         [copy3])
+
+    def test_merge_tree(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        ids = dict((node.name, node.id) for node in Cls.mp.query(self.sess))
+        for position, method in (('top', Cls.mp.move_subtree_to_top),
+                                 ('bottom', Cls.mp.move_subtree_to_bottom)):
+            method(self.sess, ids['root2'], ids['child12'])
+            data_expected = self.sess.execute(query).fetchall()
+            self.sess.rollback()
+
+            statements = []
+            def count(conn, cursor, statement, *args):
+                statements.append(statement.split()[0])
+            engine = _testlib.engine
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+            try:
+                Cls.mp.merge_tree(self.sess, 2, ids['child12'],
+                                  position=position)
+            finally:
+                sqlalchemy.event.remove(engine, 'before_cursor_execute',
+                                        count)
+            self.assertEqual(self.sess.execute(query).fetchall(),
+                             data_expected)
+            self.assertEqual(statements.count('UPDATE'), 2)
+            self.sess.rollback()
+
+        self.assertRaises(sqlamp.MovingToDescendantError, Cls.mp.merge_tree,
+                          self.sess, 2, ids['child21'])
+        # no gap is made in the parent's children for a missing tree
+        self.assertRaises(sqlalchemy.orm.exc.NoResultFound,
+                          Cls.mp.merge_tree, self.sess, 4, ids['root1'],
+                          position='top')
+        self.assertEqual(self.n('child11').mp_path, '00')
+
+    def test_delete_subtrees(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        names = ['child11', 'child13', 'child211', 'child2121', 'child212',
+                 'child22', 'root3']
+        for name in ['child11', 'child13', 'child212', 'child211', 'child22',
+                     'root3']:
+            Cls.mp.delete_subtree(self.sess, self.n(name).id)
+        data_expected = self.sess.execute(query).fetchall()
+        self.sess.rollback()
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement.split()[0])
+        engine = _testlib.engine
+        ids = [self.n(name).id for name in names]
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            Cls.mp.delete_subtrees(self.sess, ids, batch_size=3)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+        self.assertEqual(statements.count('DELETE'), 2)
+
+    def test_delete_subtree_without_closing_gap(self):
+        self._fill_tree()
+        query = sqlalchemy.select([tbl]).order_by(tbl.c.id)
+        names = ['child11', 'child12', 'child211', 'child2122', 'root3']
+        for name in names:
+            Cls.mp.delete_subtree(self.sess, self.n(name).id)
+        data_expected = self.sess.execute(query).fetchall()
+        self.sess.rollback()
+
+        ids = [self.n(name).id for name in names]
+        parent_ids = [Cls.mp.delete_subtree(self.sess, node_id,
+                                            close_gap=False)
+                      for node_id in ids]
+        self.assertEqual(parent_ids, [self.n('root1').id] * 2 +
+                                     [self.n('child21').id,
+                                      self.n('child212').id, None])
+        self.assertNotEqual(self.sess.execute(query).fetchall(), data_expected)
+        checkpoints = list(Cls.mp.compact(self.sess, parent_ids=parent_ids,
+                                          batch_size=2))
+        self.assertEqual(checkpoints, [self.n('child21').id,
+                                       self.n('child212').id])
+        self.assertEqual(self.sess.execute(query).fetchall(), data_expected)
+
     def test_delete_subtree(self):
         self._fill_tree()
         Cls.mp.delete_subtree(self.sess, self.n('child212').id)
@@ -1018,6 +1594,938 @@ class MoveNodesLimitsTestCase(_BaseFunctionalTestCase):
         self.Node.mp.move_subtree_to_top(self.sess, self.r2.id, self.r1.id)
 
 
+class SubtreeCacheTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(SubtreeCacheTestCase, self).setUp()
+        self.cache = sqlamp.SubtreeCache()
+        Cls.mp._mp_opts.cache = self.cache
+
+    def tearDown(self):
+        Cls.mp._mp_opts.cache = None
+        super(SubtreeCacheTestCase, self).tearDown()
+
+    def _cached_names(self):
+        names = []
+        for tree_id, path, kind, depth_limit in self.cache._ranges.get(2, {}):
+            [node] = [node for node in Cls.mp.query(self.sess)
+                      if node.mp_tree_id == tree_id and node.mp_path == path]
+            names.append((node.name, kind))
+        return sorted(names)
+
+    def test_get_descendants_and_children(self):
+        self._fill_tree()
+        child21 = self.n('child21')
+        self.assertEqual(child21.mp.get_descendants(),
+                         child21.mp.query_descendants().all())
+        self.assertEqual(child21.mp.get_descendants(and_self=True),
+                         child21.mp.query_descendants(and_self=True).all())
+        self.assertEqual(child21.mp.get_children(),
+                         child21.mp.query_children().all())
+        self.assertEqual(self._cached_names(), [
+            ('child21', 'children'), ('child21', 'descendants'),
+            ('child21', 'descendants_and_self')
+        ])
+        # cached values should be used for the following calls
+        key = (child21.mp_tree_id, child21.mp_path, 'children',
+               child21.mp_depth + 1)
+        marker = self.cache.get(key)[:1]
+        self.cache.set(key, marker, child21.mp_path, None)
+        self.assertEqual([node.id for node in child21.mp.get_children()],
+                         [node.id for node in marker])
+
+    def test_precise_invalidation(self):
+        self._fill_tree()
+        for name in ('root2', 'child21', 'child212', 'child22'):
+            node = self.n(name)
+            node.mp.get_descendants()
+        root1 = self.n('root1')
+        root1.mp.get_children()
+
+        Cls.mp.move_subtree_before(self.sess, self.n('child2122').id,
+                                   self.n('child211').id)
+        self.sess.commit()
+        self.assertEqual(self._cached_names(), [('child22', 'descendants')])
+        self.assertEqual(len(self.cache._ranges[1]), 1)
+
+        self.sess.expunge_all()
+        child21 = self.n('child21')
+        self.assertEqual(
+            [node.name for node in child21.mp.get_children()],
+            ['child2122', 'child211', 'child212']
+        )
+
+    def test_insert_invalidation(self):
+        self._fill_tree()
+        for name in ('root2', 'child21', 'child212', 'child22'):
+            node = self.n(name)
+            node.mp.get_descendants()
+        self.sess.add(Cls(name='child2113', parent=self.n('child211')))
+        self.sess.commit()
+        self.assertEqual(self._cached_names(), [
+            ('child212', 'descendants'), ('child22', 'descendants')
+        ])
+
+    def test_delete_invalidation(self):
+        self._fill_tree()
+        for name in ('root2', 'child21', 'child2122', 'child22', 'child23'):
+            node = self.n(name)
+            node.mp.get_descendants()
+        Cls.mp.delete_subtree(self.sess, self.n('child22').id)
+        self.sess.commit()
+        # child23 has been pulled up
+        self.assertEqual(self._cached_names(), [
+            ('child21', 'descendants'), ('child2122', 'descendants')
+        ])
+
+    def test_invalidation_on_commit(self):
+        self._fill_tree()
+        self.sess.commit()
+        root2 = self.n('root2')
+        names = [node.name for node in root2.mp.get_descendants()]
+        Cls.mp.detach_subtree(self.sess, self.n('child21').id)
+        # the changing transaction doesn't use the cache
+        self.assertEqual(len(root2.mp.get_descendants()), 2)
+        self.assertEqual(self._cached_names(), [('root2', 'descendants')])
+        self.sess.rollback()
+        self.assertEqual([node.name for node in root2.mp.get_descendants()],
+                         names)
+
+        Cls.mp.detach_subtree(self.sess, self.n('child21').id)
+        self.assertEqual(self._cached_names(), [('root2', 'descendants')])
+        self.sess.commit()
+        self.assertEqual(self._cached_names(), [])
+        self.assertEqual(len(root2.mp.get_descendants()), 2)
+
+    def test_detached_node(self):
+        self._fill_tree()
+        root2 = self.n('root2')
+        Cls.mp.detach_subtree(self.sess, self.n('child21').id)
+        opts = Cls.mp._mp_opts
+        # there is a pending invalidation, but not for a detached query
+        self.assert_(not opts.cache_usable(None, root2.mp_tree_id))
+        opts.invalidate_cache(None, root2.mp_tree_id, root2.mp_path)
+        self.sess.expunge(root2)
+        self.assertEqual([node.name for node in
+                          root2.mp.get_children(session=self.sess)],
+                         ['child22', 'child23'])
+
+    def test_evicted_ranges(self):
+        self._fill_tree()
+        self.cache.backend = sqlamp.DictCacheBackend(maxsize=2)
+        for name in ('root2', 'child21', 'child212', 'child22'):
+            node = self.n(name)
+            node.mp.get_descendants()
+        self.assertEqual(self._cached_names(), [
+            ('child212', 'descendants'), ('child22', 'descendants')
+        ])
+
+    def test_cached_copies(self):
+        self._fill_tree()
+        root2 = self.n('root2')
+        first = root2.mp.get_descendants()
+        second = root2.mp.get_descendants()
+        self.assertEqual(first, second)
+        for node1, node2 in zip(first, second):
+            self.assert_(node1 is node2)
+
+    def test_sessions(self):
+        self._fill_tree()
+        self.sess.commit()
+        root2 = self.n('root2')
+        names = [node.name for node in root2.mp.get_children()]
+        def names_in_other_session():
+            sess = make_session()
+            try:
+                node = sess.query(Cls).get(root2.id)
+                return [child.name for child in node.mp.get_children()]
+            finally:
+                sess.close()
+        # a dirty node of this session is not seen by another one
+        child = root2.mp.get_children()[0]
+        child.name = 'uncommitted'
+        self.assertEqual(names_in_other_session(), names)
+        # flushed changes aren't cached by the changing transaction
+        self.sess.flush()
+        self.assertEqual([node.name for node in root2.mp.get_children()],
+                         ['uncommitted'] + names[1:])
+        self.assertEqual(names_in_other_session(), names)
+        self.sess.commit()
+        self.assertEqual(names_in_other_session(),
+                         ['uncommitted'] + names[1:])
+
+    def test_lru_and_ttl(self):
+        now = [0]
+        backend = sqlamp.DictCacheBackend(maxsize=2, ttl=10,
+                                          timer=lambda: now[0])
+        backend.set('a', [1])
+        backend.set('b', [2])
+        self.assertEqual(backend.get('a'), [1])
+        backend.set('c', [3])
+        # 'b' was the least recently used
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('a'), [1])
+        now[0] = 10
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(backend.get('c'), None)
+
+    def test_threads(self):
+        import threading
+        cache = sqlamp.SubtreeCache(sqlamp.DictCacheBackend(maxsize=8))
+        errors = []
+        def worker(tree_id):
+            try:
+                for x in range(5000):
+                    key = (tree_id, str(x % 16), 'children', None)
+                    cache.set(key, [x], key[1], None)
+                    cache.get(key)
+                    cache.invalidate(tree_id, str(x % 7), None)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+        threads = [threading.Thread(target=worker, args=(x % 2, ))
+                   for x in range(4)]
+        if hasattr(sys, 'setswitchinterval'):
+            # switching threads as often as possible
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assert_(len(cache.backend._entries) <= 8)
+        self.assert_(sum(map(len, cache._ranges.values())) <= 8)
+
+class TreeVersionsTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(TreeVersionsTestCase, self).setUp()
+        self.Node = self._make_tree_class('tbl8', steplen=1,
+                                          track_versions=True)
+        self.versions_tbl = self.Node.mp._mp_opts.versions_table
+
+    def test_versions(self):
+        versions = lambda: self.Node.mp.get_versions(self.sess, [1, 2, 3])
+        self.assertEqual(versions(), {1: 0, 2: 0, 3: 0})
+
+        r1, r2 = self.Node(), self.Node()
+        self.sess.add_all([r1, r2])
+        self.sess.flush()
+        self.assertEqual(versions(), {1: 1, 2: 1, 3: 0})
+
+        c1, c2 = self.Node(parent=r1), self.Node(parent=r1)
+        self.sess.add_all([c1, c2])
+        self.sess.flush()
+        self.assertEqual(versions(), {1: 3, 2: 1, 3: 0})
+
+        self.Node.mp.move_subtree_to_top(self.sess, c2.id, r2.id)
+        self.assertEqual(versions(), {1: 4, 2: 2, 3: 0})
+
+        self.Node.mp.detach_subtree(self.sess, c2.id)
+        self.assertEqual(versions(), {1: 4, 2: 3, 3: 1})
+
+        self.Node.mp.delete_subtree(self.sess, c1.id)
+        self.assertEqual(versions(), {1: 5, 2: 3, 3: 1})
+
+        # rolling back the transaction rolls back versions as well
+        self.sess.rollback()
+        self.assertEqual(versions(), {1: 0, 2: 0, 3: 0})
+        self.assertEqual(self.Node.mp.get_versions(self.sess, []), {})
+
+    def _count_dml(self, operation, *args):
+        # estimated and executed numbers of DML statements
+        cost = self.Node.mp.estimate(self.sess, operation, *args)
+        statements = []
+        def count(conn, cursor, statement, *args):
+            if statement.split()[0] in ('INSERT', 'UPDATE', 'DELETE'):
+                statements.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            getattr(self.Node.mp, operation)(self.sess, *args)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        return cost.statements, len(statements)
+
+    def test_estimate(self):
+        r1 = self.Node()
+        self.sess.add(r1)
+        self.sess.flush()
+        c1, c2 = self.Node(parent=r1), self.Node(parent=r1)
+        self.sess.add_all([c1, c2])
+        self.sess.flush()
+        estimated, executed = self._count_dml('move_subtree_to_top',
+                                              c2.id, r1.id)
+        # a version bump is counted with moving and shifting nodes
+        self.assertEqual((estimated, executed), (5, 5))
+        estimated, executed = self._count_dml('delete_subtree', c1.id)
+        self.assertEqual((estimated, executed), (2, 2))
+
+    def test_concurrent_first_version(self):
+        opts = self.Node.mp._mp_opts
+        connection = self.sess.connection()
+        if opts._version_upsert(connection.dialect.name) is not None:
+            # no race, see test_version_upserts
+            return
+        def insert_version(conn, clause, multiparams, params, result):
+            # imitates a concurrent transaction which inserts the version
+            # after it was found missing by this one
+            if clause is opts._statements['bump_version'] and not inserted:
+                inserted.append(True)
+                conn.execute(self.versions_tbl.insert(), tree_id=1, version=5)
+        inserted = []
+        sqlalchemy.event.listen(connection, 'after_execute', insert_version)
+        try:
+            opts.bump_versions(connection, [1])
+        finally:
+            sqlalchemy.event.remove(connection, 'after_execute',
+                                    insert_version)
+        self.assertEqual(self.Node.mp.get_versions(self.sess, [1]), {1: 6})
+
+    def test_version_upserts(self):
+        from sqlalchemy.dialects import mysql, postgresql
+        opts = self.Node.mp._mp_opts
+        for dialect in (postgresql.dialect(), mysql.dialect()):
+            statement = opts._version_upsert(dialect.name)
+            if statement is not None:
+                self.assert_('__mp_versions.version +' in
+                             str(statement.compile(dialect=dialect)))
+
+
+
+class TreeLocksTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(TreeLocksTestCase, self).setUp()
+        self.Node = self._make_tree_class('tbl10', steplen=1,
+                                          tree_locks=True)
+        self.locks_tbl = self.Node.mp._mp_opts.locks_table
+
+    def _locked(self):
+        return sorted(tree_id for [tree_id] in
+                      self.sess.execute(self.locks_tbl.select()))
+
+    def test_locks(self):
+        r1, r2 = self.Node(), self.Node()
+        self.sess.add_all([r1, r2])
+        self.sess.flush()
+        c1, c2 = self.Node(parent=r1), self.Node(parent=r1)
+        self.sess.add_all([c1, c2])
+        self.sess.flush()
+        self.assertEqual(self._locked(), [])
+
+        self.Node.mp.move_subtree_to_top(self.sess, c2.id, r2.id)
+        self.assertEqual(self._locked(), [1, 2])
+        self.Node.mp.detach_subtree(self.sess, c2.id)
+        self.Node.mp.delete_subtree(self.sess, c2.id)
+        self.assertEqual(self._locked(), [1, 2, 3])
+        self.assertEqual(
+            [(n.mp_tree_id, n.mp_path) for n in
+             self.Node.mp.query(self.sess)],
+            [(1, ''), (1, '0'), (2, '')]
+        )
+
+    def test_estimate(self):
+        r1 = self.Node()
+        self.sess.add(r1)
+        self.sess.flush()
+        c1, c2 = self.Node(parent=r1), self.Node(parent=r1)
+        self.sess.add_all([c1, c2])
+        self.sess.flush()
+        opts = self.Node.mp._mp_opts
+        # the lock row of the tree exists
+        opts.lock_trees(self.sess, [1])
+        cost = self.Node.mp.estimate(self.sess, 'move_subtree_to_top',
+                                     c2.id, r1.id)
+        if self.sess.connection().dialect.name == 'postgresql':
+            self.assertEqual(cost.statements, 4)
+        else:
+            # and a lock of the tree
+            self.assertEqual(cost.statements, 5)
+
+    def test_concurrent_first_lock(self):
+        opts = self.Node.mp._mp_opts
+        connection = self.sess.connection()
+        if connection.dialect.name == 'postgresql':
+            # advisory locks are used
+            return
+        def insert_lock(conn, clause, multiparams, params, result):
+            # imitates a concurrent transaction which inserts the row
+            # after it was found missing by this one
+            if clause is opts._statements['lock_tree'] and not inserted:
+                inserted.append(True)
+                conn.execute(self.locks_tbl.insert(), tree_id=1)
+        inserted = []
+        sqlalchemy.event.listen(connection, 'after_execute', insert_lock)
+        try:
+            opts.lock_trees(connection, [2, 1])
+        finally:
+            sqlalchemy.event.remove(connection, 'after_execute', insert_lock)
+        self.assertEqual(self._locked(), [1, 2])
+
+    def test_advisory_locks(self):
+        from sqlalchemy.dialects import postgresql
+        opts = self.Node.mp._mp_opts
+        statement = opts._build_statements()['advisory_lock']
+        self.assert_('pg_advisory_xact_lock' in
+                     str(statement.compile(dialect=postgresql.dialect())))
+
+class OrderedTreeTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(OrderedTreeTestCase, self).setUp()
+        name = sqlalchemy.Column('name', sqlalchemy.String(100))
+        rank = sqlalchemy.Column('rank', sqlalchemy.Integer)
+        # both column names and columns are accepted
+        self.Node = self._make_tree_class('tbl11', [name, rank], steplen=1,
+                                          node_order_by=['rank', name])
+        self.tbl = self.Node.mp._mp_opts.table
+
+    def _children(self, parent):
+        return [(node.mp_path, node.rank, node.name) for node in
+                self.sess.query(self.Node).filter_by(parent=parent)
+                                          .order_by(self.tbl.c.mp_path)]
+
+    def test_create_tree(self):
+        root = self.Node(name='root', rank=0)
+        self.sess.add_all([root, self.Node(name='c', rank=1, parent=root)])
+        self.sess.flush()
+        node_id = self.Node.mp.create_tree(self.sess, {
+            'name': 'b', 'rank': 1, 'children': [
+                {'name': 'y', 'rank': 2}, {'name': 'x', 'rank': 2},
+                {'name': 'z', 'rank': None},
+            ]
+        }, root.id)
+        node = self.sess.query(self.Node).get(node_id)
+        self.assertEqual(self._children(root),
+                         [('0', 1, 'b'), ('1', 1, 'c')])
+        self.assertEqual(self._children(node),
+                         [('00', 2, 'x'), ('01', 2, 'y'), ('02', None, 'z')])
+
+    def test_nulls_order(self):
+        # NULLs go last both when nodes are inserted one by one
+        # and when they are created by create_tree()
+        values = [(None, 'b'), (1, 'a'), (None, 'a'), (None, None),
+                  (2, None), (1, 'c')]
+        expected = [(1, 'a'), (1, 'c'), (2, None), (None, 'a'),
+                    (None, 'b'), (None, None)]
+        root = self.Node(name='root', rank=0)
+        self.sess.add(root)
+        self.sess.flush()
+        for rank, name in values:
+            self.sess.add(self.Node(name=name, rank=rank, parent=root))
+            self.sess.flush()
+        self.sess.expire_all()
+        self.assertEqual([(rank, name) for _, rank, name in
+                          self._children(root)], expected)
+        root_id = self.Node.mp.create_tree(self.sess, {
+            'name': 'root', 'rank': 0, 'children': [
+                {'name': name, 'rank': rank} for rank, name in values
+            ]
+        })
+        root = self.sess.query(self.Node).get(root_id)
+        self.assertEqual([(rank, name) for _, rank, name in
+                          self._children(root)], expected)
+
+    def test_insert(self):
+        root = self.Node(name='root', rank=0)
+        self.sess.add(root)
+        self.sess.flush()
+        for rank, name in [(1, 'b'), (1, 'd'), (0, 'z'), (1, 'a')]:
+            node = self.Node(name=name, rank=rank, parent=root)
+            self.sess.add(node)
+            self.sess.flush()
+            self.assertEqual(
+                self.sess.execute(
+                    sqlalchemy.select([self.tbl.c.mp_path])
+                        .where(self.tbl.c.id == node.id)
+                ).scalar(),
+                node.mp_path
+            )
+        self.sess.add_all([self.Node(name='c', rank=1, parent=root),
+                           self.Node(name='e', rank=1, parent=root),
+                           self.Node(name='c', rank=0, parent=root)])
+        self.sess.flush()
+        self.sess.expire_all()
+        self.assertEqual(self._children(root), [
+            ('0', 0, 'c'), ('1', 0, 'z'), ('2', 1, 'a'), ('3', 1, 'b'),
+            ('4', 1, 'c'), ('5', 1, 'd'), ('6', 1, 'e'),
+        ])
+
+    def test_move(self):
+        root1 = self.Node(name='root1', rank=0)
+        root2 = self.Node(name='root2', rank=0)
+        nodes = dict((name, self.Node(name=name, rank=0, parent=root1))
+                     for name in 'bdf')
+        nodes['c'] = self.Node(name='c', rank=0, parent=root2)
+        nodes['g'] = self.Node(name='g', rank=0, parent=root2)
+        self.sess.add_all([root1, root2] + list(nodes.values()))
+        self.sess.flush()
+        self.sess.add(self.Node(name='x', rank=0, parent=nodes['c']))
+        self.sess.flush()
+
+        self.Node.mp.move_subtree_to_top(self.sess, nodes['c'].id, root1.id)
+        self.Node.mp.move_subtree_to_bottom(self.sess, nodes['g'].id,
+                                            root1.id)
+        self.sess.expire_all()
+        self.assertEqual(self._children(root1), [
+            ('0', 0, 'b'), ('1', 0, 'c'), ('2', 0, 'd'), ('3', 0, 'f'),
+            ('4', 0, 'g'),
+        ])
+        self.assertEqual(self._children(nodes['c']), [('10', 0, 'x')])
+
+        # moving to the same parent keeps the order
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = _testlib.engine
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            self.Node.mp.move_subtree_to_top(self.sess, nodes['g'].id,
+                                             root1.id)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual([statement for statement in statements
+                          if statement.split()[0] == 'UPDATE'], [])
+        self.sess.expire_all()
+        self.assertEqual([name for _, _, name in self._children(root1)],
+                         list('bcdfg'))
+
+    def test_apply_moves(self):
+        root1 = self.Node(name='root1', rank=0)
+        root2 = self.Node(name='root2', rank=0)
+        nodes = dict((name, self.Node(name=name, rank=0, parent=root1))
+                     for name in 'bdf')
+        for name, rank in [('c', 0), ('g', 0), ('a', None)]:
+            nodes[name] = self.Node(name=name, rank=rank, parent=root2)
+        self.sess.add_all([root1, root2] + list(nodes.values()))
+        self.sess.flush()
+
+        self.Node.mp.apply_moves(self.sess, [
+            ('move_subtree_to_top', nodes['c'].id, root1.id),
+        ])
+        self.sess.expire_all()
+        self.assertEqual([name for _, _, name in self._children(root1)],
+                         list('bcdf'))
+
+        # the same order as after calling the methods one by one:
+        # `d` goes right before the first sibling which follows it
+        self.Node.mp.apply_moves(self.sess, [
+            ('move_subtree_to_top', nodes['a'].id, root1.id),
+            ('move_subtree_after', nodes['g'].id, nodes['b'].id),
+            ('move_subtree_to_bottom', nodes['d'].id, root1.id),
+        ])
+        self.sess.expire_all()
+        self.assertEqual([name for _, _, name in self._children(root1)],
+                         list('bdgcfa'))
+        self.assertEqual(list(self.Node.mp.check_integrity(self.sess)), [])
+
+class BinaryPathsTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(BinaryPathsTestCase, self).setUp()
+        self.Node = self._make_tree_class(
+            'tbl12', [sqlalchemy.Column('name', sqlalchemy.String(100))],
+            steplen=1, binary_paths=True
+        )
+        self.tbl = self.Node.mp._mp_opts.table
+
+    def _paths(self):
+        return [(node.name, node.mp_path) for node in
+                self.Node.mp.query(self.sess)]
+
+    def test_paths(self):
+        self.assertEqual(self.Node.mp.max_children, 256)
+        root = self.Node(name='root')
+        self.sess.add(root)
+        self.sess.flush()
+        nodes = [self.Node(name=str(x), parent=root) for x in range(256)]
+        self.sess.add_all(nodes)
+        self.sess.flush()
+        self.assertEqual(sorted(node.mp_path for node in nodes),
+                         list(sqlamp.BINARY_ALPHABET))
+        child = self.Node(name='child', parent=root.mp.get_children()[-1])
+        self.sess.add(child)
+        self.sess.flush()
+        self.assertEqual(child.mp_path, '\xff\x00')
+        [stored] = self.sess.execute(
+            sqlalchemy.text('SELECT mp_path FROM tbl12 WHERE id = :id'),
+            {'id': child.id}
+        ).fetchone()
+        self.assertEqual(bytes(stored), b'\xff\x00')
+        self.sess.add(self.Node(name='extra', parent=root))
+        self.assertRaises(sqlamp.TooManyChildrenError, self.sess.flush)
+
+    def test_queries_and_moves(self):
+        root = self.Node(name='root')
+        node1 = self.Node(name='1', parent=root)
+        node2 = self.Node(name='2', parent=root)
+        node21 = self.Node(name='21', parent=node2)
+        node211 = self.Node(name='211', parent=node21)
+        self.sess.add_all([root, node1, node2, node21, node211])
+        self.sess.flush()
+        self.assertEqual(
+            [node.name for node in node211.mp.query_ancestors()],
+            ['root', '2', '21']
+        )
+        self.assertEqual(
+            [node.name for node in node2.mp.query_descendants()],
+            ['21', '211']
+        )
+        self.Node.mp.move_subtree_to_top(self.sess, node21.id, node1.id)
+        self.Node.mp.move_subtree_before(self.sess, node2.id, node1.id)
+        self.sess.expire_all()
+        self.assertEqual(self._paths(), [
+            ('root', ''), ('2', '\x00'), ('1', '\x01'),
+            ('21', '\x01\x00'), ('211', '\x01\x00\x00')
+        ])
+        self.Node.mp.rebuild_tree(self.sess, root.id)
+        self.sess.expire_all()
+        self.assertEqual(self._paths(), [
+            ('root', ''), ('1', '\x00'), ('21', '\x00\x00'),
+            ('211', '\x00\x00\x00'), ('2', '\x01')
+        ])
+        self.assertEqual(list(self.Node.mp.check_integrity(self.sess)), [])
+
+
+class AlphabetTestCase(_BaseFunctionalTestCase):
+    # wildcards and the escape character of LIKE are digits as well
+    alphabet = '%0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ\\_' \
+               'abcdefghijklmnopqrstuvwxyz'
+
+    def setUp(self):
+        super(AlphabetTestCase, self).setUp()
+        self.Node = self._make_tree_class(
+            'tbl13', [sqlalchemy.Column('name', sqlalchemy.String(100))],
+            steplen=1, alphabet=self.alphabet
+        )
+        self.tbl = self.Node.mp._mp_opts.table
+
+    def test_paths(self):
+        self.assertEqual(self.Node.mp.max_children, 65)
+        self.assert_(self.Node.mp.check_alphabet(self.sess))
+        root = self.Node(name='root')
+        self.sess.add(root)
+        self.sess.flush()
+        nodes = [self.Node(name=str(x), parent=root) for x in range(65)]
+        self.sess.add_all(nodes)
+        self.sess.flush()
+        self.assertEqual(sorted(node.mp_path for node in nodes),
+                         list(self.alphabet))
+        [underscore] = [node for node in nodes if node.mp_path == '_']
+        child = self.Node(name='child', parent=underscore)
+        grandchild = self.Node(name='grandchild', parent=child)
+        self.sess.add_all([child, grandchild])
+        self.sess.flush()
+        self.assertEqual(grandchild.mp_path, '_%%')
+        self.assertEqual(grandchild.mp.query_ancestors().all(),
+                         [root, underscore, child])
+        self.assertEqual(underscore.mp.query_descendants().all(),
+                         [child, grandchild])
+        [backslash] = [node for node in nodes if node.mp_path == '\\']
+        child = self.Node(name='child', parent=backslash)
+        self.sess.add(child)
+        self.sess.flush()
+        self.assertEqual(child.mp.query_ancestors().all(), [root, backslash])
+        self.sess.add(self.Node(name='extra', parent=root))
+        self.assertRaises(sqlamp.TooManyChildrenError, self.sess.flush)
+
+    def test_export_other_alphabet(self):
+        self.sess.add(self.Node(name='root'))
+        self.sess.flush()
+        class Lines(list):
+            write = list.append
+        lines = Lines()
+        self.Node.mp.export_tree(self.sess, 1, lines)
+        header = json.loads(lines[0])
+        self.assertEqual(header['alphabet'], self.alphabet)
+        # steplen of the test tree
+        header['steplen'] = [2]
+        lines[0] = json.dumps(header)
+        self.assertRaises(ValueError, Cls.mp.import_tree, self.sess, lines)
+
+    def test_unsorted_alphabet(self):
+        self.assertRaises(AssertionError, sqlamp.MPOptions, self.tbl,
+                          alphabet='0123456789abcdefA')
+        self.assertRaises(AssertionError, sqlamp.MPOptions, self.tbl,
+                          alphabet='00')
+
+
+class StepScheduleTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(StepScheduleTestCase, self).setUp()
+        self.Node = self._make_tree_class(
+            'tbl14', [sqlalchemy.Column('name', sqlalchemy.String(100))],
+            steplen=[2, 1]
+        )
+        self.tbl = self.Node.mp._mp_opts.table
+        self.nodes = {}
+        for name, parent in [('root', None), ('a', 'root'), ('b', 'root'),
+                             ('b1', 'b'), ('b2', 'b'), ('b21', 'b2')]:
+            node = self.Node(name=name, parent=self.nodes.get(parent))
+            self.sess.add(node)
+            self.sess.flush()
+            self.nodes[name] = node
+
+    def _tree(self):
+        self.sess.expire_all()
+        self.assertEqual(list(self.Node.mp.check_integrity(self.sess)), [])
+        return [(node.name, node.mp_tree_id, node.mp_path, node.mp_depth)
+                for node in self.Node.mp.query(self.sess)]
+
+    def test_limits(self):
+        self.assertEqual(self.Node.mp.max_children, 36)
+        self.assertEqual(self.Node.mp.max_depth, 255)
+        self.assertEqual(self._tree(), [
+            ('root', 1, '', 0), ('a', 1, '00', 1), ('b', 1, '01', 1),
+            ('b1', 1, '010', 2), ('b2', 1, '011', 2), ('b21', 1, '0110', 3)
+        ])
+        self.assertEqual(
+            [node.name for node in self.nodes['b21'].mp.query_ancestors()],
+            ['root', 'b', 'b2']
+        )
+
+    def test_moves_between_levels(self):
+        nodes = self.nodes
+        self.Node.mp.detach_subtree(self.sess, nodes['b'].id)
+        self.assertEqual(self._tree(), [
+            ('root', 1, '', 0), ('a', 1, '00', 1),
+            ('b', 2, '', 0), ('b1', 2, '00', 1), ('b2', 2, '01', 1),
+            ('b21', 2, '010', 2)
+        ])
+        self.Node.mp.move_subtree_to_top(self.sess, nodes['b'].id,
+                                         nodes['a'].id)
+        self.assertEqual(self._tree(), [
+            ('root', 1, '', 0), ('a', 1, '00', 1), ('b', 1, '000', 2),
+            ('b1', 1, '0000', 3), ('b2', 1, '0001', 3), ('b21', 1, '00010', 4)
+        ])
+        self.Node.mp.move_subtree_after(self.sess, nodes['b'].id,
+                                        nodes['a'].id)
+        self.assertEqual(self._tree(), [
+            ('root', 1, '', 0), ('a', 1, '00', 1), ('b', 1, '01', 1),
+            ('b1', 1, '010', 2), ('b2', 1, '011', 2), ('b21', 1, '0110', 3)
+        ])
+        copy_id = self.Node.mp.copy_subtree(self.sess, nodes['root'].id,
+                                            nodes['b21'].id)
+        copy = self.sess.query(self.Node).get(copy_id)
+        self.assertEqual(
+            [(node.name, node.mp_path) for node in
+             copy.mp.query_descendants()],
+            [('a', '011000'), ('b', '011001'), ('b1', '0110010'),
+             ('b2', '0110011'), ('b21', '01100110')]
+        )
+        self._tree()
+
+    def test_merge_and_reorder(self):
+        nodes = self.nodes
+        tree_id = self.Node.mp.create_tree(self.sess, {
+            'name': 'new', 'children': [{'name': 'new2'}, {'name': 'new1'}]
+        })
+        new = self.sess.query(self.Node).get(tree_id)
+        self.Node.mp.merge_tree(self.sess, new.mp_tree_id, nodes['b2'].id)
+        self.Node.mp.reorder_children(self.sess, new.id, self.tbl.c.name)
+        self.assertEqual(self._tree()[-4:], [
+            ('b21', 1, '0110', 3), ('new', 1, '0111', 3),
+            ('new1', 1, '01110', 4), ('new2', 1, '01111', 4)
+        ])
+
+    def test_export_import(self):
+        class Lines(list):
+            write = list.append
+        lines = Lines()
+        self.Node.mp.export_tree(self.sess, 1, lines)
+        self.assertEqual(json.loads(lines[0])['steplen'], [2, 1])
+        self.assertRaises(ValueError, Cls.mp.import_tree, self.sess, lines)
+        tree_id = self.Node.mp.import_tree(self.sess, lines)
+        self.assertEqual([row[2:] for row in self._tree()
+                          if row[1] == tree_id],
+                         [row[2:] for row in self._tree() if row[1] == 1])
+
+
+class EventsTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(EventsTestCase, self).setUp()
+        self.events = []
+        self.listeners = []
+        for name in ('node_inserted', 'subtree_moved', 'subtree_deleted',
+                     'subtree_created', 'subtree_rebuilt',
+                     'siblings_shifted'):
+            listener = self._make_listener(name)
+            sqlalchemy.event.listen(Cls.mp, name, listener)
+            self.listeners.append((name, listener))
+
+    def tearDown(self):
+        for name, listener in self.listeners:
+            sqlalchemy.event.remove(Cls.mp, name, listener)
+        super(EventsTestCase, self).tearDown()
+
+    def _make_listener(self, name):
+        def listener(session, *args):
+            self.assert_(session is self.sess)
+            if name == 'node_inserted':
+                instance, new_range = args
+                args = (instance.name, new_range)
+            self.events.append((name, ) + tuple(args))
+        return listener
+
+    def test_node_inserted(self):
+        self._fill_tree()
+        self.assertEqual(len(self.events), 15)
+        self.assertEqual(self.events[:2], [
+            ('node_inserted', 'root1', sqlamp.PathRange(1, '', None)),
+            ('node_inserted', 'child11', sqlamp.PathRange(1, '00', '01')),
+        ])
+
+    def test_subtree_moved(self):
+        self._fill_tree()
+        del self.events[:]
+        node_id = self.n('child211').id
+        Cls.mp.move_subtree_after(self.sess, node_id,
+                                  self.n('child2121').id)
+        self.assertEqual(self.events, [
+            ('siblings_shifted', sqlamp.PathRange(2, '000101', '0002'),
+                                 sqlamp.PathRange(2, '000102', '0002')),
+            ('subtree_moved', node_id,
+                sqlamp.PathRange(2, '0000', '0001'),
+                sqlamp.PathRange(2, '000101', '000102')),
+            ('siblings_shifted', sqlamp.PathRange(2, '0001', '01'),
+                                 sqlamp.PathRange(2, '0000', '01')),
+        ])
+
+    def test_subtree_deleted(self):
+        self._fill_tree()
+        del self.events[:]
+        node_id = self.n('child21').id
+        Cls.mp.delete_subtree(self.sess, node_id)
+        self.assertEqual(self.events, [
+            ('subtree_deleted', node_id, sqlamp.PathRange(2, '00', '01')),
+            ('siblings_shifted', sqlamp.PathRange(2, '01', None),
+                                 sqlamp.PathRange(2, '00', None)),
+        ])
+
+    def test_subtree_created_by_import(self):
+        self._fill_tree()
+        class Lines(list):
+            write = list.append
+        lines = Lines()
+        Cls.mp.export_tree(self.sess, 2, lines)
+        del self.events[:]
+        tree_id = Cls.mp.import_tree(self.sess, lines)
+        root_id = self.sess.query(Cls).filter_by(mp_tree_id=tree_id,
+                                                 mp_path='').one().id
+        self.assertEqual(self.events, [
+            ('subtree_created', root_id, sqlamp.PathRange(tree_id, '', None)),
+        ])
+
+    def test_subtree_created_by_create_tree(self):
+        self._fill_tree()
+        del self.events[:]
+        data = {'name': 'new', 'children': [{'name': 'new1'}]}
+        root_id = Cls.mp.create_tree(self.sess, data)
+        subtree_id = Cls.mp.create_tree(self.sess, data, self.n('child12').id)
+        self.assertEqual(self.events, [
+            ('subtree_created', root_id, sqlamp.PathRange(4, '', None)),
+            ('subtree_created', subtree_id,
+                sqlamp.PathRange(1, '0100', '0101')),
+        ])
+
+    def test_subtree_rebuilt(self):
+        self._fill_tree()
+        del self.events[:]
+        root_id, child21_id = self.n('root2').id, self.n('child21').id
+        Cls.mp.rebuild_subtree(self.sess, child21_id)
+        Cls.mp.rebuild_tree(self.sess, root_id)
+        self.assertEqual(self.events, [
+            ('subtree_rebuilt', child21_id, sqlamp.PathRange(2, '00', '01')),
+            ('subtree_rebuilt', root_id, sqlamp.PathRange(2, '', None)),
+        ])
+
+
+class StatementsCacheTestCase(_BaseFunctionalTestCase):
+    def test_compiled_statements_reused(self):
+        self._fill_tree()
+        opts = Cls.mp._mp_opts
+        def move_around():
+            n = lambda name: self.n(name).id
+            Cls.mp.move_subtree_after(self.sess, n('child211'),
+                                      n('child2121'))
+            Cls.mp.move_subtree_to_bottom(self.sess, n('child211'),
+                                          n('child21'))
+            Cls.mp.move_subtree_to_top(self.sess, n('root1'), n('child22'))
+            Cls.mp.detach_subtree(self.sess, n('root1'))
+            self.sess.add(Cls(name='new', parent=self.n('child13')))
+            self.sess.flush()
+            Cls.mp.delete_subtree(self.sess, n('new'))
+        move_around()
+        cached = len(opts._compiled_cache)
+        self.assert_(cached)
+        move_around()
+        self.assertEqual(len(opts._compiled_cache), cached)
+
+    def test_chunk_end_statements_limited(self):
+        self._fill_tree()
+        opts = Cls.mp._mp_opts
+        for chunk_size in range(1, 10):
+            self.assertEqual(opts.chunk_end(self.sess, 2, '', None,
+                                            chunk_size),
+                             ['', '00', '0000', '0001', '000100', '000101',
+                              '00010100', '00010101', '01', '02'][chunk_size])
+            self.assert_(len(opts._chunk_end_statements) <= 4)
+        self.assertEqual(list(opts._chunk_end_statements), [6, 7, 8, 9])
+
+
+
+class ConcurrencyTestCase(_BaseFunctionalTestCase):
+    def setUp(self):
+        super(ConcurrencyTestCase, self).setUp()
+        Cls.mp._mp_opts.concurrency = 'retry'
+        self.root = Cls(name='root')
+        self.sess.add(self.root)
+        self.sess.flush()
+        # node of a concurrent transaction, committed before the node
+        # of this one is inserted.
+        self.other = Cls(name='other', parent=self.root)
+        self.sess.add(self.other)
+        self.sess.commit()
+        self.stale_attempts = 1
+        self.taken_paths = []
+        sqlalchemy.event.listen(Cls, 'before_insert', self._take_path)
+
+    def tearDown(self):
+        sqlalchemy.event.remove(Cls, 'before_insert', self._take_path)
+        Cls.mp._mp_opts.concurrency = None
+        super(ConcurrencyTestCase, self).tearDown()
+
+    def _take_path(self, mapper, connection, instance):
+        # imitates the path calculated before the concurrent
+        # transaction has committed its node.
+        if len(self.taken_paths) < self.stale_attempts:
+            instance.mp_path = self.other.mp_path
+        self.taken_paths.append(instance.mp_path)
+
+    def test_flush_retries(self):
+        node = Cls(name='node', parent=self.root)
+        self.sess.add(node)
+        Cls.mp.flush(self.sess)
+        self.assertEqual(self.taken_paths, ['00', '01'])
+        self.assertEqual(node.mp_path, '01')
+        self.sess.commit()
+        self.assertEqual(self.sess.query(Cls).count(), 3)
+        self.assertEqual(
+            [path for path, in self.sess.query(Cls.mp_path) \
+                                        .filter(Cls.parent == self.root) \
+                                        .order_by(Cls.mp_path)],
+            ['00', '01']
+        )
+
+    def test_flush_retries_exhausted(self):
+        self.stale_attempts = 2
+        node = Cls(name='node', parent=self.root)
+        self.sess.add(node)
+        self.assertRaises(sqlalchemy.exc.IntegrityError,
+                          Cls.mp.flush, self.sess, retries=1)
+        self.assertEqual(self.taken_paths, ['00', '00'])
+        self.assert_(node in self.sess.new)
+
 def get_suite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()